@@ -1,6 +1,7 @@
 import os
 from typing import Optional
-from supabase import create_client, Client
+import httpx
+from supabase import create_client, Client, acreate_client, AsyncClient, AsyncClientOptions
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -8,6 +9,13 @@ load_dotenv()
 url: Optional[str] = os.environ.get("SUPABASE_URL")
 key: Optional[str] = os.environ.get("SUPABASE_KEY")
 
+# Async client mode and its connection pool, tune per deployment
+SUPABASE_ASYNC: bool = os.environ.get("SUPABASE_ASYNC", "false").lower() in ("1", "true", "yes")
+SUPABASE_POOL_MAX_CONNECTIONS = int(os.environ.get("SUPABASE_POOL_MAX_CONNECTIONS", 100))
+SUPABASE_POOL_MAX_KEEPALIVE = int(os.environ.get("SUPABASE_POOL_MAX_KEEPALIVE", 20))
+SUPABASE_POOL_KEEPALIVE_EXPIRY = float(os.environ.get("SUPABASE_POOL_KEEPALIVE_EXPIRY", 30))
+SUPABASE_POOL_TIMEOUT = float(os.environ.get("SUPABASE_POOL_TIMEOUT", 30))
+
 # Initialize Supabase client with error handling
 supabase: Optional[Client] = None
 if url and key:
@@ -17,8 +25,51 @@ if url and key:
         print(f"Warning: Failed to initialize Supabase client: {e}")
         print("The application will start but database operations will fail.")
 
+# Created by the app lifespan (see init_async_supabase), None while async mode is off
+async_supabase: Optional[AsyncClient] = None
+_async_http_client: Optional[httpx.AsyncClient] = None
+
 def get_supabase_client() -> Client:
     """Dependency to get Supabase client"""
     if supabase is None:
         raise Exception("Supabase client is not initialized")
     return supabase
+
+def get_async_supabase() -> Optional[AsyncClient]:
+    """Returns the async Supabase client, or None when async mode is off or not started."""
+    return async_supabase
+
+def get_async_supabase_client() -> AsyncClient:
+    """Dependency to get the async Supabase client"""
+    if async_supabase is None:
+        raise Exception("Async Supabase client is not initialized")
+    return async_supabase
+
+async def init_async_supabase() -> Optional[AsyncClient]:
+    """Creates the pooled async client, called once on application startup."""
+    global async_supabase, _async_http_client
+    if not (SUPABASE_ASYNC and url and key) or async_supabase is not None:
+        return async_supabase
+
+    _async_http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=SUPABASE_POOL_MAX_CONNECTIONS,
+                            max_keepalive_connections=SUPABASE_POOL_MAX_KEEPALIVE,
+                            keepalive_expiry=SUPABASE_POOL_KEEPALIVE_EXPIRY),
+        timeout=SUPABASE_POOL_TIMEOUT,
+    )
+    try:
+        async_supabase = await acreate_client(url, key, options=AsyncClientOptions(httpx_client=_async_http_client))
+    except Exception as e:
+        print(f"Warning: Failed to initialize async Supabase client: {e}")
+        print("Falling back to the synchronous client.")
+        await _async_http_client.aclose()
+        _async_http_client = None
+    return async_supabase
+
+async def close_async_supabase() -> None:
+    """Closes the async client's connection pool, called on application shutdown."""
+    global async_supabase, _async_http_client
+    if _async_http_client is not None:
+        await _async_http_client.aclose()
+    async_supabase = None
+    _async_http_client = None
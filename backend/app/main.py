@@ -1,11 +1,34 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from routers import users, nodes, images, links
+from routers import users, nodes, images, links, graph, sync
+from db.db import init_async_supabase, close_async_supabase
+from services.offload import pool_stats, shutdown_pools
+from services.security import hashing_engine, security_service
+from services.http_client import outbound_http
+from services.image_services import image_service
+from services.link_services import link_service
+from services.media_pipeline import media_pipeline
+from services.image_metadata import image_metadata_service
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Opens shared clients on startup and closes them on shutdown"""
+    await init_async_supabase()
+    await outbound_http.start()
+    yield
+    await close_async_supabase()
+    await outbound_http.close()
+    shutdown_pools()
+    hashing_engine.shutdown()
+    image_metadata_service.shutdown()
+    media_pipeline.shutdown()
 
 app = FastAPI(
     title="MemoLink API",
     description="Backend API for MemoLink - Memory Graph Application",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configure CORS - Allow frontend origins
@@ -26,6 +49,8 @@ app.include_router(users.router)
 app.include_router(images.router)
 app.include_router(nodes.router)
 app.include_router(links.router)
+app.include_router(graph.router)
+app.include_router(sync.router)
 
 @app.get("/")
 @app.head("/")
@@ -41,4 +66,27 @@ async def root():
 @app.head("/health")
 async def health_check():
     """Health check endpoint for monitoring"""
-    return {"status": "healthy"}
\ No newline at end of file
+    return {"status": "healthy"}
+
+@app.get("/health/pools")
+async def pools_health(verified_id : int = Depends(security_service.get_current_user)):
+    """Queue depth and wait time of the blocking service thread pools"""
+    return pool_stats()
+
+@app.get("/health/media")
+async def media_health(verified_id : int = Depends(security_service.get_current_user)):
+    """Pending, finished and dropped background image jobs"""
+    return media_pipeline.stats()
+
+@app.get("/health/caches")
+async def caches_health(verified_id : int = Depends(security_service.get_current_user)):
+    """Hit and miss counters of the in-process caches"""
+    caches = {"jwt": security_service.token_cache.stats(), "links": link_service.cache.stats()}
+    if hasattr(image_service.url_cache, "stats"):
+        caches["signed_urls"] = image_service.url_cache.stats()
+    return caches
+
+@app.get("/health/outbound")
+async def outbound_health(verified_id : int = Depends(security_service.get_current_user)):
+    """Aggregate latency of outbound image fetches and DNS cache counters"""
+    return outbound_http.stats()
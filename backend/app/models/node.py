@@ -13,6 +13,9 @@ class NodeDataFields(Enum):
     position_y : str = "position_y"
     custom_date : str = "custom_date"
 
+# Columns of a node row sent to clients, the generated search_vector and timeline_at stay in the database
+NODE_COLUMNS = tuple(field.value for field in NodeDataFields) + ("created_at", "updated_at")
+
 class NodeOp(BaseModel):
     user_id : int
     image_id : str
@@ -27,17 +30,32 @@ class NodeCreate(NodeOp):
     position_y : float | None = None
     custom_date : datetime.datetime | None = None
 
-class NodeUpdate(NodeOp):
+class NodeUpdate(NodeOp):  # only the fields set explicitly are written
     user_id : int
     node_id : str
-    image_id : str
-    description : str
+    image_id : str | None = None
+    description : str | None = None
+    title : str | None = None
+    tags : list[str] | None = None
+    position_x : float | None = None
+    position_y : float | None = None
+    custom_date : datetime.datetime | None = None
+
+class NodePatch(BaseModel):  # request body of update_node, user_id comes from the token
+    node_id : str
+    image_id : str | None = None
+    description : str | None = None
     title : str | None = None
     tags : list[str] | None = None
     position_x : float | None = None
     position_y : float | None = None
     custom_date : datetime.datetime | None = None
 
+class NodePosition(BaseModel):
+    node_id : str
+    position_x : float
+    position_y : float
+
 class NodeInfoDelete(BaseModel):  # Simplified model for node info/delete operations
     user_id : int
     node_id : str
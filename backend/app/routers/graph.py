@@ -0,0 +1,50 @@
+from fastapi import APIRouter, Body, Depends, Query, Request, Response
+from typing import Optional
+from services.graph_services import graph_service, MAX_HOPS
+from services.graph_index import Direction
+from services.derivatives import ImageSize
+from services.security import security_service
+
+router = APIRouter(prefix="/graph", tags=["Graph"])
+
+@router.get("/snapshot")
+async def graph_snapshot(request : Request, response : Response, size : Optional[ImageSize] = None,
+                        verified_id : int = Depends(security_service.get_current_user)):
+    """Returns nodes, links and signed image urls of the user in one payload, 304 if If-None-Match still holds."""
+    etag, payload = await graph_service.snapshot(user_id=verified_id,
+                                                 if_none_match=request.headers.get("if-none-match"), size=size)
+    if payload is None:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return payload
+
+@router.get("/neighbors")
+async def graph_neighbors(node_id : str, direction : Direction = "both",
+                        verified_id : int = Depends(security_service.get_current_user)):
+    """Nodes linked to node_id, direction: both, out (node is source) or in (node is target)"""
+    neighbors = await graph_service.neighbors(user_id=verified_id, node_id=node_id, direction=direction)
+    return {"node_id": node_id, "neighbors": neighbors}
+
+@router.get("/khop")
+async def graph_khop(node_id : str, k : int = Query(2, ge=1, le=MAX_HOPS), direction : Direction = "both",
+                    verified_id : int = Depends(security_service.get_current_user)):
+    """Nodes within k links of node_id with their distance, closest first"""
+    nodes = await graph_service.k_hop(user_id=verified_id, node_id=node_id, k=k, direction=direction)
+    return {"node_id": node_id, "k": k, "nodes": nodes}
+
+@router.get("/path")
+async def graph_path(source : str, target : str, direction : Direction = "both",
+                    max_depth : Optional[int] = Query(None, ge=1),
+                    verified_id : int = Depends(security_service.get_current_user)):
+    """Shortest chain of links from source to target, path is null when they are not connected"""
+    path = await graph_service.shortest_path(user_id=verified_id, source=source, target=target,
+                                             direction=direction, max_depth=max_depth)
+    return {"path": path, "length": len(path) - 1 if path else None}
+
+@router.post("/layout")
+async def graph_layout(pinned : list[str] = Body([], embed=True), iterations : int = Body(50, ge=1, le=500),
+                      incremental : bool = Body(True), persist : bool = Body(True),
+                      verified_id : int = Depends(security_service.get_current_user)):
+    """Lays out the user's graph server-side and saves the positions, pinned nodes keep theirs"""
+    return await graph_service.layout(user_id=verified_id, pinned=pinned, iterations=iterations,
+                                      incremental=incremental, persist=persist)
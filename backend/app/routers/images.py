@@ -1,19 +1,36 @@
-from fastapi import APIRouter, Depends, HTTPException
-from typing import Annotated, Any
+from fastapi import APIRouter, Body, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from typing import Annotated, Any, Literal, Optional
 from pydantic import BaseModel
 from services.image_services import image_service
+from services.derivatives import ImageSize
+from services.similarity import similarity_service
+from services.offload import image_pool
 from services.security import security_service
+from services.http_client import outbound_http
 from models.image import ImagePublic, ImageFilename
+from contextlib import AsyncExitStack
 import httpx
 import base64
+import hashlib
 import logging
+import mimetypes
+import uuid
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/images", tags=["Images"])
 
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+IMAGE_TOO_LARGE = "Image is too large (max 10MB)"
+FETCH_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+
 class ImageUrlRequest(BaseModel):
     url: str
+    mode: Literal["base64", "raw", "store"] = "base64"
+    # Name in the bucket for mode "store", generated when empty. Bytes the user already has keep the
+    # existing image's name, the response's file_name is the one to use
+    file_name: Optional[str] = None
 
 def _filename_to_payload(file_name: str, verified_id: int) -> ImageFilename:
     return ImageFilename(user_id=verified_id, file_name=file_name)
@@ -23,7 +40,7 @@ async def get_upload_url(file_name: str,
                         verified_id: int = Depends(security_service.get_current_user)):
     """Returns signed url for temporary access to the storage bucket."""
     payload = _filename_to_payload(file_name=file_name, verified_id=verified_id)
-    signed_url = image_service.get_upload_url(payload)
+    signed_url = await image_pool.run(image_service.get_upload_url, payload)
     return signed_url
 
 @router.post("/confirm_upload")
@@ -31,23 +48,51 @@ async def confirm_upload(file_name : str,
                         verified_id : int = Depends(security_service.get_current_user)):
     """Method when needs to be called if image uploaded to the url"""
     payload = _filename_to_payload(file_name=file_name, verified_id=verified_id)
-    db_response = image_service.confirm_uploaded(payload)
+    db_response = await image_pool.run(image_service.confirm_uploaded, payload)
     return db_response
 
+@router.get("/find_by_hash")
+async def find_by_hash(sha256 : str,
+                        verified_id : int = Depends(security_service.get_current_user)):
+    """Looks up the user's image with this SHA-256 (hex) so a client can skip uploading a duplicate"""
+    if len(sha256) != 64 or any(c not in "0123456789abcdefABCDEF" for c in sha256):
+        raise HTTPException(status_code=400, detail="sha256 must be 64 hex characters")
+    image_row = await image_pool.run(image_service.find_by_hash, verified_id, sha256)
+    return {"found": image_row is not None, "image": image_row}
+
+@router.get("/similar")
+async def similar_images(file_name : str, radius : Optional[int] = None, limit : int = 50,
+                        verified_id : int = Depends(security_service.get_current_user)):
+    """Near-duplicates of an image (same photo resized, recompressed or lightly edited), closest first.
+    radius is how many of the 64 hash bits may differ"""
+    response = await image_pool.run(similarity_service.similar, verified_id, file_name, radius,
+                                    max(1, min(limit, 200)))
+    return response
+
 @router.post("/get_url_by_name")
-async def get_url_by_name(file_name : str, 
+async def get_url_by_name(file_name : str, size : Optional[ImageSize] = None,
                         verified_id : int = Depends(security_service.get_current_user)):
-    """Gets signed url from the storage for the file name"""
+    """Gets signed url from the storage for the file name, size=thumb|small|medium for a resized copy"""
     payload = _filename_to_payload(file_name=file_name, verified_id=verified_id)
-    response = image_service.get_signed_url(payload=payload)
+    response = await image_service.get_signed_url_async(payload=payload, size=size)
+    return response
+
+@router.post("/get_urls_by_names")
+async def get_urls_by_names(file_names : list[str] = Body(..., embed=True), size : Optional[ImageSize] = Body(None),
+                        verified_id : int = Depends(security_service.get_current_user)):
+    """Gets signed urls for many file names at once, as a map of file_name -> url (null if it failed)"""
+    response = await image_pool.run(image_service.get_signed_urls, user_id=verified_id, file_names=file_names,
+                                    size=size)
     return response
 
 @router.delete("/delete_image_file")
-async def delete_image(file_name : str, 
+async def delete_image(file_name : str, node_id : Optional[str] = None,
                         verified_id : int = Depends(security_service.get_current_user)):
-    """Deletes file from the storage and database according to filename"""
+    """Deletes file from the storage and database according to filename.
+
+    Answers 409 while nodes other than node_id still use the image (uploads are deduplicated)."""
     payload = _filename_to_payload(file_name=file_name, verified_id=verified_id)
-    response = image_service.delete_image(payload=payload)
+    response = await image_pool.run(image_service.delete_image, payload=payload, node_id=node_id)
     return response
 
 @router.post("/get_image_info")
@@ -55,17 +100,76 @@ async def get_image_info(file_name : str,
                         verified_id : int = Depends(security_service.get_current_user)):
     """Gets image info of user_id, image_id, file_path, created_at"""
     payload = _filename_to_payload(file_name=file_name, verified_id=verified_id)
-    image_public = image_service.get_image_info(payload=payload).model_dump()
+    image_public = (await image_pool.run(image_service.get_image_info, payload=payload)).model_dump()
     return image_public
 
+async def _open_image_stream(client: httpx.AsyncClient, url: str) -> httpx.Response:
+    """Sends the GET in streaming mode and rejects non-images or oversized bodies before reading them."""
+    response = await client.send(
+        client.build_request("GET", url, headers={'User-Agent': FETCH_USER_AGENT}),
+        stream=True,
+    )
+    try:
+        if response.status_code != 200:
+            logger.error(f"Failed to fetch image: HTTP {response.status_code}")
+            raise HTTPException(
+                status_code=400,
+                detail=f"Could not fetch image: HTTP {response.status_code}"
+            )
+
+        # Check content type
+        content_type = response.headers.get('content-type', '')
+        if not content_type.startswith('image/'):
+            logger.error(f"Invalid content type: {content_type}")
+            raise HTTPException(
+                status_code=400,
+                detail=f"URL does not point to an image (content-type: {content_type})"
+            )
+
+        # Reject early when the server announces a body over the limit
+        content_length = response.headers.get('content-length')
+        if content_length and content_length.isdigit() and int(content_length) > MAX_IMAGE_BYTES:
+            raise HTTPException(status_code=400, detail=IMAGE_TOO_LARGE)
+    except BaseException:
+        await response.aclose()
+        raise
+    return response
+
+async def _iter_capped(response: httpx.Response):
+    """Yields body chunks and stops the download as soon as it passes MAX_IMAGE_BYTES."""
+    received = 0
+    async for chunk in response.aiter_bytes():
+        received += len(chunk)
+        if received > MAX_IMAGE_BYTES:
+            raise HTTPException(status_code=400, detail=IMAGE_TOO_LARGE)
+        yield chunk
+
+async def _stream_and_close(response: httpx.Response, cleanup: AsyncExitStack):
+    try:
+        async for chunk in _iter_capped(response):
+            yield chunk
+    finally:
+        await cleanup.aclose()
+
+async def _read_capped(response: httpx.Response, digest: Optional[Any] = None) -> bytes:
+    """Reads the whole capped body, feeding each chunk to digest (a hashlib object) on the way."""
+    body = bytearray()
+    async for chunk in _iter_capped(response):
+        body.extend(chunk)
+        if digest is not None:
+            digest.update(chunk)
+    return bytes(body)
+
 @router.post("/fetch_from_url")
 async def fetch_image_from_url(
     request: ImageUrlRequest,
     verified_id: int = Depends(security_service.get_current_user)
 ):
     """
-    Fetches an image from a URL and returns it as base64.
-    This bypasses CORS issues by fetching the image server-side.
+    Fetches an image from a URL, bypassing CORS issues by fetching it server-side.
+    mode "base64" returns it as a data url, "raw" streams the bytes back and
+    "store" saves it straight into the user's storage bucket. When the user already has the same
+    bytes, "store" answers deduplicated: true with that image's file_name instead of request.file_name.
     """
     try:
         logger.info(f"Fetching image from URL: {request.url}")
@@ -74,56 +178,60 @@ async def fetch_image_from_url(
         if not request.url.startswith(('http://', 'https://')):
             raise HTTPException(status_code=400, detail="Invalid URL format")
         
-        # Fetch the image with timeout and size limit
-        async with httpx.AsyncClient(timeout=10.0, follow_redirects=True) as client:
-            response = await client.get(
-                request.url,
-                headers={
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                }
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"Failed to fetch image: HTTP {response.status_code}")
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Could not fetch image: HTTP {response.status_code}"
-                )
-            
-            # Check content type
-            content_type = response.headers.get('content-type', '')
-            if not content_type.startswith('image/'):
-                logger.error(f"Invalid content type: {content_type}")
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"URL does not point to an image (content-type: {content_type})"
-                )
-            
-            # Check file size (max 10MB)
-            content_length = len(response.content)
-            if content_length > 10 * 1024 * 1024:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Image is too large (max 10MB)"
-                )
-            
-            # Convert to base64
-            image_data = response.content
-            base64_image = base64.b64encode(image_data).decode('utf-8')
-            
-            # Determine MIME type for data URL
-            mime_type = content_type.split(';')[0]
-            data_url = f"data:{mime_type};base64,{base64_image}"
-            
-            logger.info(f"Successfully fetched image ({content_length} bytes)")
-            
+        # Fetch over the shared client, the body is read in chunks up to MAX_IMAGE_BYTES
+        async with AsyncExitStack() as stack:
+            await stack.enter_async_context(outbound_http.host_slot(request.url))
+            client = await outbound_http.get_client()
+            response = await _open_image_stream(client, request.url)
+            stack.push_async_callback(response.aclose)
+            mime_type = response.headers.get('content-type', '').split(';')[0]
+
+            if request.mode == "raw":
+                headers = {}
+                # aiter_bytes yields the decoded body, the upstream length only holds for identity encoding
+                encoding = response.headers.get('content-encoding', 'identity').strip().lower()
+                if response.headers.get('content-length') and encoding == 'identity':
+                    headers['Content-Length'] = response.headers['content-length']
+                # The host slot and the upstream response stay open until streaming finishes
+                return StreamingResponse(_stream_and_close(response, stack.pop_all()),
+                                         media_type=mime_type, headers=headers)
+
+            digest = hashlib.sha256()
+            image_data = await _read_capped(response, digest)
+        content_length = len(image_data)
+
+        if request.mode == "store":
+            file_name = request.file_name or f"{uuid.uuid4().hex}{mimetypes.guess_extension(mime_type) or ''}"
+            payload = _filename_to_payload(file_name=file_name, verified_id=verified_id)
+            image_row = await image_pool.run(image_service.upload_image_bytes, payload, image_data, mime_type,
+                                             digest.hexdigest())
+            # Same bytes as an image the user already has: that one is reused under its own name
+            file_name = image_row.get("file_name", file_name)
+            logger.info(f"Stored image from URL as {file_name} ({content_length} bytes)")
             return {
                 "success": True,
-                "image": data_url,
+                "file_name": file_name,
+                "deduplicated": image_row.get("deduplicated", False),
+                "image": image_row,
                 "size": content_length,
                 "mime_type": mime_type
             }
+
+        # Convert to base64
+        base64_image = base64.b64encode(image_data).decode('utf-8')
+        data_url = f"data:{mime_type};base64,{base64_image}"
+        
+        logger.info(f"Successfully fetched image ({content_length} bytes)")
+        
+        return {
+            "success": True,
+            "image": data_url,
+            "size": content_length,
+            "mime_type": mime_type
+        }
             
+    except HTTPException:
+        raise
     except httpx.TimeoutException:
         logger.error("Request timeout")
         raise HTTPException(status_code=408, detail="Request timeout - image took too long to download")
@@ -1,6 +1,7 @@
-from fastapi import APIRouter, Depends
-from typing import Annotated, Any
+from fastapi import APIRouter, Body, Depends, Header, Response
+from typing import Annotated, Any, Optional
 from services.link_services import link_service
+from services.offload import link_pool
 from services.security import security_service
 from models.link import LinkDataFields, NodeLinkCreate, NodeLinkDelete
 
@@ -12,20 +13,37 @@ async def create_link(source_node_id : str, target_node_id : str,
     """Creates link between described source and target nodes, for verified user_id"""
     payload = NodeLinkCreate(user_id=verified_id, source_node_id=source_node_id,
                             target_node_id=target_node_id)
-    response = link_service.create_link(payload=payload)
+    response = await link_pool.run(link_service.create_link, payload=payload)
     return response
 
+@router.post("/bulk_create")
+async def bulk_create(links : list[dict[str, Any]] = Body(..., embed=True), undirected : bool = Body(True),
+                    verified_id : int = Depends(security_service.get_current_user)):
+    """Creates many links (source_node_id, target_node_id) at once, existing and repeated pairs are not duplicated."""
+    results = await link_pool.run(link_service.bulk_create_links, user_id=verified_id, items=links,
+                                  undirected=undirected)
+    return {"results": results}
+
 @router.get("/list_links")
-async def list_links(verified_id: int = Depends(security_service.get_current_user)):
-    """Lists all links for the authenticated user"""
-    response = link_service.list_links(user_id=verified_id)
-    return response
+async def list_links(response : Response, since_version : Optional[str] = None,
+                     if_none_match : Optional[str] = Header(default=None),
+                     verified_id: int = Depends(security_service.get_current_user)):
+    """Lists all links for the authenticated user, or only the changes since a returned version"""
+    etag, body = await link_service.list_links_since(verified_id, if_none_match=if_none_match,
+                                                     since_version=since_version)
+    if body is None:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    response.headers["X-Links-Version"] = body["version"]
+    if since_version is None:
+        return body["links"]
+    return body
 
 @router.delete("/delete_link")
 async def delete_link(link_id : int,
                     verified_id : int = Depends(security_service.get_current_user)):
     """Deletes link for given link_id, it is necessary to call this function for cleaner database"""
     payload = NodeLinkDelete(user_id=verified_id, link_id=link_id)
-    response = link_service.delete_link(payload=payload)
+    response = await link_pool.run(link_service.delete_link, payload=payload)
 
     return response
\ No newline at end of file
@@ -1,8 +1,14 @@
-from fastapi import APIRouter, Depends
-from typing import Annotated, Any, Optional
-from services.node_services import node_service
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
+from typing import Annotated, Any, Literal, Optional
+from services.node_services import node_service, TimelineBucket
+from services.search_services import search_service
+from services.offload import node_pool
 from services.security import security_service
-from models.node import NodeUpdate, NodeInfoDelete, NodeCreate, NodeDataFields
+from services.position_services import PositionCoalescer
+from models.node import NodeUpdate, NodeInfoDelete, NodeCreate, NodeDataFields, NodePosition, NodePatch
+import asyncio
+import datetime
 
 router = APIRouter(prefix="/nodes", tags=["Nodes"])
 
@@ -11,29 +17,122 @@ async def create_node(description : str, image_id : Optional[str] = None,
                     verified_id : int = Depends(security_service.get_current_user)):
     """Creates node given user_id, node_id and description"""
     payload = NodeCreate(user_id=verified_id, image_id=image_id, description=description)
-    response = node_service.create_node(payload=payload)
+    response = await node_pool.run(node_service.create_node, payload=payload)
     return response
 
 @router.put("/update_node")
-async def update_node(image_id : str, description : str, node_id : str,
+@router.patch("/update_node")
+async def update_node(patch : NodePatch, return_node : bool = False,
                     verified_id : int = Depends(security_service.get_current_user)):
-    """Updates image_id and description (both) for node given user_id, node_id."""
-    payload = NodeUpdate(user_id=verified_id, image_id=image_id, description=description, node_id=node_id)
-    response = node_service.update_node(payload=payload)
+    """Updates only the fields sent in the body for node_id, returns the updated row if return_node."""
+    payload = NodeUpdate(user_id=verified_id, **patch.model_dump(exclude_unset=True))
+    response = await node_pool.run(node_service.update_node, payload=payload,
+                                   return_representation=return_node)
     return response
 
 @router.delete("/delete_node")
 async def delete_node(node_id : str, description : str,
                     verified_id : int = Depends(security_service.get_current_user)):
-    """Deletes the node for given user_id and node_id"""
+    """Deletes the node for given user_id and node_id, along with its links"""
     payload = NodeInfoDelete(user_id=verified_id, node_id=node_id)
-    response = node_service.delete_node(payload=payload)
+    response = await node_pool.run(node_service.delete_node, payload=payload)
     return response
 
+@router.post("/bulk_create")
+async def bulk_create(nodes : list[dict[str, Any]] = Body(..., embed=True),
+                    verified_id : int = Depends(security_service.get_current_user)):
+    """Creates many nodes (NodeCreate fields) at once, returns {index, ok, node | error} per item."""
+    results = await node_pool.run(node_service.bulk_create_nodes, user_id=verified_id, items=nodes)
+    return {"results": results}
+
+@router.post("/bulk_update")
+async def bulk_update(nodes : list[dict[str, Any]] = Body(..., embed=True),
+                    verified_id : int = Depends(security_service.get_current_user)):
+    """Updates many nodes (NodeUpdate fields, node_id required) at once, returns a result per item."""
+    results = await node_pool.run(node_service.bulk_update_nodes, user_id=verified_id, items=nodes)
+    return {"results": results}
+
+@router.post("/bulk_delete")
+async def bulk_delete(node_ids : list[str] = Body(..., embed=True),
+                    verified_id : int = Depends(security_service.get_current_user)):
+    """Deletes many nodes and every link touching them, returns the deleted node and link ids."""
+    return await node_pool.run(node_service.delete_nodes, user_id=verified_id, node_ids=node_ids)
+
+@router.patch("/positions")
+async def update_positions(positions : list[NodePosition] = Body(..., embed=True),
+                        verified_id : int = Depends(security_service.get_current_user)):
+    """Saves position_x/position_y of many nodes in one batched write."""
+    results = await node_pool.run(node_service.update_positions, verified_id, positions)
+    return {"results": results}
+
+@router.websocket("/positions/ws")
+async def positions_socket(websocket : WebSocket, token : str = Query(...)):
+    """Drag channel: send {node_id, position_x, position_y} (or a list of them) per move.
+    Moves are coalesced per node and saved in batches, results are sent back after each batch."""
+    try:
+        verified_id = security_service.get_current_user(token)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+
+    async def send_results(results):
+        await websocket.send_json({"saved": results})
+
+    coalescer = PositionCoalescer(user_id=verified_id, on_flush=send_results)
+    flusher = asyncio.create_task(coalescer.run())
+    try:
+        while True:
+            try:
+                message = await websocket.receive_json()
+            except (ValueError, KeyError):  # not JSON, or a binary frame
+                await websocket.send_json({"error": "Messages must be JSON text"})
+                continue
+            moves = message if isinstance(message, list) else [message]
+            try:
+                for move in moves:
+                    coalescer.add(NodePosition.model_validate(move))
+            except ValidationError as e:
+                await websocket.send_json({"error": e.errors(include_url=False)})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        flusher.cancel()
+        coalescer.on_flush = None  # the socket is gone, just write what is left
+        await asyncio.shield(coalescer.flush())
+
+@router.get("/list_nodes")
+async def list_nodes(limit : int = Query(40, ge=1), cursor : Optional[str] = None,
+                    fields : Optional[list[NodeDataFields]] = Query(None),
+                    verified_id : int = Depends(security_service.get_current_user)):
+    """Lists a page of the user's nodes, pass next_cursor back as cursor for the following page."""
+    response = await node_service.list_nodes_async(user_id=verified_id, limit=limit, cursor=cursor, fields=fields)
+    return response
+
+@router.get("/timeline")
+async def timeline(start : Optional[datetime.datetime] = None, end : Optional[datetime.datetime] = None,
+                   limit : int = Query(40, ge=1), cursor : Optional[str] = None,
+                   order : Literal["asc", "desc"] = "asc", fields : Optional[list[NodeDataFields]] = Query(None),
+                   bucket : Optional[TimelineBucket] = None,
+                   verified_id : int = Depends(security_service.get_current_user)):
+    """Nodes dated in [start, end) by custom_date (else created_at), or only their counts per bucket."""
+    if bucket is not None:
+        buckets = await node_pool.run(node_service.timeline_buckets, verified_id, bucket, start, end)
+        return {"bucket": bucket, "buckets": buckets}
+    return await node_pool.run(node_service.timeline, verified_id, start, end, limit, cursor,
+                               order == "desc", fields)
+
+@router.get("/search")
+async def search_nodes(q : Optional[str] = None, tag : Optional[str] = None, limit : int = Query(20, ge=1),
+                    verified_id : int = Depends(security_service.get_current_user)):
+    """Ranked search over titles, descriptions and tags; q matches words, tag matches the start of a tag."""
+    results = await node_pool.run(search_service.search, verified_id, q, tag, limit)
+    return {"results": results}
+
 @router.post("/get_node_info")
 async def get_node_info(node_id : str, 
                         verified_id : int = Depends(security_service.get_current_user)):
     """Gets info of the asked node."""
     payload = NodeInfoDelete(user_id=verified_id, node_id=node_id)
-    response = node_service.get_node_info(payload=payload)
+    response = await node_service.get_node_info_async(payload=payload)
     return response
\ No newline at end of file
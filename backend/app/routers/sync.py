@@ -0,0 +1,12 @@
+from fastapi import APIRouter, Depends
+from typing import Optional
+from services.sync_services import sync_service
+from services.security import security_service
+
+router = APIRouter(prefix="/sync", tags=["Sync"])
+
+@router.get("/changes")
+async def sync_changes(since : Optional[str] = None,
+                       verified_id : int = Depends(security_service.get_current_user)):
+    """Nodes, links and images changed or deleted since the watermark (ISO timestamp or version) of the last sync"""
+    return await sync_service.changes(user_id=verified_id, since=since)
@@ -0,0 +1,9 @@
+from typing import Iterator, Sequence, TypeVar
+
+T = TypeVar("T")
+
+
+def chunks(items : Sequence[T], size : int) -> Iterator[Sequence[T]]:
+    """Consecutive slices of at most size items, for multi-row writes and id filters."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
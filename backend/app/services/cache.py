@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from typing import Any, Hashable
+import threading
+import time
+
+
+class TTLCache:
+    """Thread safe LRU cache whose entries also expire at an absolute wall clock time."""
+
+    def __init__(self, maxsize : int, default_ttl : float | None = None):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self._entries : OrderedDict[Hashable, tuple[Any, float | None]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key : Hashable, default : Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key : Hashable, value : Any, ttl : float | None = None,
+            expires_at : float | None = None) -> None:
+        """Stores value until expires_at (epoch seconds), or for ttl / default_ttl seconds."""
+        if expires_at is None:
+            ttl = self.default_ttl if ttl is None else ttl
+            expires_at = time.time() + ttl if ttl is not None else None
+        if self.maxsize <= 0 or (expires_at is not None and expires_at <= time.time()):
+            return
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key : Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
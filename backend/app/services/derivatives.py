@@ -0,0 +1,111 @@
+from db.db import supabase
+from services.media_pipeline import media_pipeline
+from services.cache import TTLCache
+from typing import Literal
+import io
+import os
+
+try:
+    from PIL import Image, ImageOps, features
+    PIL_AVAILABLE = True
+except ImportError:  # derivatives are skipped and the size= endpoints hand out originals
+    PIL_AVAILABLE = False
+
+ImageSize = Literal["thumb", "small", "medium"]
+# Longest edge in pixels of each derivative, images are never upscaled
+DERIVATIVE_SIZES : dict[str, int] = {"thumb": 200, "small": 480, "medium": 1080}
+DERIVATIVE_PREFIX = os.environ.get("DERIVATIVE_PREFIX", "derivatives")
+DERIVATIVE_FORMAT = os.environ.get("DERIVATIVE_FORMAT", "webp").lower()
+DERIVATIVE_QUALITY = int(os.environ.get("DERIVATIVE_QUALITY", 80))
+DERIVATIVE_RETRY_AFTER = 600  # seconds before a missing derivative is looked up and scheduled again
+
+_CONTENT_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg"}
+
+
+def _output_format() -> str:
+    if DERIVATIVE_FORMAT == "webp" and PIL_AVAILABLE and features.check("webp"):
+        return "webp"
+    return "jpeg"
+
+def render_derivatives(data : bytes, sizes : dict[str, int], fmt : str, quality : int) -> dict[str, bytes]:
+    """Encodes one resized copy per size, largest first so each step shrinks the previous result.
+
+    Module level so that it can run in a worker process."""
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG can decode straight at a fraction of the resolution, much cheaper than a full decode
+        image.draft("RGB", (max(sizes.values()),) * 2)
+        current = ImageOps.exif_transpose(image)
+        keep_alpha = fmt == "webp" and current.mode in ("RGBA", "LA", "P")
+        current = current.convert("RGBA" if keep_alpha else "RGB")
+        rendered = {}
+        for name, edge in sorted(sizes.items(), key=lambda item: -item[1]):
+            current.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            if fmt == "webp":
+                current.save(buffer, format="WEBP", quality=quality, method=4)
+            else:
+                current.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+            rendered[name] = buffer.getvalue()
+        return rendered
+
+
+def _key(user_id, file_name : str) -> tuple[str, str]:
+    # Routes pass the token's sub (a string), upload hooks the int from ImageFilename
+    return (str(user_id), file_name)
+
+
+class DerivativeService:
+    def __init__(self):
+        self.enabled = PIL_AVAILABLE
+        self.format = _output_format()
+        self._scheduled = TTLCache(maxsize=10000, default_ttl=DERIVATIVE_RETRY_AFTER)
+        # Images found without derivatives, their originals are handed out without asking storage again
+        self._missing = TTLCache(maxsize=10000, default_ttl=DERIVATIVE_RETRY_AFTER)
+
+    def path(self, user_id : int, file_name : str, size : ImageSize) -> str:
+        """Storage path of a derivative, kept under the user's folder like the original."""
+        extension = "jpg" if self.format == "jpeg" else self.format
+        return f"{user_id}/{DERIVATIVE_PREFIX}/{size}/{file_name}.{extension}"
+
+    def build(self, user_id : int, file_name : str, data : bytes) -> list[str]:
+        """Renders every size in a worker process and uploads them, returns the stored paths."""
+        if not self.enabled:
+            return []
+        rendered = media_pipeline.cpu(render_derivatives, data, DERIVATIVE_SIZES,
+                                      self.format, DERIVATIVE_QUALITY)
+        bucket = supabase.storage.from_("images_0")
+        paths = []
+        for size, body in rendered.items():
+            path = self.path(user_id, file_name, size)
+            bucket.upload(path=path, file=body,
+                          file_options={"content-type": _CONTENT_TYPES[self.format], "upsert": "true"})
+            paths.append(path)
+        self._missing.delete(_key(user_id, file_name))
+        return paths
+
+    def is_missing(self, user_id : int, file_name : str) -> bool:
+        """Whether the image was found without derivatives in the last DERIVATIVE_RETRY_AFTER seconds."""
+        return self._missing.get(_key(user_id, file_name)) is not None
+
+    def ensure(self, user_id : int, file_name : str) -> None:
+        """Remembers that an image has no derivatives yet (e.g. older uploads) and schedules a build."""
+        key = _key(user_id, file_name)
+        self._missing.set(key, True)
+        # Also covers builds that failed (not an image) or are still running
+        if not self.enabled or self._scheduled.get(key) is not None:
+            return
+        self._scheduled.set(key, True)
+        if media_pipeline.background(self._build_missing, user_id, file_name) is None:
+            self._scheduled.delete(key)
+
+    def _build_missing(self, user_id : int, file_name : str) -> list[str]:
+        data = supabase.storage.from_("images_0").download(f"{user_id}/{file_name}")
+        return self.build(user_id, file_name, data)
+
+    def paths(self, user_id : int, file_name : str) -> list[str]:
+        return [self.path(user_id, file_name, size) for size in DERIVATIVE_SIZES]
+
+
+derivative_service = DerivativeService()
+if derivative_service.enabled:
+    media_pipeline.add_upload_hook(derivative_service.build)
@@ -0,0 +1,124 @@
+from typing import Any
+import datetime
+import struct
+
+# Tags read from the TIFF structure inside EXIF, everything else is skipped without decoding
+_IFD0_TAGS = {0x010F: "make", 0x0110: "model", 0x0112: "orientation", 0x0132: "modified_at", 0x8769: "exif_ifd"}
+_EXIF_TAGS = {0x9003: "original_at", 0x9004: "digitized_at", 0x9011: "offset_original",
+              0xA002: "exif_width", 0xA003: "exif_height"}
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+# Start-of-frame markers carry the pixel size (C4, C8 and CC are other segments in that range)
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _read_ifd(tiff : bytes, offset : int, order : str, tags : dict[int, str]) -> dict[str, Any]:
+    values : dict[str, Any] = {}
+    if offset + 2 > len(tiff):
+        return values
+    count = struct.unpack_from(order + "H", tiff, offset)[0]
+    for index in range(count):
+        entry = offset + 2 + index * 12
+        if entry + 12 > len(tiff):  # cut off by the ranged read, keep what was parsed
+            break
+        tag, kind, length = struct.unpack_from(order + "HHI", tiff, entry)
+        if tag not in tags:
+            continue
+        size = _TYPE_SIZES.get(kind, 0) * length
+        # Values of up to 4 bytes sit in the entry itself, longer ones at an offset
+        start = entry + 8 if size <= 4 else struct.unpack_from(order + "I", tiff, entry + 8)[0]
+        raw = tiff[start:start + size]
+        if not size or len(raw) < size:
+            continue
+        if kind == 2:
+            values[tags[tag]] = raw.split(b"\0", 1)[0].decode("ascii", "replace").strip()
+        elif kind == 3:
+            values[tags[tag]] = struct.unpack_from(order + "H", raw)[0]
+        elif kind == 4:
+            values[tags[tag]] = struct.unpack_from(order + "I", raw)[0]
+    return values
+
+def _parse_tiff(tiff : bytes) -> dict[str, Any]:
+    """Tag values of IFD0 and the EXIF sub-IFD, as far as they fit in the bytes read."""
+    order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if order is None or len(tiff) < 8:
+        return {}
+    values = _read_ifd(tiff, struct.unpack_from(order + "I", tiff, 4)[0], order, _IFD0_TAGS)
+    if "exif_ifd" in values:
+        values.update(_read_ifd(tiff, values["exif_ifd"], order, _EXIF_TAGS))
+    return values
+
+def _exif_datetime(value : str | None, offset : str | None) -> str | None:
+    """EXIF "YYYY:MM:DD HH:MM:SS" (local camera time) as ISO 8601, with its UTC offset when recorded."""
+    if not value:
+        return None
+    try:
+        parsed = datetime.datetime.strptime(value[:19], "%Y:%m:%d %H:%M:%S")
+        if offset:
+            parsed = parsed.replace(tzinfo=datetime.datetime.strptime(offset, "%z").tzinfo)
+    except ValueError:  # blank "0000:00:00 00:00:00" stamps and odd offsets
+        return None
+    return parsed.isoformat()
+
+def _summarize(tags : dict[str, Any], width : int | None, height : int | None) -> dict[str, Any]:
+    metadata : dict[str, Any] = {}
+    width = width or tags.get("exif_width")
+    height = height or tags.get("exif_height")
+    if width and height:
+        metadata["width"], metadata["height"] = width, height
+    if tags.get("orientation") in range(1, 9):
+        metadata["orientation"] = tags["orientation"]
+    taken_at = _exif_datetime(tags.get("original_at") or tags.get("digitized_at") or tags.get("modified_at"),
+                              tags.get("offset_original"))
+    if taken_at:
+        metadata["taken_at"] = taken_at
+    camera = " ".join(part for part in (tags.get("make"), tags.get("model")) if part)
+    if camera:
+        metadata["camera"] = camera
+    return metadata
+
+def _parse_jpeg(data : bytes) -> dict[str, Any]:
+    tags : dict[str, Any] = {}
+    width = height = None
+    position = 2
+    while position + 4 <= len(data) and data[position] == 0xFF:
+        marker = data[position + 1]
+        if marker == 0xFF:  # fill byte
+            position += 1
+            continue
+        if marker in (0xD9, 0xDA):  # end of image / start of scan, only pixel data follows
+            break
+        length = int.from_bytes(data[position + 2:position + 4], "big")
+        segment = data[position + 4:position + 2 + length]
+        if marker == 0xE1 and segment.startswith(b"Exif\0\0") and not tags:
+            tags = _parse_tiff(segment[6:])
+        elif marker in _SOF_MARKERS and len(segment) >= 5:
+            height = int.from_bytes(segment[1:3], "big")
+            width = int.from_bytes(segment[3:5], "big")
+            break
+        position += 2 + length
+    return _summarize(tags, width, height)
+
+def _parse_png(data : bytes) -> dict[str, Any]:
+    tags : dict[str, Any] = {}
+    width, height = struct.unpack_from(">II", data, 16) if len(data) >= 24 else (None, None)
+    position = 8
+    while position + 8 <= len(data):
+        length, kind = struct.unpack_from(">I4s", data, position)
+        if kind in (b"IDAT", b"IEND"):
+            break
+        if kind == b"eXIf":
+            tags = _parse_tiff(data[position + 8:position + 8 + length])
+        position += 12 + length
+    return _summarize(tags, width, height)
+
+def parse_header(data : bytes) -> dict[str, Any]:
+    """Capture time, pixel size, orientation and camera from the first bytes of a JPEG or PNG.
+
+    Only markers and tags are walked, no pixels are decoded, so a ranged read of the file's start
+    is enough. Unknown formats give {}. Module level so that it can run in a worker process."""
+    if data[:2] == b"\xff\xd8":
+        return _parse_jpeg(data)
+    if data[:8] == _PNG_SIGNATURE:
+        return _parse_png(data)
+    return {}
@@ -0,0 +1,76 @@
+from collections import deque
+from typing import Iterable, Literal
+
+Direction = Literal["both", "out", "in"]
+
+
+class AdjacencyIndex:
+    """Dict-of-sets adjacency of one user's nodelinks, answers BFS style queries in memory."""
+
+    def __init__(self, links : Iterable[dict]):
+        self.outgoing : dict[str, set[str]] = {}
+        self.incoming : dict[str, set[str]] = {}
+        self.edge_count = 0
+        for link in links:
+            self.add_edge(str(link["source_node_id"]), str(link["target_node_id"]))
+
+    def add_edge(self, source : str, target : str) -> None:
+        self.outgoing.setdefault(source, set()).add(target)
+        self.incoming.setdefault(target, set()).add(source)
+        self.edge_count += 1
+
+    def _iter_neighbors(self, node_id : str, direction : Direction):
+        # No set union here, the BFS loops skip repeats through their visited maps
+        if direction != "in":
+            yield from self.outgoing.get(node_id, ())
+        if direction != "out":
+            yield from self.incoming.get(node_id, ())
+
+    def neighbors(self, node_id : str, direction : Direction = "both") -> set[str]:
+        found = set(self._iter_neighbors(node_id, direction))
+        found.discard(node_id)
+        return found
+
+    def k_hop(self, node_id : str, k : int, direction : Direction = "both",
+              limit : int | None = None) -> dict[str, int]:
+        """Nodes within k hops of node_id (excluding it) mapped to their hop distance."""
+        depths = {node_id : 0}
+        frontier = [node_id]
+        for depth in range(1, k + 1):
+            next_frontier = []
+            for current in frontier:
+                for neighbor in self._iter_neighbors(current, direction):
+                    if neighbor not in depths:
+                        depths[neighbor] = depth
+                        next_frontier.append(neighbor)
+                        if limit is not None and len(depths) > limit:
+                            del depths[node_id]
+                            return depths
+            if not next_frontier:
+                break
+            frontier = next_frontier
+        del depths[node_id]
+        return depths
+
+    def shortest_path(self, source : str, target : str, direction : Direction = "both",
+                      max_depth : int | None = None) -> list[str] | None:
+        """Fewest-hops path from source to target as a node list, None if there is none."""
+        if source == target:
+            return [source]
+        parents : dict[str, str | None] = {source : None}
+        queue = deque([(source, 0)])
+        while queue:
+            current, depth = queue.popleft()
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for neighbor in self._iter_neighbors(current, direction):
+                if neighbor in parents:
+                    continue
+                parents[neighbor] = current
+                if neighbor == target:
+                    path = [neighbor]
+                    while parents[path[-1]] is not None:
+                        path.append(parents[path[-1]])
+                    return path[::-1]
+                queue.append((neighbor, depth + 1))
+        return None
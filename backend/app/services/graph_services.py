@@ -0,0 +1,183 @@
+from models.node import NodeDataFields as df
+from models.node import NodePosition
+from services.node_services import node_service
+from services.link_services import link_service
+from services.image_services import image_service, SIGNED_URL_MIN_REMAINING
+from services.derivatives import ImageSize, derivative_service
+from services.offload import image_pool, node_pool, layout_pool
+from services.cache import TTLCache
+from services.graph_index import AdjacencyIndex, Direction
+from services.layout import NUMPY_AVAILABLE, force_layout, stored_position
+from fastapi import HTTPException
+from typing import Any
+import os
+import asyncio
+import hashlib
+import json
+import math
+import time
+
+# Only what the graph view draws; descriptions are fetched when a node is opened
+SNAPSHOT_NODE_FIELDS = [df.node_id, df.title, df.image_id, df.tags,
+                        df.position_x, df.position_y, df.custom_date]
+SNAPSHOT_LINK_FIELDS = ("link_id", "source_node_id", "target_node_id")
+
+# Adjacency indexes are kept for this many users, and rebuilt after the ttl as a safety net
+GRAPH_INDEX_CACHE_USERS = int(os.environ.get("GRAPH_INDEX_CACHE_USERS", 256))
+GRAPH_INDEX_TTL = float(os.environ.get("GRAPH_INDEX_TTL", 600))
+MAX_HOPS = 6
+MAX_KHOP_NODES = 5000
+LAYOUT_MAX_NODES = int(os.environ.get("LAYOUT_MAX_NODES", 5000))
+LAYOUT_SPACING = float(os.environ.get("LAYOUT_SPACING", 150))  # ideal link length in canvas units
+LAYOUT_MAX_ITERATIONS = 500
+# Node pairs times iterations one run may compute, larger graphs get fewer iterations (about 2s of work)
+LAYOUT_WORK_BUDGET = float(os.environ.get("LAYOUT_WORK_BUDGET", 2.5e8))
+LAYOUT_MIN_MOVE = 0.5  # nodes that moved less than this are not written back
+LAYOUT_NODE_FIELDS = [df.node_id, df.position_x, df.position_y]
+
+
+def _layout_seed(user_id) -> int:
+    """Stable integer seed per user, user_id arrives as the token's string sub."""
+    return int(hashlib.sha256(str(user_id).encode("utf-8")).hexdigest(), 16) % 2**32
+
+def _snapshot_etag(nodes : list[dict], links : list[dict], file_names : list[str],
+                   size : str | None = None, originals : list[str] = ()) -> str:
+    """Weak ETag over the graph contents, rolled over halfway through the signed url lifetime.
+
+    originals are the images served at full size for lack of derivatives, so the tag changes
+    once their derivatives are built."""
+    # Signed urls change on every call so they can't be hashed, the time window stands in for them.
+    # The url cache hands out urls with as little as SIGNED_URL_MIN_REMAINING seconds left, a window
+    # of half that keeps 304s from outliving the urls the client already holds
+    url_window = int(time.time() // max(SIGNED_URL_MIN_REMAINING // 2, 1))
+    body = json.dumps([nodes, links, file_names, url_window, size, list(originals)], sort_keys=True, default=str)
+    return 'W/"' + hashlib.sha256(body.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+class GraphService:
+    def __init__(self):
+        self._indexes = TTLCache(maxsize=GRAPH_INDEX_CACHE_USERS, default_ttl=GRAPH_INDEX_TTL)
+        self._versions : dict[Any, int] = {}
+        self._layouts_running : set[str] = set()
+        link_service.subscribe(self.invalidate)
+
+    def invalidate(self, user_id) -> None:
+        """Drops the user's adjacency index, called by LinkService whenever a link changes."""
+        key = str(user_id)
+        self._versions[key] = self._versions.get(key, 0) + 1
+        self._indexes.delete(key)
+
+    async def get_index(self, user_id) -> AdjacencyIndex:
+        key = str(user_id)
+        index = self._indexes.get(key)
+        if index is None:
+            version = self._versions.get(key, 0)
+            links = await link_service.list_links_async(user_id)
+            index = AdjacencyIndex(links)
+            # A link changed while we were loading, serve this index once but don't keep it
+            if self._versions.get(key, 0) == version:
+                self._indexes.set(key, index)
+        return index
+
+    async def neighbors(self, user_id, node_id : str, direction : Direction = "both") -> list[str]:
+        index = await self.get_index(user_id)
+        return sorted(index.neighbors(node_id, direction))
+
+    async def k_hop(self, user_id, node_id : str, k : int, direction : Direction = "both") -> list[dict[str, Any]]:
+        index = await self.get_index(user_id)
+        depths = index.k_hop(node_id, min(k, MAX_HOPS), direction, limit=MAX_KHOP_NODES)
+        return [{"node_id": node, "depth": depth}
+                for node, depth in sorted(depths.items(), key=lambda item: (item[1], item[0]))]
+
+    async def shortest_path(self, user_id, source : str, target : str,
+                            direction : Direction = "both", max_depth : int | None = None) -> list[str] | None:
+        index = await self.get_index(user_id)
+        return index.shortest_path(source, target, direction, max_depth)
+
+    async def snapshot(self, user_id : int, if_none_match : str | None = None,
+                       size : ImageSize | None = None) -> tuple[str, dict[str, Any] | None]:
+        """Returns (etag, payload) with nodes, links and image URLs for the user's graph.
+
+        payload is None when if_none_match already matches the current graph."""
+        nodes, links, file_names = await asyncio.gather(
+            node_service.list_all_nodes_async(user_id, SNAPSHOT_NODE_FIELDS),
+            link_service.list_links_async(user_id),
+            image_service.list_file_names_async(user_id),
+        )
+        links = [{key : link.get(key) for key in SNAPSHOT_LINK_FIELDS} for link in links]
+        file_names = sorted(set(file_names))
+
+        originals = [name for name in file_names if derivative_service.is_missing(user_id, name)] if size else []
+        etag = _snapshot_etag(nodes, links, file_names, size, originals)
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return etag, None
+
+        image_urls = await image_pool.run(image_service.get_signed_urls, user_id, file_names, size)
+        payload = {
+            "nodes": nodes,
+            "links": links,
+            "image_urls": image_urls,
+        }
+        return etag, payload
+
+    async def layout(self, user_id : int, pinned : list[str] | None = None, iterations : int = 50,
+                     incremental : bool = True, persist : bool = True) -> dict[str, Any]:
+        """Force-directed positions for all of the user's nodes, saved with batched updates.
+
+        Incremental runs refine the stored positions (nodes without one are placed next to their
+        neighbours), otherwise everything but the pinned nodes is laid out from scratch.
+        One layout runs per user at a time, nodes moved while it ran keep their new position."""
+        if not NUMPY_AVAILABLE:
+            raise HTTPException(status_code=503, detail="Server-side layout is not available (numpy missing)")
+        key = str(user_id)
+        if key in self._layouts_running:
+            raise HTTPException(status_code=409, detail="A layout is already running for this graph")
+        self._layouts_running.add(key)
+        try:
+            return await self._layout(user_id, pinned, iterations, incremental, persist)
+        finally:
+            self._layouts_running.discard(key)
+
+    async def _layout(self, user_id : int, pinned : list[str] | None, iterations : int,
+                      incremental : bool, persist : bool) -> dict[str, Any]:
+        nodes, links = await asyncio.gather(
+            node_service.list_all_nodes_async(user_id, LAYOUT_NODE_FIELDS),
+            link_service.list_links_async(user_id),
+        )
+        if len(nodes) > LAYOUT_MAX_NODES:
+            raise HTTPException(status_code=413, detail=f"At most {LAYOUT_MAX_NODES} nodes can be laid out")
+        node_ids = [str(node[df.node_id.value]) for node in nodes]
+        positions = {node_id : index for index, node_id in enumerate(node_ids)}
+        edges = [(positions[str(link["source_node_id"])], positions[str(link["target_node_id"])])
+                 for link in links
+                 if str(link["source_node_id"]) in positions and str(link["target_node_id"]) in positions]
+        stored = [stored_position(node) for node in nodes]
+        pinned_ids = set(pinned or ())
+        fixed = [node_id in pinned_ids and stored[index] is not None for index, node_id in enumerate(node_ids)]
+
+        # Each iteration compares every pair of nodes, the budget caps the whole run
+        iterations = max(1, min(iterations, LAYOUT_MAX_ITERATIONS, int(LAYOUT_WORK_BUDGET // max(len(nodes), 1) ** 2)))
+        # numpy releases the GIL for the heavy array work, a layout_pool thread is enough
+        placed = await layout_pool.run(force_layout, stored, edges, fixed, iterations, LAYOUT_SPACING,
+                                       incremental, _layout_seed(user_id))
+        result = [NodePosition(node_id=node_id, position_x=round(x, 2), position_y=round(y, 2))
+                  for node_id, (x, y) in zip(node_ids, placed)]
+        moved = [position for position, before in zip(result, stored)
+                 if before is None or math.dist(before, (position.position_x, position.position_y)) >= LAYOUT_MIN_MOVE]
+        skipped = 0
+        if persist and moved:
+            # Positions saved while the layout ran (a user dragging a node) win over the computed ones
+            current = {str(node[df.node_id.value]) : stored_position(node)
+                       for node in await node_service.list_all_nodes_async(user_id, LAYOUT_NODE_FIELDS)}
+            unchanged = [position for position in moved
+                         if position.node_id in current
+                         and current[position.node_id] == stored[positions[position.node_id]]]
+            skipped = len(moved) - len(unchanged)
+            moved = unchanged
+            if moved:
+                await node_pool.run(node_service.update_positions, user_id, moved)
+        return {"positions": [position.model_dump() for position in result], "iterations": iterations,
+                "moved": len(moved), "skipped": skipped, "saved": persist}
+
+
+graph_service = GraphService()
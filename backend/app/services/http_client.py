@@ -0,0 +1,154 @@
+from contextlib import asynccontextmanager
+from services.cache import TTLCache
+from typing import Any
+from urllib.parse import urlsplit
+import asyncio
+import ipaddress
+import os
+import socket
+import time
+import httpcore
+import httpx
+
+# Outbound connection pool used for fetching images from user supplied urls
+OUTBOUND_MAX_CONNECTIONS = int(os.environ.get("OUTBOUND_MAX_CONNECTIONS", 100))
+OUTBOUND_MAX_KEEPALIVE = int(os.environ.get("OUTBOUND_MAX_KEEPALIVE", 20))
+OUTBOUND_KEEPALIVE_EXPIRY = float(os.environ.get("OUTBOUND_KEEPALIVE_EXPIRY", 30))
+OUTBOUND_PER_HOST_LIMIT = int(os.environ.get("OUTBOUND_PER_HOST_LIMIT", 8))
+OUTBOUND_DNS_TTL = float(os.environ.get("OUTBOUND_DNS_TTL", 300))
+OUTBOUND_HTTP2 = os.environ.get("OUTBOUND_HTTP2", "true").lower() in ("1", "true", "yes")
+OUTBOUND_TIMEOUT = float(os.environ.get("OUTBOUND_TIMEOUT", 10))
+
+try:
+    import h2  # noqa: F401  (httpx needs it for http2=True)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class CachingDNSBackend(httpcore.AsyncNetworkBackend):
+    """Network backend that remembers resolved addresses for a while.
+
+    Only the TCP connect goes to the cached ip, TLS still verifies the original host name."""
+
+    def __init__(self, backend : httpcore.AsyncNetworkBackend, ttl : float, maxsize : int = 256):
+        self._backend = backend
+        self.cache = TTLCache(maxsize=maxsize, default_ttl=ttl)
+
+    async def _resolve(self, host : str, port : int) -> str:
+        try:
+            ipaddress.ip_address(host)
+            return host
+        except ValueError:
+            pass
+        address = self.cache.get((host, port))
+        if address is None:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            address = infos[0][4][0]
+            self.cache.set((host, port), address)
+        return address
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        address = await self._resolve(host, port)
+        return await self._backend.connect_tcp(address, port, timeout=timeout,
+                                               local_address=local_address, socket_options=socket_options)
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self._backend.connect_unix_socket(path, timeout=timeout, socket_options=socket_options)
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+
+class _HostSlot:
+    __slots__ = ("semaphore", "users")
+
+    def __init__(self, limit : int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.users = 0  # requests holding or waiting for the semaphore
+
+
+class OutboundHTTP:
+    """App scoped httpx client with per-host concurrency caps and latency stats.
+
+    A host's semaphore only exists while requests to it are in flight, so arbitrary user urls can't grow
+    the map. Latency stats are aggregated over all hosts, the hostnames users fetch from are never exposed."""
+
+    def __init__(self):
+        self.client : httpx.AsyncClient | None = None
+        self.dns_backend : CachingDNSBackend | None = None
+        self._host_slots : dict[str, _HostSlot] = {}
+        self._totals : dict[str, float] = {"requests": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+    async def start(self) -> httpx.AsyncClient:
+        if self.client is None or self.client.is_closed:
+            transport = httpx.AsyncHTTPTransport(
+                http2=OUTBOUND_HTTP2 and HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=OUTBOUND_MAX_CONNECTIONS,
+                                    max_keepalive_connections=OUTBOUND_MAX_KEEPALIVE,
+                                    keepalive_expiry=OUTBOUND_KEEPALIVE_EXPIRY),
+            )
+            # httpx has no public hook for the network backend, swap it on the underlying httpcore pool.
+            # Private attribute: httpcore is pinned in requirements.txt and a test checks it is still there
+            self.dns_backend = CachingDNSBackend(httpcore.AnyIOBackend(), ttl=OUTBOUND_DNS_TTL)
+            transport._pool._network_backend = self.dns_backend
+            self.client = httpx.AsyncClient(transport=transport, timeout=OUTBOUND_TIMEOUT,
+                                            follow_redirects=True)
+        return self.client
+
+    async def close(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+        self.client = None
+        self._host_slots.clear()
+
+    async def get_client(self) -> httpx.AsyncClient:
+        """The shared client, started on first use if the lifespan has not done it."""
+        return await self.start()
+
+    @asynccontextmanager
+    async def host_slot(self, url : str):
+        """Holds one of the host's concurrency slots and records how long the request took."""
+        host = urlsplit(url).hostname or ""
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = self._host_slots[host] = _HostSlot(OUTBOUND_PER_HOST_LIMIT)
+        slot.users += 1
+        try:
+            async with slot.semaphore:
+                started = time.perf_counter()
+                failed = False
+                try:
+                    yield
+                except BaseException:
+                    failed = True
+                    raise
+                finally:
+                    self._record(host, time.perf_counter() - started, failed)
+        finally:
+            slot.users -= 1
+            # Idle again, a later request to the host starts a fresh semaphore
+            if slot.users == 0 and self._host_slots.get(host) is slot:
+                del self._host_slots[host]
+
+    def _record(self, host : str, seconds : float, failed : bool) -> None:
+        elapsed_ms = seconds * 1000
+        self._totals["requests"] += 1
+        self._totals["errors"] += int(failed)
+        self._totals["total_ms"] += elapsed_ms
+        self._totals["max_ms"] = max(self._totals["max_ms"], elapsed_ms)
+
+    def stats(self) -> dict[str, Any]:
+        totals = dict(self._totals)
+        dns = self.dns_backend.cache.stats() if self.dns_backend else None
+        return {
+            "requests": int(totals["requests"]),
+            "errors": int(totals["errors"]),
+            "avg_ms": round(totals["total_ms"] / totals["requests"], 3) if totals["requests"] else 0.0,
+            "max_ms": round(totals["max_ms"], 3),
+            "hosts_in_flight": len(self._host_slots),
+            "dns_cache": dns,
+        }
+
+
+outbound_http = OutboundHTTP()
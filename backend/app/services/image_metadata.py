@@ -0,0 +1,100 @@
+from db.db import supabase
+from services.media_pipeline import media_pipeline
+from services.exif import parse_header
+from postgrest.exceptions import APIError
+from typing import Any
+import datetime
+import os
+import threading
+
+# Bytes handed to the parser from the start of each upload, EXIF lives in the first segments of a JPEG (max 64KB)
+EXIF_HEADER_BYTES = int(os.environ.get("EXIF_HEADER_BYTES", 128 * 1024))
+EXIF_BATCH_SIZE = int(os.environ.get("EXIF_BATCH_SIZE", 100))
+EXIF_FLUSH_INTERVAL = float(os.environ.get("EXIF_FLUSH_INTERVAL", 2.0))
+
+
+class ImageMetadataService:
+    """Reads capture time, size and orientation of new uploads and saves them in batches.
+
+    Runs as an upload hook on the bytes the media pipeline already downloaded, only their first
+    EXIF_HEADER_BYTES go to the parser in a worker process. Results are written together once
+    EXIF_BATCH_SIZE are waiting or EXIF_FLUSH_INTERVAL passed, with the apply_image_metadata
+    function from sql/image_metadata.sql (one call per batch)."""
+
+    def __init__(self, batch_size : int = EXIF_BATCH_SIZE, flush_interval : float = EXIF_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rpc_available = True
+        self._pending : list[dict[str, Any]] = []
+        self._timer : threading.Timer | None = None
+        self._lock = threading.Lock()
+        self.written = 0
+
+    def ingest(self, user_id : int, file_name : str, data : bytes) -> dict[str, Any]:
+        """Upload hook: parses the start of data and queues what was found for the next batch."""
+        metadata = media_pipeline.cpu(parse_header, data[:EXIF_HEADER_BYTES])
+        if metadata:
+            self._enqueue({"user_id": user_id, "file_name": file_name, "metadata": metadata,
+                           "taken_at": metadata.get("taken_at")})
+        return metadata
+
+    def _enqueue(self, row : dict[str, Any]) -> None:
+        with self._lock:
+            self._pending.append(row)
+            full = len(self._pending) >= self.batch_size
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self) -> int:
+        """Writes every pending result, returns how many were written."""
+        with self._lock:
+            rows, self._pending = self._pending, []
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        written = 0
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            try:
+                self._write(batch)
+                written += len(batch)
+            except Exception as e:
+                print(f"Warning: Could not save metadata of {len(batch)} images: {e}")
+        with self._lock:
+            self.written += written
+        return written
+
+    def _write(self, batch : list[dict[str, Any]]) -> None:
+        if self.rpc_available:
+            try:
+                supabase.rpc("apply_image_metadata", {"p_rows": batch}).execute()
+                return
+            except APIError as e:
+                if e.code != "PGRST202":
+                    raise
+                print("Warning: apply_image_metadata function not found, saving metadata row by row")
+                self.rpc_available = False
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        for row in batch:
+            supabase.table("images").update({"metadata": row["metadata"], "taken_at": row["taken_at"]})\
+                .eq("user_id", row["user_id"])\
+                .eq("file_name", row["file_name"])\
+                .execute()
+            if row["taken_at"]:
+                # Only fill dates the user has not set, nodes point at their image by file name
+                supabase.table("nodes").update({"custom_date": row["taken_at"], "updated_at": now})\
+                    .eq("user_id", row["user_id"])\
+                    .eq("image_id", row["file_name"])\
+                    .is_("custom_date", "null")\
+                    .execute()
+
+    def shutdown(self) -> None:
+        self.flush()
+
+
+image_metadata_service = ImageMetadataService()
+media_pipeline.add_upload_hook(image_metadata_service.ingest)
@@ -1,8 +1,39 @@
 from models.image import ImageFilename, ImagePublic
-from db.db import supabase
+from db.db import supabase, get_async_supabase
+from services.offload import image_pool
 from services.security import security_service
+from services.sync_services import sync_service
+from services.media_pipeline import media_pipeline
+from services.derivatives import derivative_service, ImageSize
+from services.similarity import similarity_service
+from services.cache import TTLCache
 from fastapi import Depends, HTTPException
-from typing import Any, Annotated
+from postgrest.exceptions import APIError
+from typing import Any, Annotated, Protocol
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import time
+
+SIGNED_URL_EXPIRES_IN = int(os.environ.get("SIGNED_URL_EXPIRES_IN", 60*30))
+# A cached url is only handed out while it has at least this many seconds left
+SIGNED_URL_MIN_REMAINING = int(os.environ.get("SIGNED_URL_MIN_REMAINING", 60*5))
+SIGNED_URL_CACHE_SIZE = int(os.environ.get("SIGNED_URL_CACHE_SIZE", 5000))
+SIGNED_URL_BATCH_SIZE = 100  # paths per create_signed_urls call
+SIGNED_URL_FALLBACK_WORKERS = 8
+# 42703: unknown column in a filter, PGRST204: unknown column in a write, i.e. sql/image_hashes.sql not applied
+_MISSING_COLUMN_CODES = ("42703", "PGRST204")
+
+
+class UrlCacheBackend(Protocol):
+    """What ImageService needs from a signed url cache, TTLCache in process or e.g. a redis adapter."""
+
+    def get(self, key : str, default : Any = None) -> Any: ...
+
+    def set(self, key : str, value : Any, ttl : float | None = None,
+            expires_at : float | None = None) -> None: ...
+
+    def delete(self, key : str) -> None: ...
 
 def _payload_to_image_dump(payload : ImageFilename) -> dict[str, Any]:
     """keys: (user_id, file_name, file_path)"""
@@ -13,8 +44,15 @@ def _payload_to_image_dump(payload : ImageFilename) -> dict[str, Any]:
 
 class ImageService:
 
-    def __init__(self):
-        pass
+    def __init__(self, url_cache : UrlCacheBackend | None = None):
+        self.url_cache = url_cache if url_cache is not None else TTLCache(maxsize=SIGNED_URL_CACHE_SIZE)
+        self.hashes_available = True  # images.content_sha256 exists, turned off on the first miss
+
+    def _cache_signed_url(self, file_path : str, response) -> None:
+        if response:
+            # Drop the entry once less than SIGNED_URL_MIN_REMAINING of the url's life is left
+            expires_at = time.time() + SIGNED_URL_EXPIRES_IN - SIGNED_URL_MIN_REMAINING
+            self.url_cache.set(file_path, response, expires_at=expires_at)
 
     def get_upload_url(self, payload: ImageFilename):
         """Returns a signed URL for the given file name."""
@@ -27,28 +65,200 @@ class ImageService:
         # Return the signed URL so the frontend can use it
         return response["signedUrl"]
     
-    def confirm_uploaded(self, payload : ImageFilename):
+    def confirm_uploaded(self, payload : ImageFilename, content_sha256 : str | None = None,
+                         data : bytes | None = None):
         """If upload to signed URL successful, then call this method so that DB can be updated."""
         image_dump = _payload_to_image_dump(payload=payload)
+        if content_sha256 is not None:
+            image_dump["content_sha256"] = content_sha256
         try:
             db_response = supabase.table("images").insert(image_dump).execute()
         except Exception as e:
             print(f" DATABASE ERROR: {e}")
             raise HTTPException(status_code=500, detail=f"Database Insert Failed: {str(e)}")
-        
+        # Thumbnails, EXIF and other derived data are produced in the background from one download
+        media_pipeline.uploaded(payload.user_id, payload.file_name, data)
         return db_response.data[0]
-    
-    def get_signed_url(self, payload : ImageFilename):
-        """Returns a signed URL of given file name for the user."""
+
+    def find_by_hash(self, user_id : int, content_sha256 : str) -> dict[str, Any] | None:
+        """The user's image with this SHA-256, one lookup on the (user_id, content_sha256) index."""
+        if not self.hashes_available:
+            return None
+        try:
+            db_response = supabase.table("images").select("*")\
+                .eq("user_id", user_id)\
+                .eq("content_sha256", content_sha256.lower())\
+                .limit(1)\
+                .execute()
+        except APIError as e:
+            if e.code not in _MISSING_COLUMN_CODES:
+                raise
+            print("Warning: images.content_sha256 not found, uploads are not deduplicated")
+            self.hashes_available = False
+            return None
+        return db_response.data[0] if db_response.data else None
+
+    def record_content_hash(self, user_id : int, file_name : str, data : bytes) -> None:
+        """Upload hook: hashes images that went straight to storage through a signed upload URL."""
+        if not self.hashes_available:
+            return
+        supabase.table("images").update({"content_sha256": hashlib.sha256(data).hexdigest()})\
+            .eq("user_id", user_id)\
+            .eq("file_name", file_name)\
+            .is_("content_sha256", "null")\
+            .execute()
+
+    def upload_image_bytes(self, payload : ImageFilename, data : bytes, content_type : str,
+                           content_sha256 : str | None = None):
+        """Uploads image bytes fetched server-side to the bucket and records them like confirm_uploaded.
+
+        When the user already has the same bytes the existing row is returned (deduplicated: True)
+        and nothing is stored; content_sha256 can be passed when the caller hashed while streaming."""
+        content_sha256 = content_sha256 or hashlib.sha256(data).hexdigest()
+        existing = self.find_by_hash(payload.user_id, content_sha256)
+        if existing is not None:
+            return {**existing, "deduplicated": True}
+
+        image_dump = _payload_to_image_dump(payload=payload)
+        try:
+            supabase.storage.from_("images_0").upload(path=image_dump["file_path"], file=data,
+                                                     file_options={"content-type": content_type})
+        except Exception as e:
+            print(f" STORAGE ERROR: {e}")
+            raise HTTPException(status_code=500, detail=f"Storage Upload Failed: {str(e)}")
+
+        image_row = self.confirm_uploaded(payload, data=data,
+                                          content_sha256=content_sha256 if self.hashes_available else None)
+        return {**image_row, "deduplicated": False}
+
+    def get_signed_url(self, payload : ImageFilename, size : ImageSize | None = None):
+        """Returns a signed URL of given file name for the user, reusing a cached one while it is fresh.
+
+        With size the URL points at that derivative, or at the original while it is still being made."""
+        image_dump = _payload_to_image_dump(payload=payload)
+        if size is not None and derivative_service.enabled \
+                and not derivative_service.is_missing(payload.user_id, payload.file_name):
+            response = self._sign_path(derivative_service.path(payload.user_id, payload.file_name, size))
+            if response:
+                return response
+            derivative_service.ensure(payload.user_id, payload.file_name)
+        return self._sign_path(image_dump["file_path"], raise_errors=True)
+
+    def _sign_path(self, file_path : str, raise_errors : bool = False):
+        cached = self.url_cache.get(file_path)
+        if cached is not None:
+            return cached
+        try:
+            response = supabase.storage.from_("images_0").create_signed_url(
+                path=file_path, expires_in=SIGNED_URL_EXPIRES_IN
+            )
+        except Exception:
+            # Missing derivatives surface as storage errors, the caller falls back to the original
+            if raise_errors:
+                raise
+            return None
+        self._cache_signed_url(file_path, response)
+        return response
+
+    def _sign_one(self, user_id : int, file_name : str) -> str | None:
+        try:
+            response = self.get_signed_url(ImageFilename(user_id=user_id, file_name=file_name))
+        except Exception as e:
+            print(f"Warning: Could not sign {user_id}/{file_name}: {e}")
+            return None
+        return response.get("signedUrl") if response else None
+
+    def get_signed_urls(self, user_id : int, file_names : list[str],
+                        size : ImageSize | None = None) -> dict[str, str | None]:
+        """Signed URLs for many files of the user, keyed by file name (None if it could not be signed).
+
+        Cached URLs are reused, the rest are signed with one storage call per SIGNED_URL_BATCH_SIZE
+        paths and anything the batch call misses is retried with concurrent single calls.
+        With size, derivatives that don't exist yet are scheduled and their originals handed out,
+        images already known to lack them skip the derivative lookup."""
+        names = list(dict.fromkeys(file_names))
+        if size is not None and derivative_service.enabled:
+            known_missing = [name for name in names if derivative_service.is_missing(user_id, name)]
+            paths = {name : derivative_service.path(user_id, name, size)
+                     for name in names if name not in known_missing}
+            urls, missing = self._sign_batch(paths)
+            for name in missing:
+                derivative_service.ensure(user_id, name)
+            originals = known_missing + missing
+            urls.update(self.get_signed_urls(user_id, originals) if originals else {})
+            return {name : urls.get(name) for name in names}
+
+        urls, failed = self._sign_batch({name : f"{user_id}/{name}" for name in names})
+        if failed:
+            with ThreadPoolExecutor(max_workers=min(SIGNED_URL_FALLBACK_WORKERS, len(failed))) as executor:
+                for name, url in zip(failed, executor.map(lambda name: self._sign_one(user_id, name), failed)):
+                    urls[name] = url
+
+        return {name : urls.get(name) for name in names}
+
+    def _sign_batch(self, paths : dict[str, str]) -> tuple[dict[str, str], list[str]]:
+        """Signs {name: path} from the cache and batched storage calls, returns (urls, names it missed)."""
+        urls : dict[str, str] = {}
+        missing = []
+        for name, path in paths.items():
+            cached = self.url_cache.get(path)
+            if cached is not None:
+                urls[name] = cached.get("signedUrl")
+            else:
+                missing.append(name)
+
+        failed = []
+        for start in range(0, len(missing), SIGNED_URL_BATCH_SIZE):
+            chunk = missing[start:start + SIGNED_URL_BATCH_SIZE]
+            try:
+                signed = supabase.storage.from_("images_0").create_signed_urls(
+                    paths=[paths[name] for name in chunk], expires_in=SIGNED_URL_EXPIRES_IN
+                )
+                by_path = {item["path"] : item for item in signed if not item.get("error")}
+            except Exception as e:
+                print(f"Warning: Batch signing failed, falling back to single calls: {e}")
+                by_path = {}
+
+            for name in chunk:
+                item = by_path.get(paths[name])
+                if item and item.get("signedUrl"):
+                    response = {"signedURL": item["signedURL"], "signedUrl": item["signedUrl"]}
+                    self._cache_signed_url(paths[name], response)
+                    urls[name] = item["signedUrl"]
+                else:
+                    failed.append(name)
+        return urls, failed
+
+    async def get_signed_url_async(self, payload : ImageFilename, size : ImageSize | None = None):
         image_dump = _payload_to_image_dump(payload=payload)
-        response = supabase.storage.from_("images_0").create_signed_url(
-            path=image_dump["file_path"], expires_in=60*30 # can be loaded from dotenv
+        if size is not None and derivative_service.enabled:
+            # The derivative fallback needs a few calls, keep it on the blocking path
+            return await image_pool.run(self.get_signed_url, payload, size)
+        cached = self.url_cache.get(image_dump["file_path"])
+        if cached is not None:
+            return cached
+        client = get_async_supabase()
+        if client is None:
+            return await image_pool.run(self.get_signed_url, payload)
+        response = await client.storage.from_("images_0").create_signed_url(
+            path=image_dump["file_path"], expires_in=SIGNED_URL_EXPIRES_IN
         )
+        self._cache_signed_url(image_dump["file_path"], response)
         return response
     
-    def delete_image(self, payload: ImageFilename):
-        """Deletes an image from storage and the database."""
+    def delete_image(self, payload: ImageFilename, node_id : str | None = None):
+        """Deletes an image from storage and the database.
+
+        Deduplicated uploads let several nodes share one image, so the delete is refused (409) while
+        a node other than node_id still points at it."""
+        others = [str(row["node_id"]) for row in self._nodes_using(payload.user_id, payload.file_name)
+                  if str(row["node_id"]) != str(node_id)]
+        if others:
+            raise HTTPException(status_code=409, detail=f"Image is still used by {len(others)} other node(s)")
         image_dump = _payload_to_image_dump(payload=payload)
+        derivative_paths = derivative_service.paths(payload.user_id, payload.file_name)
+        for path in [image_dump["file_path"], *derivative_paths]:
+            self.url_cache.delete(path)
         
         # 1. Delete from Storage
         storage_response = supabase.storage.from_("images_0").remove(paths=image_dump["file_path"])
@@ -57,6 +267,11 @@ class ImageService:
         if not storage_response:
             # It's possible the file didn't exist in storage, but we might still want to clean up the DB
             print(f"Warning: File {image_dump['file_path']} not found in storage or deletion failed.")
+        if derivative_service.enabled:
+            try:
+                supabase.storage.from_("images_0").remove(paths=derivative_paths)
+            except Exception as e:
+                print(f"Warning: Could not remove derivatives of {image_dump['file_path']}: {e}")
 
         # 2. Delete from Database
         try:
@@ -66,9 +281,33 @@ class ImageService:
         except Exception as e:
             print(f" DATABASE ERROR: {e}")
             raise HTTPException(status_code=500, detail=f"Database Deletion Failed: {str(e)}")
+        if db_response.data:
+            similarity_service.forget(payload.user_id, payload.file_name)
+            sync_service.record_deletes(payload.user_id, "image", [payload.file_name])
 
         return {"storage_data": storage_response, "db_data": db_response.data}
     
+    def _nodes_using(self, user_id : int, file_name : str) -> list[dict]:
+        db_response = supabase.table("nodes").select("node_id")\
+            .eq("user_id", user_id)\
+            .eq("image_id", file_name)\
+            .execute()
+        return db_response.data if db_response.data else []
+
+    def list_file_names(self, user_id : int) -> list[str]:
+        """Returns the file names of every image the user has uploaded."""
+        db_response = supabase.table("images").select("file_name").eq("user_id", user_id).execute()
+        rows = db_response.data if db_response.data else []
+        return [row["file_name"] for row in rows]
+
+    async def list_file_names_async(self, user_id : int) -> list[str]:
+        client = get_async_supabase()
+        if client is None:
+            return await image_pool.run(self.list_file_names, user_id)
+        db_response = await client.table("images").select("file_name").eq("user_id", user_id).execute()
+        rows = db_response.data if db_response.data else []
+        return [row["file_name"] for row in rows]
+
     def get_image_info(self, payload):
         image_dump = _payload_to_image_dump(payload=payload)
         file_path = image_dump["file_path"]
@@ -90,4 +329,5 @@ class ImageService:
         return image_public
 
 
-image_service = ImageService()
\ No newline at end of file
+image_service = ImageService()
+media_pipeline.add_upload_hook(image_service.record_content_hash)
\ No newline at end of file
@@ -0,0 +1,89 @@
+from typing import Any
+import math
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:  # /graph/layout answers 503 and layout stays in the browser
+    NUMPY_AVAILABLE = False
+
+LAYOUT_BLOCK_SIZE = 256  # rows of the pairwise repulsion computed at once, bounds memory to block x n
+GRAVITY = 0.05  # pull towards the centre, keeps unconnected parts of the graph from drifting apart
+
+
+def _initial_positions(stored : list[tuple[float, float] | None], edges : "np.ndarray", spacing : float,
+                       seed : int) -> "np.ndarray":
+    """Stored coordinates where known, new nodes next to an already placed neighbour (or on a disc)."""
+    rng = np.random.default_rng(seed)
+    count = len(stored)
+    positions = np.zeros((count, 2))
+    placed = np.array([position is not None for position in stored], dtype=bool)
+    if placed.any():
+        positions[placed] = [position for position in stored if position is not None]
+    centre = positions[placed].mean(axis=0) if placed.any() else np.zeros(2)
+    radius = spacing * math.sqrt(count)
+    for index in np.flatnonzero(~placed):
+        neighbours = np.concatenate([edges[edges[:, 0] == index, 1], edges[edges[:, 1] == index, 0]])
+        anchors = neighbours[placed[neighbours]] if len(neighbours) else neighbours
+        if len(anchors):
+            positions[index] = positions[anchors].mean(axis=0) + rng.normal(0, spacing / 2, 2)
+        else:
+            angle, distance = rng.uniform(0, 2 * math.pi), radius * math.sqrt(rng.uniform())
+            positions[index] = centre + distance * np.array([math.cos(angle), math.sin(angle)])
+    return positions
+
+def force_layout(stored : list[tuple[float, float] | None], edges : list[tuple[int, int]],
+                 pinned : list[bool], iterations : int = 100, spacing : float = 150.0,
+                 incremental : bool = True, seed : int = 0) -> list[tuple[float, float]]:
+    """Fruchterman-Reingold layout with every force computed as array operations.
+
+    stored holds each node's current position (None when it has none), edges index into it and
+    pinned nodes never move. Incremental runs start cool, so a laid out graph is only refined
+    and nodes that were placed by hand stay roughly where they were."""
+    count = len(stored)
+    if count == 0:
+        return []
+    edge_array = np.array(edges, dtype=np.int64).reshape(-1, 2)
+    edge_array = edge_array[edge_array[:, 0] != edge_array[:, 1]]
+    fixed = np.array(pinned, dtype=bool)
+    if not incremental:
+        stored = [position if fixed[index] else None for index, position in enumerate(stored)]
+    positions = _initial_positions(stored, edge_array, spacing, seed)
+    # Nodes stored on the same spot would push each other with zero force and never separate
+    positions[~fixed] += np.random.default_rng(seed).normal(0, spacing / 100, (int((~fixed).sum()), 2))
+    anchor = positions[fixed]
+
+    source, target = edge_array[:, 0], edge_array[:, 1]
+    centre = positions.mean(axis=0)
+    temperature = spacing * (1.0 if incremental else math.sqrt(count))
+    cooling = 0.01 ** (1 / max(iterations, 1))  # ends at 1% of the starting step
+    for _ in range(iterations):
+        displacement = np.zeros_like(positions)
+        # Repulsion k^2 / d between every pair, a block of rows at a time in float32 (the forces
+        # only steer the step, the positions themselves stay float64)
+        x, y = positions[:, 0].astype(np.float32), positions[:, 1].astype(np.float32)
+        for start in range(0, count, LAYOUT_BLOCK_SIZE):
+            block = slice(start, start + LAYOUT_BLOCK_SIZE)
+            dx, dy = x[block, None] - x, y[block, None] - y
+            force = dx * dx
+            force += dy * dy
+            np.maximum(force, np.float32(0.01), out=force)
+            np.divide(np.float32(spacing ** 2), force, out=force)
+            displacement[block, 0] += np.einsum("ij,ij->i", dx, force)
+            displacement[block, 1] += np.einsum("ij,ij->i", dy, force)
+        # Attraction d^2 / k along each link
+        if len(edge_array):
+            delta = positions[source] - positions[target]
+            pull = delta * (np.sqrt((delta ** 2).sum(axis=1)) / spacing)[:, None]
+            np.subtract.at(displacement, source, pull)
+            np.add.at(displacement, target, pull)
+        displacement -= GRAVITY * (positions - centre)
+        length = np.maximum(np.sqrt((displacement ** 2).sum(axis=1)), 1e-9)
+        positions += displacement * (np.minimum(length, temperature) / length)[:, None]
+        positions[fixed] = anchor
+        temperature *= cooling
+    return [(float(x), float(y)) for x, y in positions]
+
+def stored_position(node : dict[str, Any]) -> tuple[float, float] | None:
+    x, y = node.get("position_x"), node.get("position_y")
+    return (float(x), float(y)) if x is not None and y is not None else None
@@ -1,31 +1,347 @@
 from models.link import NodeLinkCreate, NodeLinkDelete, LinkDataFields as df
-from db.db import supabase
-from typing import Any, Annotated, Literal
+from db.db import supabase, get_async_supabase
+from services.offload import link_pool
+from services.sync_services import sync_service
+from services.batching import chunks
+from fastapi import HTTPException
+from pydantic import ValidationError
+from typing import Any, Annotated, Callable, Literal
 from enum import Enum
+from collections import OrderedDict, deque
+import os
+import secrets
+import threading
+import time
+
+# Process-local link cache: total rows kept across users, and how long a user's set is trusted
+LINK_CACHE_MAX_LINKS = int(os.environ.get("LINK_CACHE_MAX_LINKS", 200000))
+LINK_CACHE_TTL = float(os.environ.get("LINK_CACHE_TTL", 300))
+LINK_CHANGELOG_SIZE = 1000  # changes kept per user for since_version diffs
+MAX_BULK_LINKS = 1000
+LINK_INSERT_CHUNK_SIZE = 200  # rows per multi-row insert
+# Node ids per delete, each id appears twice in the or= filter of the url (about 4KB for 50 uuids)
+LINK_DELETE_CHUNK_SIZE = 50
+
+
+class _UserLinks:
+    def __init__(self, links : list[dict], version : int):
+        self.links = {str(link[df.link_id.value]) : link for link in links}
+        self.changes : deque[tuple[int, str, Any]] = deque()
+        self.floor = version  # oldest version the change log can diff from
+        self.loaded_at = time.monotonic()
+
+    def record(self, version : int, op : str, value : Any) -> None:
+        if len(self.changes) >= LINK_CHANGELOG_SIZE:
+            self.floor = self.changes.popleft()[0]
+        self.changes.append((version, op, value))
+
+    def diff(self, since_version : int) -> dict[str, list]:
+        """Links upserted and link ids deleted after since_version, latest change per link wins."""
+        upserted, deleted = {}, {}
+        for version, op, value in self.changes:
+            if version <= since_version:
+                continue
+            if op == "upsert":
+                link_id = str(value[df.link_id.value])
+                upserted[link_id] = value
+                deleted.pop(link_id, None)
+            else:
+                upserted.pop(value, None)
+                deleted[value] = True
+        return {"upserted": _newest_first(upserted.values()), "deleted": list(deleted)}
+
+
+class LinkCache:
+    """Per-user link sets kept in memory, LRU evicted by user once LINK_CACHE_MAX_LINKS rows are held.
+
+    Versions are per process (tokens carry a random epoch to tell processes apart) and keep
+    counting across evictions, so a client's since_version is either diffable or answered in full.
+    A reload after expiry or eviction gets a new version unless it holds exactly the links that
+    were dropped, so writes from other processes picked up by the reload change the ETag."""
+
+    def __init__(self, max_links : int = LINK_CACHE_MAX_LINKS, ttl : float = LINK_CACHE_TTL):
+        self.max_links = max_links
+        self.ttl = ttl
+        self.epoch = secrets.token_hex(4)
+        self._users : OrderedDict[str, _UserLinks] = OrderedDict()
+        self._versions : dict[str, int] = {}
+        self._retired : dict[str, int] = {}  # fingerprint of each user's last expired or evicted set
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def version(self, user_id) -> int:
+        with self._lock:
+            return self._versions.get(str(user_id), 0)
+
+    def token(self, version : int) -> str:
+        return f"{self.epoch}.{version}"
+
+    def etag(self, version : int) -> str:
+        return f'W/"links-{self.token(version)}"'
+
+    def parse_token(self, token : str | None) -> int | None:
+        """Version number of a token issued by this process, None for other processes or garbage."""
+        epoch, _, version = (token or "").partition(".")
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    def get(self, user_id) -> tuple[int, _UserLinks] | None:
+        key = str(user_id)
+        with self._lock:
+            entry = self._users.get(key)
+            if entry is not None and time.monotonic() - entry.loaded_at > self.ttl:
+                self._retire(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._users.move_to_end(key)
+            self.hits += 1
+            return self._versions.get(key, 0), entry
+
+    def store(self, user_id, links : list[dict], loaded_version : int) -> None:
+        """Keeps links loaded from the database, unless the user's links changed during the load."""
+        key = str(user_id)
+        with self._lock:
+            version = self._versions.get(key, 0)
+            if version != loaded_version or len(links) > self.max_links:
+                return
+            self._drop(key)
+            entry = _UserLinks(links, version)
+            if self._retired.pop(key, None) != _fingerprint(entry):
+                # Possibly different from what clients were told at this version, e.g. another
+                # process wrote links meanwhile, so this set gets a version of its own
+                version += 1
+                self._versions[key] = version
+                entry.floor = version
+            self._users[key] = entry
+            self._size += len(links)
+            self._evict()
+
+    def apply(self, user_id, upserted : list[dict] = (), deleted_ids : list[Any] = ()) -> int:
+        """Bumps the user's version and patches the cached set in place, returns the new version."""
+        key = str(user_id)
+        with self._lock:
+            version = self._versions.get(key, 0) + 1
+            self._versions[key] = version
+            entry = self._users.get(key)
+            if entry is not None:
+                for link in upserted:
+                    link_id = str(link[df.link_id.value])
+                    self._size += link_id not in entry.links
+                    entry.links[link_id] = link
+                    entry.record(version, "upsert", link)
+                for link_id in map(str, deleted_ids):
+                    if entry.links.pop(link_id, None) is not None:
+                        self._size -= 1
+                    entry.record(version, "delete", link_id)
+                self._evict()
+            return version
+
+    def invalidate(self, user_id) -> None:
+        """Forgets the user's set after a change the cache can't replay (e.g. a database cascade)."""
+        key = str(user_id)
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._drop(key)
+
+    def _drop(self, key : str) -> None:
+        entry = self._users.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry.links)
+
+    def _retire(self, key : str) -> None:
+        """Drops an expired or evicted set, remembering its fingerprint for the next store."""
+        entry = self._users.get(key)
+        if entry is not None:
+            self._retired[key] = _fingerprint(entry)
+            self._drop(key)
+
+    def _evict(self) -> None:
+        while self._size > self.max_links and self._users:
+            self._retire(next(iter(self._users)))
+            self.evictions += 1
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {"users": len(self._users), "links": self._size, "max_links": self.max_links,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+def _fingerprint(entry : _UserLinks) -> int:
+    return hash(frozenset(entry.links))
+
+def _newest_first(links) -> list[dict]:
+    return sorted(links, key=lambda link: str(link.get("created_at") or ""), reverse=True)
+
+def _link_key(source : str, target : str, undirected : bool) -> tuple[str, str]:
+    """Identity of an edge, a->b and b->a are the same edge when undirected."""
+    return (min(source, target), max(source, target)) if undirected else (source, target)
+
 
 class LinkService:
     def __init__(self):
-        pass
+        self._listeners: list[Callable[[int], None]] = []
+        self.cache = LinkCache()
+
+    def subscribe(self, listener: Callable[[int], None]):
+        """Registers listener(user_id), called after the user's links change."""
+        self._listeners.append(listener)
+
+    def _notify(self, user_id: int):
+        for listener in self._listeners:
+            listener(user_id)
 
     def create_link(self, payload: NodeLinkCreate):
         link_dump = payload.model_dump()
         db_response = supabase.table("nodelinks").insert(link_dump).execute()
+        self.cache.apply(payload.user_id, upserted=db_response.data or [])
+        self._notify(payload.user_id)
         return db_response.data[0] if db_response.data else None
     
+    def bulk_create_links(self, user_id: int, items: list[dict[str, Any]], undirected: bool = True):
+        """Creates many links at once, returns {index, ok, link, created} | {index, ok, error} per item.
+
+        Pairs are deduplicated within the request and against the user's existing links
+        (read once through list_links), only new pairs are inserted in chunked multi-row inserts."""
+        if len(items) > MAX_BULK_LINKS:
+            raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_LINKS} items per request")
+        existing = {}
+        for link in self.list_links(user_id):
+            source, target = str(link[df.source_node_id.value]), str(link[df.target_node_id.value])
+            existing.setdefault(_link_key(source, target, undirected), link)
+
+        results, pending = [], {}  # pending: key -> (row, [indices])
+        for index, item in enumerate(items):
+            try:
+                payload = NodeLinkCreate.model_validate({**item, df.user_id.value : user_id})
+            except (ValidationError, TypeError) as e:
+                detail = e.errors(include_url=False) if isinstance(e, ValidationError) else str(e)
+                results.append({"index": index, "ok": False, "error": detail})
+                continue
+            source, target = payload.source_node_id.strip(), payload.target_node_id.strip()
+            if source == target:
+                results.append({"index": index, "ok": False, "error": "A node cannot be linked to itself"})
+                continue
+            key = _link_key(source, target, undirected)
+            if key in existing:
+                results.append({"index": index, "ok": True, "link": existing[key], "created": False})
+            elif key in pending:
+                pending[key][1].append(index)
+            else:
+                row = {df.user_id.value : user_id,
+                       df.source_node_id.value : source, df.target_node_id.value : target}
+                pending[key] = (row, [index])
+
+        created_rows = []
+        for chunk in chunks(list(pending.values()), LINK_INSERT_CHUNK_SIZE):
+            try:
+                db_response = supabase.table("nodelinks").insert([row for row, _ in chunk]).execute()
+                created = db_response.data or []
+            except Exception as e:
+                print(f" DATABASE ERROR: {e}")
+                results.extend({"index": index, "ok": False, "error": str(e)}
+                               for _, indices in chunk for index in indices)
+                continue
+            created_rows.extend(created)
+            for (_, indices), link in zip(chunk, created):
+                # Repeats of a pair within the request share the row created for its first occurrence
+                results.extend({"index": index, "ok": True, "link": link, "created": position == 0}
+                               for position, index in enumerate(indices))
+
+        if created_rows:
+            self.cache.apply(user_id, upserted=created_rows)
+            self._notify(user_id)
+        return sorted(results, key=lambda result: result["index"])
+
+    def _list_links_query(self, client, user_id: int):
+        return client.table("nodelinks").select("*")\
+            .eq(df.user_id.value, user_id)\
+            .order("created_at", desc=True)
+
     def list_links(self, user_id: int):
         """Get all links for a user"""
-        db_response = supabase.table("nodelinks").select("*")\
-            .eq(df.user_id.value, user_id)\
-            .order("created_at", desc=True)\
-            .execute()
-        return db_response.data if db_response.data else []
-    
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            return _newest_first(cached[1].links.values())
+        version = self.cache.version(user_id)
+        db_response = self._list_links_query(supabase, user_id).execute()
+        links = db_response.data if db_response.data else []
+        self.cache.store(user_id, links, version)
+        return links
+
+    async def list_links_async(self, user_id: int):
+        """list_links on the async client, or on a worker thread when async mode is off."""
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            return _newest_first(cached[1].links.values())
+        client = get_async_supabase()
+        if client is None:
+            return await link_pool.run(self.list_links, user_id)
+        version = self.cache.version(user_id)
+        db_response = await self._list_links_query(client, user_id).execute()
+        links = db_response.data if db_response.data else []
+        self.cache.store(user_id, links, version)
+        return links
+
+    async def list_links_since(self, user_id: int, if_none_match: str | None = None,
+                               since_version: str | None = None) -> tuple[str, dict[str, Any] | None]:
+        """Versioned list_links, returns (etag, body) with body None when if_none_match is current.
+
+        With since_version the body only holds what changed after that version, or every
+        link with full=True when the change log can't reach back that far."""
+        cached = self.cache.get(user_id)
+        if cached is None:
+            version = self.cache.version(user_id)
+            links = await self.list_links_async(user_id)
+            # The load may have been stored under a new version, answer from the cache then
+            cached = self.cache.get(user_id)
+            if cached is None:
+                # Not cached (too big, or changed while loading) means there is no log to diff from
+                return self.cache.etag(version), {"version": self.cache.token(version), "full": True, "links": links}
+
+        version, entry = cached
+        etag = self.cache.etag(version)
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return etag, None
+        since = self.cache.parse_token(since_version)
+        if since is not None and entry.floor <= since <= version:
+            return etag, {"version": self.cache.token(version), "full": False, **entry.diff(since)}
+        return etag, {"version": self.cache.token(version), "full": True,
+                      "links": _newest_first(entry.links.values())}
+
+    def delete_links_of_nodes(self, user_id: int, node_ids: list[str]) -> list[dict]:
+        """Deletes every link touching node_ids, one request per LINK_DELETE_CHUNK_SIZE ids, returns the deleted rows."""
+        deleted = []
+        for ids in chunks(list(node_ids), LINK_DELETE_CHUNK_SIZE):
+            id_list = ",".join('"' + str(node_id).replace('"', '\\"') + '"' for node_id in ids)
+            db_response = supabase.table("nodelinks").delete()\
+                .eq(df.user_id.value, user_id)\
+                .or_(f"{df.source_node_id.value}.in.({id_list}),{df.target_node_id.value}.in.({id_list})")\
+                .execute()
+            deleted.extend(db_response.data or [])
+        link_ids = [row[df.link_id.value] for row in deleted]
+        if link_ids:
+            sync_service.record_deletes(user_id, "link", link_ids)
+            self.cache.apply(user_id, deleted_ids=link_ids)
+            self._notify(user_id)
+        return deleted
+
     def delete_link(self, payload: NodeLinkDelete):
         link_dump = payload.model_dump()
         db_response = supabase.table("nodelinks").delete()\
             .eq(df.user_id.value, link_dump[df.user_id.value])\
             .eq(df.link_id.value, link_dump[df.link_id.value])\
             .execute()
+        # A missing or foreign link_id deletes nothing, so nothing changes for readers either
+        if db_response.data:
+            sync_service.record_deletes(payload.user_id, "link", [payload.link_id])
+            self.cache.apply(payload.user_id, deleted_ids=[payload.link_id])
+            self._notify(payload.user_id)
         return {"message": "Link deleted successfully"}
     
 
@@ -0,0 +1,123 @@
+from db.db import supabase
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable
+import os
+import threading
+
+# Background work after an upload: threads move bytes to and from storage, processes do the pixel work
+MEDIA_IO_WORKERS = int(os.environ.get("MEDIA_IO_WORKERS", 4))
+MEDIA_CPU_WORKERS = int(os.environ.get("MEDIA_CPU_WORKERS", min(os.cpu_count() or 1, 2)))
+MEDIA_MAX_PENDING = int(os.environ.get("MEDIA_MAX_PENDING", 256))
+
+UploadHook = Callable[[int, str, bytes], None]
+
+
+class MediaPipeline:
+    """Runs image jobs off the request path; jobs are dropped (and logged) once too many are pending.
+
+    Hooks registered with add_upload_hook get (user_id, file_name, original bytes) after each
+    confirmed upload, the original is downloaded once for all of them."""
+
+    def __init__(self, io_workers : int, cpu_workers : int, max_pending : int):
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.max_pending = max_pending
+        self._io : ThreadPoolExecutor | None = None
+        self._cpu : ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._hooks : list[UploadHook] = []
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def add_upload_hook(self, hook : UploadHook) -> None:
+        self._hooks.append(hook)
+
+    def _get_io(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._io is None:
+                self._io = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix="media-pool")
+            return self._io
+
+    def _get_cpu(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._cpu is None:
+                self._cpu = ProcessPoolExecutor(max_workers=self.cpu_workers)
+            return self._cpu
+
+    def background(self, fn : Callable[..., Any], *args : Any) -> Future | None:
+        """Queues fn(*args) on the io threads, returns None when the job had to be dropped."""
+        with self._lock:
+            if self.max_pending and self._pending >= self.max_pending:
+                self.dropped += 1
+                print(f"Warning: Media pipeline is full, dropped {getattr(fn, '__name__', fn)}{args[:2]}")
+                return None
+            self._pending += 1
+
+        def call():
+            try:
+                result = fn(*args)
+            except Exception as e:
+                print(f"Warning: Media job {getattr(fn, '__name__', fn)} failed: {e}")
+                with self._lock:
+                    self.failed += 1
+                return None
+            finally:
+                with self._lock:
+                    self._pending -= 1
+            with self._lock:
+                self.completed += 1
+            return result
+
+        return self._get_io().submit(call)
+
+    def cpu(self, fn : Callable[..., Any], *args : Any) -> Any:
+        """Runs a picklable fn(*args) in a worker process and waits for it (inline with 0 workers)."""
+        if self.cpu_workers <= 0:
+            return fn(*args)
+        try:
+            return self._get_cpu().submit(fn, *args).result()
+        except BrokenProcessPool:
+            with self._lock:
+                executor, self._cpu = self._cpu, None
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    def uploaded(self, user_id : int, file_name : str, data : bytes | None = None) -> Future | None:
+        """Runs the upload hooks for a newly confirmed image in the background.
+
+        data saves the download when the server already holds the bytes (e.g. fetch_from_url)."""
+        if not self._hooks:
+            return None
+        return self.background(self._run_hooks, user_id, file_name, data)
+
+    def _run_hooks(self, user_id : int, file_name : str, data : bytes | None) -> None:
+        if data is None:
+            data = supabase.storage.from_("images_0").download(f"{user_id}/{file_name}")
+        for hook in self._hooks:
+            try:
+                hook(user_id, file_name, data)
+            except Exception as e:
+                name = getattr(hook, "__name__", hook)
+                print(f"Warning: Upload hook {name} failed for {user_id}/{file_name}: {e}")
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {"io_workers": self.io_workers, "cpu_workers": self.cpu_workers,
+                    "max_pending": self.max_pending, "pending": self._pending,
+                    "completed": self.completed, "failed": self.failed, "dropped": self.dropped}
+
+    def shutdown(self) -> None:
+        with self._lock:
+            io, self._io = self._io, None
+            cpu, self._cpu = self._cpu, None
+        for executor in (io, cpu):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+
+media_pipeline = MediaPipeline(io_workers=MEDIA_IO_WORKERS, cpu_workers=MEDIA_CPU_WORKERS,
+                               max_pending=MEDIA_MAX_PENDING)
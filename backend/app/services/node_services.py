@@ -1,11 +1,95 @@
-from models.node import NodeCreate, NodeInfoDelete, NodePublic, NodeUpdate, NodeOp, NodeDataFields as df
-from db.db import supabase
-from typing import Any, Annotated, Literal
+from models.node import NodeCreate, NodeInfoDelete, NodePublic, NodeUpdate, NodeOp, NodePosition, NodeDataFields as df, NODE_COLUMNS
+from models.link import LinkDataFields as link_df
+from db.db import supabase, get_async_supabase
+from services.offload import node_pool
+from services.link_services import link_service
+from services.sync_services import sync_service
+from services.batching import chunks
+from typing import Any, Annotated, Callable, Literal
 from enum import Enum
+from fastapi import HTTPException
+from pydantic import BaseModel, ValidationError
+from postgrest.types import ReturnMethod
+from postgrest.exceptions import APIError
+import base64
+import datetime
+
+MAX_PAGE_SIZE = 100
+MAX_BULK_ITEMS = 1000
+BULK_CHUNK_SIZE = 200  # rows per multi-row insert or batched update
+# Maintained by Postgres, see sql/node_search.sql and sql/node_timeline.sql
+GENERATED_COLUMNS = ("search_vector", "timeline_at")
+NODE_NOT_FOUND = "Node not found"  # per-item error of batched writes to unknown or foreign nodes
+TIMELINE_COLUMN = "timeline_at"  # coalesce(custom_date, created_at)
+TimelineBucket = Literal["day", "month", "year"]
+_BUCKET_LABEL_LENGTH = {"day": 10, "month": 7, "year": 4}  # prefix of an ISO timestamp
+
+def _encode_cursor(created_at : str, node_id : Any) -> str:
+    """Opaque keyset cursor of the last row in a page: (created_at, node_id)."""
+    raw = f"{created_at}|{node_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def _decode_cursor(cursor : str) -> tuple[str, str]:
+    try:
+        created_at, node_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|", 1)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return created_at, node_id
+
+def _projection(fields : list[df] | None, sort_column : str = "created_at") -> str:
+    """Columns to select (NODE_COLUMNS by default); sort_column and node_id are always kept for the cursor."""
+    columns = [field.value for field in fields] if fields else list(NODE_COLUMNS)
+    for key_column in (sort_column, df.node_id.value):
+        if key_column not in columns:
+            columns.append(key_column)
+    return ",".join(columns)
+
+def _parse_timestamp(value : str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+
+def _as_utc(value : datetime.datetime | None) -> datetime.datetime | None:
+    """Aware UTC datetime, naive values are taken to be UTC already."""
+    if value is None:
+        return None
+    return value.replace(tzinfo=datetime.timezone.utc) if value.tzinfo is None else value.astimezone(datetime.timezone.utc)
+
+def _strip_generated(rows : list[dict] | None) -> list[dict]:
+    """Drops GENERATED_COLUMNS from rows returned by writes (which send back the whole row), in place."""
+    rows = rows if rows else []
+    for row in rows:
+        for column in GENERATED_COLUMNS:
+            row.pop(column, None)
+    return rows
+
+def _validate_items(model : type[BaseModel], items : list[dict[str, Any]], user_id : int):
+    """Validates every item in one pass; returns ([(index, model)], [error result])."""
+    if len(items) > MAX_BULK_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_ITEMS} items per request")
+    valid, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            # user_id always comes from the verified token, never from the item
+            valid.append((index, model.model_validate({**item, df.user_id.value : user_id})))
+        except (ValidationError, TypeError) as e:
+            detail = e.errors(include_url=False) if isinstance(e, ValidationError) else str(e)
+            errors.append({"index": index, "ok": False, "error": detail})
+    return valid, errors
+
 
 class NodeService:
     def __init__(self):
-        pass
+        self._listeners : list[Callable[[int, list[dict], list[str]], None]] = []
+        self.changes_rpc_available = True  # apply_node_changes exists, turned off on the first miss
+
+    def subscribe(self, listener : Callable[[int, list[dict], list[str]], None]):
+        """Registers listener(user_id, written_rows, deleted_node_ids), called after nodes change.
+
+        Rows of partial updates only carry node_id and the columns that were written."""
+        self._listeners.append(listener)
+
+    def _notify(self, user_id : int, written : list[dict] = (), deleted : list[str] = ()):
+        for listener in self._listeners:
+            listener(user_id, list(written), list(deleted))
 
     def _wrap_node_op(self, payload : NodeOp):
         """Wraps user_id and image_id fields of NodeOp for other special purpose models."""
@@ -14,36 +98,286 @@ class NodeService:
     def create_node(self, payload : NodeCreate):
         node_dump = self._wrap_node_op(payload)
         db_response = supabase.table("nodes").insert(node_dump).execute()
-
+        self._notify(payload.user_id, written=_strip_generated(db_response.data))
         return db_response
     
-    def update_node(self, payload : NodeUpdate):
-        node_dump = self._wrap_node_op(payload)
+    def update_node(self, payload : NodeUpdate, return_representation : bool = False):
+        """Writes only the fields explicitly set on payload, the row is returned only when asked for."""
+        changes = payload.model_dump(mode="json", exclude_unset=True)
+        for key_column in (df.user_id.value, df.node_id.value):
+            changes.pop(key_column, None)
+        if not changes:
+            raise HTTPException(status_code=400, detail="No fields to update")
+        changes["updated_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+        returning = ReturnMethod.representation if return_representation else ReturnMethod.minimal
         db_response = supabase.table("nodes")\
-            .update({df.image_id.value : node_dump[df.image_id.value], 
-                    df.description.value : node_dump[df.description.value]})\
-            .eq(df.user_id.value, node_dump[df.user_id.value]) \
-            .eq(df.node_id.value, node_dump[df.node_id.value]) \
+            .update(changes, returning=returning)\
+            .eq(df.user_id.value, payload.user_id) \
+            .eq(df.node_id.value, payload.node_id) \
             .execute()
-        
+        _strip_generated(db_response.data)
+        self._notify(payload.user_id, written=[{**changes, df.node_id.value : payload.node_id}])
         return db_response
     
     def delete_node(self, payload : NodeInfoDelete):
+        """Deletes the node together with every link that starts or ends at it."""
         node_dump = self._wrap_node_op(payload)
+        # Links first, so no dangling edge is left behind if the node delete fails
+        link_service.delete_links_of_nodes(payload.user_id, [payload.node_id])
         db_response = supabase.table("nodes") \
             .delete() \
             .eq(df.user_id.value, node_dump[df.user_id.value]) \
             .eq(df.node_id.value, node_dump[df.node_id.value]) \
             .execute()
-        
+        if db_response.data:
+            sync_service.record_deletes(payload.user_id, "node", [payload.node_id])
+            self._notify(payload.user_id, deleted=[payload.node_id])
         return db_response
+
+    def delete_nodes(self, user_id : int, node_ids : list[str]) -> dict[str, list]:
+        """Deletes many nodes and their links, links in smaller chunks (see delete_links_of_nodes)."""
+        node_ids = list(dict.fromkeys(str(node_id) for node_id in node_ids))
+        if len(node_ids) > MAX_BULK_ITEMS:
+            raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_ITEMS} items per request")
+        deleted_nodes, deleted_links = [], []
+        for ids in chunks(node_ids, BULK_CHUNK_SIZE):
+            links = link_service.delete_links_of_nodes(user_id, ids)
+            deleted_links.extend(link[link_df.link_id.value] for link in links)
+            db_response = supabase.table("nodes").delete()\
+                .eq(df.user_id.value, user_id).in_(df.node_id.value, ids).execute()
+            deleted_nodes.extend(row[df.node_id.value] for row in (db_response.data or []))
+        sync_service.record_deletes(user_id, "node", deleted_nodes)
+        self._notify(user_id, deleted=deleted_nodes)
+        return {"deleted_nodes": deleted_nodes, "deleted_links": deleted_links}
     
     def get_node_info(self, payload : NodeInfoDelete):
         node_dump = payload.model_dump()
-        db_response = supabase.table("nodes").select("*")\
+        db_response = supabase.table("nodes").select(",".join(NODE_COLUMNS))\
             .eq(df.user_id.value, node_dump[df.user_id.value]).eq(df.node_id.value, node_dump[df.node_id.value]).execute()
         
         return db_response
 
+    async def get_node_info_async(self, payload : NodeInfoDelete):
+        client = get_async_supabase()
+        if client is None:
+            return await node_pool.run(self.get_node_info, payload)
+        db_response = await client.table("nodes").select(",".join(NODE_COLUMNS))\
+            .eq(df.user_id.value, payload.user_id).eq(df.node_id.value, payload.node_id).execute()
+
+        return db_response
+
+    def bulk_create_nodes(self, user_id : int, items : list[dict[str, Any]]):
+        """Creates many nodes with chunked multi-row inserts, returns one result per item in input order."""
+        valid, results = _validate_items(NodeCreate, items, user_id)
+        for chunk in chunks(valid, BULK_CHUNK_SIZE):
+            rows = [payload.model_dump(mode="json") for _, payload in chunk]
+            try:
+                db_response = supabase.table("nodes").insert(rows).execute()
+                created = _strip_generated(db_response.data)
+            except Exception as e:
+                print(f" DATABASE ERROR: {e}")
+                results.extend({"index": index, "ok": False, "error": str(e)} for index, _ in chunk)
+                continue
+            for (index, _), node in zip(chunk, created):
+                results.append({"index": index, "ok": True, "node": node})
+            self._notify(user_id, written=created)
+
+        return sorted(results, key=lambda result: result["index"])
+
+    def bulk_update_nodes(self, user_id : int, items : list[dict[str, Any]]):
+        """Updates many nodes in chunked batches, returns one result per item in input order.
+
+        Only nodes the user owns are written; other node_ids get a per-item error."""
+        valid, results = _validate_items(NodeUpdate, items, user_id)
+        changes = []
+        for index, payload in valid:
+            change = payload.model_dump(mode="json", exclude_unset=True)
+            for key_column in (df.user_id.value, df.node_id.value):
+                change.pop(key_column, None)
+            if not change:  # same as update_node, nothing to write is an error rather than a bare updated_at
+                results.append({"index": index, "ok": False, "error": "No fields to update"})
+                continue
+            changes.append((index, payload.node_id, change))
+        results.extend(self._apply_changes(user_id, changes))
+
+        return sorted(results, key=lambda result: result["index"])
+
+    def update_positions(self, user_id : int, positions : list[NodePosition]):
+        """Saves the latest coordinates of many nodes, one batched update per chunk."""
+        changes = [(index, position.node_id,
+                    {df.position_x.value : position.position_x, df.position_y.value : position.position_y})
+                   for index, position in enumerate(positions)]
+        return self._apply_changes(user_id, changes)
+
+    def _apply_changes(self, user_id : int, changes : list[tuple[int, str, dict[str, Any]]]):
+        """Applies (index, node_id, columns) changes to the user's nodes, writing only those columns.
+
+        Each chunk is one apply_node_changes call (sql/node_bulk_update.sql) that updates the rows in
+        place, so columns a concurrent request wrote in the meantime are kept and updated_at is set
+        by the database. Unknown or foreign node_ids get a per-item error and are never written."""
+        merged : dict[str, dict[str, Any]] = {}
+        indices : dict[str, list[int]] = {}
+        for index, node_id, change in changes:
+            node_id = str(node_id)
+            merged[node_id] = {**merged.get(node_id, {}), **change}
+            indices.setdefault(node_id, []).append(index)
+
+        results = []
+        for ids in chunks(list(merged), BULK_CHUNK_SIZE):
+            try:
+                rows = self._write_changes(user_id, [(node_id, merged[node_id]) for node_id in ids])
+            except Exception as e:
+                print(f" DATABASE ERROR: {e}")
+                results.extend({"index": index, "ok": False, "error": str(e)}
+                               for node_id in ids for index in indices[node_id])
+                continue
+            updated = {str(row[df.node_id.value]) : row for row in _strip_generated(rows)}
+            self._notify(user_id, written=list(updated.values()))
+            for node_id in ids:
+                node = updated.get(node_id)
+                results.extend({"index": index, "ok": True, "node": node} if node is not None
+                               else {"index": index, "ok": False, "error": NODE_NOT_FOUND}
+                               for index in indices[node_id])
+
+        return sorted(results, key=lambda result: result["index"])
+
+    def _write_changes(self, user_id : int, batch : list[tuple[str, dict[str, Any]]]) -> list[dict]:
+        """Updated rows of one chunk of (node_id, columns) changes."""
+        if self.changes_rpc_available:
+            try:
+                params = {"p_user_id": user_id,
+                          "p_changes": [{**change, df.node_id.value : node_id} for node_id, change in batch]}
+                db_response = supabase.rpc("apply_node_changes", params).execute()
+                return db_response.data or []
+            except APIError as e:
+                if e.code != "PGRST202":
+                    raise
+                print("Warning: apply_node_changes function not found, updating nodes one by one")
+                self.changes_rpc_available = False
+
+        # Without the function: one partial update per node, still only the changed columns
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        rows = []
+        for node_id, change in batch:
+            db_response = supabase.table("nodes").update({**change, "updated_at": now})\
+                .eq(df.user_id.value, user_id)\
+                .eq(df.node_id.value, node_id)\
+                .execute()
+            rows.extend(db_response.data or [])
+        return rows
+
+    def _list_nodes_query(self, client, user_id : int, limit : int, cursor : str | None,
+                          fields : list[df] | None):
+        """Builds the page query on either the sync or the async client."""
+        query = client.table("nodes").select(_projection(fields))\
+            .eq(df.user_id.value, user_id)
+
+        if cursor:
+            created_at, node_id = _decode_cursor(cursor)
+            query = query.or_(f'created_at.lt."{created_at}",'
+                              f'and(created_at.eq."{created_at}",node_id.lt."{node_id}")')
+
+        # One extra row tells us whether another page exists without a count query
+        return query.order("created_at", desc=True)\
+            .order(df.node_id.value, desc=True)\
+            .limit(limit + 1)
+
+    def _to_page(self, rows : list[dict] | None, limit : int, sort_column : str = "created_at"):
+        rows = rows if rows else []
+        nodes = rows[:limit]
+        next_cursor = None
+        if len(rows) > limit:
+            last = nodes[-1]
+            next_cursor = _encode_cursor(last[sort_column], last[df.node_id.value])
+
+        return {"nodes": nodes, "next_cursor": next_cursor}
+
+    def list_nodes(self, user_id : int, limit : int = 40, cursor : str | None = None,
+                   fields : list[df] | None = None):
+        """Returns one page of the user's nodes, newest first, keyed on (created_at, node_id)."""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        db_response = self._list_nodes_query(supabase, user_id, limit, cursor, fields).execute()
+        return self._to_page(db_response.data, limit)
+
+    async def list_nodes_async(self, user_id : int, limit : int = 40, cursor : str | None = None,
+                               fields : list[df] | None = None):
+        """list_nodes on the async client, or on a worker thread when async mode is off."""
+        client = get_async_supabase()
+        if client is None:
+            return await node_pool.run(self.list_nodes, user_id, limit, cursor, fields)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        db_response = await self._list_nodes_query(client, user_id, limit, cursor, fields).execute()
+        return self._to_page(db_response.data, limit)
+
+    def list_all_nodes(self, user_id : int, fields : list[df] | None = None):
+        """Walks every page of list_nodes and returns all of the user's nodes."""
+        nodes, cursor = [], None
+        while True:
+            page = self.list_nodes(user_id=user_id, limit=MAX_PAGE_SIZE, cursor=cursor, fields=fields)
+            nodes.extend(page["nodes"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return nodes
+
+    async def list_all_nodes_async(self, user_id : int, fields : list[df] | None = None):
+        if get_async_supabase() is None:
+            return await node_pool.run(self.list_all_nodes, user_id, fields)
+        nodes, cursor = [], None
+        while True:
+            page = await self.list_nodes_async(user_id=user_id, limit=MAX_PAGE_SIZE, cursor=cursor, fields=fields)
+            nodes.extend(page["nodes"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return nodes
+
+    def timeline(self, user_id : int, start : datetime.datetime | None = None,
+                 end : datetime.datetime | None = None, limit : int = 40, cursor : str | None = None, descending : bool = False,
+                 fields : list[df] | None = None):
+        """One page of the user's nodes dated in [start, end), by custom_date falling back to created_at."""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        query = supabase.table("nodes").select(_projection(fields, TIMELINE_COLUMN))\
+            .eq(df.user_id.value, user_id)
+        if start is not None:
+            query = query.gte(TIMELINE_COLUMN, start.isoformat())
+        if end is not None:
+            query = query.lt(TIMELINE_COLUMN, end.isoformat())
+        if cursor:
+            timeline_at, node_id = _decode_cursor(cursor)
+            op = "lt" if descending else "gt"
+            query = query.or_(f'{TIMELINE_COLUMN}.{op}."{timeline_at}",'
+                              f'and({TIMELINE_COLUMN}.eq."{timeline_at}",node_id.{op}."{node_id}")')
+        db_response = query.order(TIMELINE_COLUMN, desc=descending)\
+            .order(df.node_id.value, desc=descending)\
+            .limit(limit + 1)\
+            .execute()
+        return self._to_page(db_response.data, limit, sort_column=TIMELINE_COLUMN)
+
+    def timeline_buckets(self, user_id : int, bucket : TimelineBucket, start : datetime.datetime | None = None,
+                         end : datetime.datetime | None = None) -> list[dict[str, Any]]:
+        """Node counts per UTC day, month or year in [start, end), oldest first."""
+        label_length = _BUCKET_LABEL_LENGTH[bucket]
+        params = {"p_user_id": user_id, "p_bucket": bucket,
+                  "p_start": start.isoformat() if start else None, "p_end": end.isoformat() if end else None}
+        try:
+            db_response = supabase.rpc("node_timeline_buckets", params).execute()
+            return [{"bucket": row["bucket"][:label_length], "count": row["count"]}
+                    for row in (db_response.data or [])]
+        except APIError as e:
+            if e.code != "PGRST202":
+                raise
+            print("Warning: node_timeline_buckets function not found, counting nodes here instead")
+
+        # Without sql/node_timeline.sql there is no timeline_at column either, so the dates are
+        # coalesced here from the two columns it is made of, paging through every node once
+        start, end = _as_utc(start), _as_utc(end)
+        counts : dict[str, int] = {}
+        for node in self.list_all_nodes(user_id, [df.custom_date]):
+            dated = _as_utc(_parse_timestamp(node.get(df.custom_date.value) or node["created_at"]))
+            if (start is not None and dated < start) or (end is not None and dated >= end):
+                continue
+            label = dated.isoformat()[:label_length]
+            counts[label] = counts.get(label, 0) + 1
+        return [{"bucket": label, "count": counts[label]} for label in sorted(counts)]
 
 node_service = NodeService()
\ No newline at end of file
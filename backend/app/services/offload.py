@@ -0,0 +1,122 @@
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+from typing import Any, Callable, TypeVar
+import asyncio
+import os
+import threading
+import time
+
+T = TypeVar("T")
+
+
+class BlockingPool:
+    """Bounded thread pool that async routes use to run blocking service calls off the event loop."""
+
+    def __init__(self, name : str, max_workers : int, max_queue : int = 0):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue  # 0 means unbounded
+        self._executor : ThreadPoolExecutor | None = None
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix=f"{self.name}-pool")
+            return self._executor
+
+    async def run(self, fn : Callable[..., T], *args : Any, **kwargs : Any) -> T:
+        """Runs fn(*args, **kwargs) on the pool and awaits its result."""
+        with self._lock:
+            if self.max_queue and self._queued >= self.max_queue:
+                self._rejected += 1
+                raise HTTPException(status_code=503, detail="Server is busy, please retry",
+                                    headers={"Retry-After": "1"})
+            self._queued += 1
+        submitted = time.perf_counter()
+        started = False
+
+        def call():
+            nonlocal started
+            waited = time.perf_counter() - submitted
+            with self._lock:
+                started = True
+                self._queued -= 1
+                self._running += 1
+                self._total_wait += waited
+                self._max_wait = max(self._max_wait, waited)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+
+        def release(_future):
+            # A call cancelled before a worker picked it up (shutdown, cancelled await) never ran
+            nonlocal started
+            with self._lock:
+                if not started:
+                    started = True
+                    self._queued -= 1
+
+        try:
+            future = self._get_executor().submit(call)
+        except RuntimeError:
+            release(None)
+            raise
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            started = self._completed + self._running
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queue_depth": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "avg_wait_ms": round(1000 * self._total_wait / started, 3) if started else 0.0,
+                "max_wait_ms": round(1000 * self._max_wait, 3),
+            }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _make_pool(name : str, default_workers : int, default_max_queue : int = 0) -> BlockingPool:
+    prefix = name.upper()
+    return BlockingPool(name=name,
+                        max_workers=int(os.environ.get(f"{prefix}_POOL_WORKERS", default_workers)),
+                        max_queue=int(os.environ.get(f"{prefix}_POOL_MAX_QUEUE", default_max_queue)))
+
+
+node_pool = _make_pool("nodes", 16)
+link_pool = _make_pool("links", 8)
+image_pool = _make_pool("images", 8)
+user_pool = _make_pool("users", 8)
+# Server-side graph layouts are CPU bound for seconds, kept apart so they can't starve node requests
+layout_pool = _make_pool("layout", 2, 4)
+
+pools = {pool.name : pool for pool in (node_pool, link_pool, image_pool, user_pool, layout_pool)}
+
+
+def pool_stats() -> dict[str, dict[str, Any]]:
+    return {name : pool.stats() for name, pool in pools.items()}
+
+
+def shutdown_pools() -> None:
+    for pool in pools.values():
+        pool.shutdown()
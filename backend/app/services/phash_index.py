@@ -0,0 +1,93 @@
+from typing import Iterable
+import threading
+
+
+def hamming(a : int, b : int) -> int:
+    return (a ^ b).bit_count()
+
+
+class _BKNode:
+    __slots__ = ("key", "items", "children")
+
+    def __init__(self, key : int):
+        self.key = key
+        self.items : set[str] = set()
+        self.children : dict[int, "_BKNode"] = {}
+
+
+class BKTree:
+    """BK-tree over 64 bit perceptual hashes of one user's images, keyed by Hamming distance.
+
+    A radius query only descends into children whose edge distance d satisfies
+    |d - distance(query, node)| <= radius (triangle inequality), so a small radius visits a
+    small part of the tree instead of every image. Images sharing a hash share a node."""
+
+    def __init__(self, entries : Iterable[tuple[str, int]] = ()):
+        self._root : _BKNode | None = None
+        self._hashes : dict[str, int] = {}
+        self._lock = threading.Lock()
+        for item, key in entries:
+            self.add(item, key)
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def __contains__(self, item : str) -> bool:
+        return item in self._hashes
+
+    def get(self, item : str) -> int | None:
+        return self._hashes.get(item)
+
+    def add(self, item : str, key : int) -> None:
+        with self._lock:
+            if self._hashes.get(item) == key:
+                return
+            self._discard(item)
+            self._hashes[item] = key
+            if self._root is None:
+                self._root = _BKNode(key)
+                self._root.items.add(item)
+                return
+            node = self._root
+            while True:
+                distance = hamming(key, node.key)
+                if distance == 0:
+                    node.items.add(item)
+                    return
+                child = node.children.get(distance)
+                if child is None:
+                    child = node.children[distance] = _BKNode(key)
+                    child.items.add(item)
+                    return
+                node = child
+
+    def remove(self, item : str) -> None:
+        with self._lock:
+            self._discard(item)
+
+    def _discard(self, item : str) -> None:
+        # The node stays in place as a routing point, only the item leaves it
+        key = self._hashes.pop(item, None)
+        node = self._root
+        while key is not None and node is not None:
+            distance = hamming(key, node.key)
+            if distance == 0:
+                node.items.discard(item)
+                return
+            node = node.children.get(distance)
+
+    def search(self, key : int, radius : int, limit : int | None = None) -> list[tuple[str, int]]:
+        """(item, distance) pairs within radius of key, closest first."""
+        found : list[tuple[str, int]] = []
+        with self._lock:
+            stack = [self._root] if self._root is not None else []
+            while stack:
+                node = stack.pop()
+                distance = hamming(key, node.key)
+                if distance <= radius:
+                    found.extend((item, distance) for item in node.items)
+                for edge, child in node.children.items():
+                    if distance - radius <= edge <= distance + radius:
+                        stack.append(child)
+        found.sort(key=lambda match: (match[1], match[0]))
+        return found[:limit] if limit is not None else found
@@ -0,0 +1,63 @@
+from models.node import NodePosition
+from services.node_services import node_service, NODE_NOT_FOUND
+from services.offload import node_pool
+from typing import Any, Awaitable, Callable
+import asyncio
+import os
+
+# How long moves are collected before the latest coordinates are written
+POSITION_FLUSH_INTERVAL = float(os.environ.get("POSITION_FLUSH_INTERVAL", 0.5))
+
+
+class PositionCoalescer:
+    """Collects node moves of one connection and writes only the latest coordinates per node.
+
+    Moves are flushed as one batched update every POSITION_FLUSH_INTERVAL seconds
+    and once more when the connection closes."""
+
+    def __init__(self, user_id : int, flush_interval : float | None = None,
+                 on_flush : Callable[[list[dict[str, Any]]], Awaitable[None]] | None = None):
+        self.user_id = user_id
+        self.flush_interval = flush_interval if flush_interval is not None else POSITION_FLUSH_INTERVAL
+        self.on_flush = on_flush
+        self._pending : dict[str, NodePosition] = {}
+        self._lock = asyncio.Lock()
+        self.received = 0
+        self.written = 0
+
+    def add(self, position : NodePosition) -> None:
+        # A newer move of the same node replaces the buffered one
+        self._pending[position.node_id] = position
+        self.received += 1
+
+    async def flush(self) -> list[dict[str, Any]]:
+        async with self._lock:
+            if not self._pending:
+                return []
+            positions = list(self._pending.values())
+            self._pending.clear()
+            try:
+                results = await node_pool.run(node_service.update_positions, self.user_id, positions)
+            except Exception:
+                # Keep the moves for the next flush unless the node has moved again since
+                for position in positions:
+                    self._pending.setdefault(position.node_id, position)
+                raise
+            # Chunks whose write failed come back as per-item errors, keep those moves for the next flush
+            for result in results:
+                if not result["ok"] and result.get("error") != NODE_NOT_FOUND:
+                    position = positions[result["index"]]
+                    self._pending.setdefault(position.node_id, position)
+            self.written += sum(1 for result in results if result["ok"])
+        if self.on_flush is not None:
+            await self.on_flush(results)
+        return results
+
+    async def run(self) -> None:
+        """Flushes on a timer until cancelled."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Warning: Position flush failed, retrying on next tick: {e}")
@@ -0,0 +1,115 @@
+from typing import Any, Iterable
+import bisect
+import math
+import re
+import threading
+
+# How much a term counts depending on where it occurs, a title hit outranks a description hit
+FIELD_WEIGHTS = {"title": 3.0, "tags": 2.0, "description": 1.0}
+PREFIX_WEIGHT = 0.5  # a query's last word matching only the start of a term, e.g. while typing
+
+_TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text : str | None) -> list[str]:
+    return _TOKEN.findall(text.casefold()) if text else []
+
+def _prefixed(sorted_terms : list[str], prefix : str) -> list[str]:
+    """Entries of a sorted list starting with prefix, found with two binary searches."""
+    start = bisect.bisect_left(sorted_terms, prefix)
+    end = bisect.bisect_left(sorted_terms, prefix + "\U0010ffff")
+    return sorted_terms[start:end]
+
+
+class InvertedIndex:
+    """Term -> {node_id: weight} postings over one user's node titles, tags and descriptions."""
+
+    def __init__(self, rows : Iterable[dict] = ()):
+        self.docs : dict[str, dict[str, Any]] = {}
+        self.postings : dict[str, dict[str, float]] = {}
+        self.tag_postings : dict[str, set[str]] = {}
+        self._terms : list[str] = []  # sorted keys of postings, for prefix lookups
+        self._tags : list[str] = []
+        self._lock = threading.Lock()
+        for row in rows:
+            self.upsert(row)
+
+    def upsert(self, row : dict[str, Any]) -> None:
+        """Indexes a node row, fields missing from row keep their previously indexed value."""
+        node_id = str(row["node_id"])
+        with self._lock:
+            changes = {field : row[field] for field in FIELD_WEIGHTS if field in row}
+            doc = {**self.docs.get(node_id, {}), **changes}
+            self._unindex(node_id)
+            self.docs[node_id] = doc
+            weights : dict[str, float] = {}
+            for field, weight in FIELD_WEIGHTS.items():
+                value = doc.get(field)
+                text = " ".join(value) if isinstance(value, list) else value
+                for term in tokenize(text):
+                    weights[term] = weights.get(term, 0.0) + weight
+            for term, weight in weights.items():
+                if term not in self.postings:
+                    self.postings[term] = {}
+                    bisect.insort(self._terms, term)
+                self.postings[term][node_id] = weight
+            for tag in {tag.casefold() for tag in doc.get("tags") or []}:
+                if tag not in self.tag_postings:
+                    self.tag_postings[tag] = set()
+                    bisect.insort(self._tags, tag)
+                self.tag_postings[tag].add(node_id)
+
+    def remove(self, node_id : str) -> None:
+        with self._lock:
+            self._unindex(str(node_id))
+            self.docs.pop(str(node_id), None)
+
+    def _unindex(self, node_id : str) -> None:
+        doc = self.docs.get(node_id)
+        if doc is None:
+            return
+        for field in FIELD_WEIGHTS:
+            value = doc.get(field)
+            for term in tokenize(" ".join(value) if isinstance(value, list) else value):
+                postings = self.postings.get(term)
+                if postings is not None and postings.pop(node_id, None) is not None and not postings:
+                    del self.postings[term]
+                    del self._terms[bisect.bisect_left(self._terms, term)]
+        for tag in {tag.casefold() for tag in doc.get("tags") or []}:
+            nodes = self.tag_postings.get(tag)
+            if nodes is not None:
+                nodes.discard(node_id)
+                if not nodes:
+                    del self.tag_postings[tag]
+                    del self._tags[bisect.bisect_left(self._tags, tag)]
+
+    def search(self, query : str | None = None, tag_prefix : str | None = None,
+               limit : int = 20) -> list[tuple[str, float]]:
+        """(node_id, score) pairs, best first. Every query word must match, the last one as a prefix."""
+        tokens = tokenize(query)
+        with self._lock:
+            candidates : set[str] | None = None
+            if tag_prefix:
+                candidates = set()
+                for tag in _prefixed(self._tags, tag_prefix.casefold().lstrip("#")):
+                    candidates |= self.tag_postings[tag]
+            scores : dict[str, float] = {}
+            doc_count = max(len(self.docs), 1)
+            for position, token in enumerate(tokens):
+                terms = _prefixed(self._terms, token) if position == len(tokens) - 1 else [token]
+                matches : dict[str, float] = {}
+                for term in terms:
+                    postings = self.postings.get(term)
+                    if not postings:
+                        continue
+                    idf = math.log(1 + doc_count / len(postings))
+                    factor = 1.0 if term == token else PREFIX_WEIGHT
+                    for node_id, weight in postings.items():
+                        matches[node_id] = max(matches.get(node_id, 0.0), weight * idf * factor)
+                candidates = set(matches) if candidates is None else candidates & matches.keys()
+                for node_id in candidates:
+                    scores[node_id] = scores.get(node_id, 0.0) + matches[node_id]
+                if not candidates:
+                    break
+            ranked = sorted(candidates or (), key=lambda node_id: (-scores.get(node_id, 0.0), node_id))
+            return [(node_id, round(scores.get(node_id, 0.0), 4)) for node_id in ranked[:limit]]
@@ -0,0 +1,96 @@
+from models.node import NodeDataFields as df, NODE_COLUMNS
+from db.db import supabase
+from services.node_services import node_service, MAX_PAGE_SIZE
+from services.search_index import InvertedIndex
+from services.cache import TTLCache
+from fastapi import HTTPException
+from postgrest.exceptions import APIError
+from typing import Any
+import os
+import threading
+
+# "postgres" ranks with the search_nodes function from sql/node_search.sql, "local" with an
+# in-process inverted index, "auto" tries postgres and falls back to local when it is missing
+NODE_SEARCH_BACKEND = os.environ.get("NODE_SEARCH_BACKEND", "auto").lower()
+SEARCH_INDEX_CACHE_USERS = int(os.environ.get("SEARCH_INDEX_CACHE_USERS", 256))
+SEARCH_INDEX_TTL = float(os.environ.get("SEARCH_INDEX_TTL", 600))
+SEARCH_FIELDS = [df.title, df.description, df.tags]
+
+
+class SearchService:
+    def __init__(self):
+        self._indexes = TTLCache(maxsize=SEARCH_INDEX_CACHE_USERS, default_ttl=SEARCH_INDEX_TTL)
+        self._versions : dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.postgres_available = NODE_SEARCH_BACKEND != "local"
+        node_service.subscribe(self.apply)
+
+    def apply(self, user_id, written : list[dict], deleted : list[str]) -> None:
+        """Keeps a cached index in step with node writes."""
+        key = str(user_id)
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+        index = self._indexes.get(key)
+        if index is None:
+            return
+        for row in written:
+            if df.node_id.value in row:
+                index.upsert(row)
+        for node_id in deleted:
+            index.remove(node_id)
+
+    def get_index(self, user_id) -> InvertedIndex:
+        key = str(user_id)
+        index = self._indexes.get(key)
+        if index is None:
+            with self._lock:
+                version = self._versions.get(key, 0)
+            index = InvertedIndex(node_service.list_all_nodes(user_id, fields=SEARCH_FIELDS))
+            with self._lock:
+                # A write during the load may be missing from the rows, serve it once but don't keep it
+                if self._versions.get(key, 0) == version:
+                    self._indexes.set(key, index)
+        return index
+
+    def _search_postgres(self, user_id : int, query : str | None, tag_prefix : str | None,
+                         limit : int) -> list[dict[str, Any]]:
+        params = {"p_user_id": user_id, "p_query": query or "",
+                  "p_tag_prefix": tag_prefix or "", "p_limit": limit}
+        db_response = supabase.rpc("search_nodes", params).execute()
+        return [{**row["node"], "rank": row["rank"]} for row in (db_response.data or [])]
+
+    def _search_local(self, user_id : int, query : str | None, tag_prefix : str | None,
+                      limit : int) -> list[dict[str, Any]]:
+        ranked = self.get_index(user_id).search(query, tag_prefix, limit)
+        if not ranked:
+            return []
+        db_response = supabase.table("nodes").select(",".join(NODE_COLUMNS))\
+            .eq(df.user_id.value, user_id)\
+            .in_(df.node_id.value, [node_id for node_id, _ in ranked])\
+            .execute()
+        rows = {str(row[df.node_id.value]) : row for row in (db_response.data or [])}
+        return [{**rows[node_id], "rank": score} for node_id, score in ranked if node_id in rows]
+
+    def search(self, user_id : int, query : str | None = None, tag_prefix : str | None = None,
+               limit : int = 20) -> list[dict[str, Any]]:
+        """Ranked nodes matching q and/or a tag prefix, each row carries its rank.
+
+        Every word of query has to match (the last one may be a prefix, for search-as-you-type)."""
+        if not (query or "").strip() and not (tag_prefix or "").strip():
+            raise HTTPException(status_code=400, detail="Provide q or tag to search")
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        tag_prefix = (tag_prefix or "").strip().lstrip("#") or None
+        if self.postgres_available:
+            try:
+                return self._search_postgres(user_id, query, tag_prefix, limit)
+            except APIError as e:
+                # PGRST202: the function is not in the schema cache, i.e. the migration was not applied
+                if NODE_SEARCH_BACKEND == "postgres" or e.code != "PGRST202":
+                    print(f" DATABASE ERROR: {e}")
+                    raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
+                print("Warning: search_nodes function not found, searching with the local index")
+                self.postgres_available = False
+        return self._search_local(user_id, query, tag_prefix, limit)
+
+
+search_service = SearchService()
@@ -1,7 +1,9 @@
 from datetime import datetime, timedelta, timezone
 from typing import Annotated, Any
 import os
+import hashlib
 import secrets
+import threading
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -10,8 +12,13 @@ from fastapi import Depends, APIRouter, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jwt.exceptions import InvalidTokenError
 from pwdlib import PasswordHash
+from pwdlib.hashers.argon2 import Argon2Hasher
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
 from pydantic import BaseModel
 from supabase import Client
+from services.cache import TTLCache
 
 # to get a string like this run:
 # openssl rand -hex 32
@@ -19,7 +26,81 @@ SECRET_KEY = os.environ.get("SECRET_KEY")
 ALGORITHM = os.environ.get("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("ACCESS_TOKEN_EXPIRE_MINUTES", 10080))  # Default: 7 days
 
-password_hash = PasswordHash.recommended()
+# Argon2 cost per deployment, defaults match PasswordHash.recommended()
+ARGON2_TIME_COST = int(os.environ.get("ARGON2_TIME_COST", 3))
+ARGON2_MEMORY_COST = int(os.environ.get("ARGON2_MEMORY_COST", 65536))  # KiB
+ARGON2_PARALLELISM = int(os.environ.get("ARGON2_PARALLELISM", 4))
+# Worker processes for hashing (0 hashes inline) and how many hashes may be pending at once
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", min(os.cpu_count() or 1, 4)))
+HASH_MAX_PENDING = int(os.environ.get("HASH_MAX_PENDING", 32))
+# Decoded tokens kept in memory, entries expire with the token's own exp
+JWT_CACHE_SIZE = int(os.environ.get("JWT_CACHE_SIZE", 10000))
+JWT_CACHE_TTL_NO_EXP = 300  # seconds, for tokens that carry no exp claim
+
+password_hash = PasswordHash((Argon2Hasher(time_cost=ARGON2_TIME_COST,
+                                           memory_cost=ARGON2_MEMORY_COST,
+                                           parallelism=ARGON2_PARALLELISM),))
+
+
+def _hash_password(password: str) -> str:
+    return password_hash.hash(password)
+
+def _verify_password(plain_password: str, hashed_password: str) -> bool:
+    return password_hash.verify(plain_password, hashed_password)
+
+
+class HashingEngine:
+    """Runs Argon2 in worker processes and sheds load once too many hashes are pending.
+
+    Routes take a slot with admit() before queueing the call on user_pool, so a burst is turned
+    away with 503 right away instead of waiting behind the pool's threads."""
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self._executor: ProcessPoolExecutor | None = None
+        self._executor_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending) if max_pending > 0 else None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    @contextmanager
+    def admit(self):
+        """Holds one of the max_pending slots for the block, raises 503 when none is free."""
+        if self._slots is not None and not self._slots.acquire(blocking=False):
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many requests in progress, please retry",
+                headers={"Retry-After": "1"},
+            )
+        try:
+            yield
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+    def run(self, fn, *args):
+        """Blocks the calling (worker) thread until fn(*args) finishes in a hashing process."""
+        if self.workers <= 0:
+            return fn(*args)
+        try:
+            return self._get_executor().submit(fn, *args).result()
+        except BrokenProcessPool:
+            self.shutdown()
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Password hashing is unavailable, please retry")
+
+    def shutdown(self):
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+hashing_engine = HashingEngine(workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/users/get_access_token")
 
@@ -30,13 +111,25 @@ class Token(BaseModel):
 
 class SecurityService:
     def __init__(self):
-        pass
+        self.token_cache = TTLCache(maxsize=JWT_CACHE_SIZE, default_ttl=JWT_CACHE_TTL_NO_EXP)
+
+    def _decode_claims(self, token: str) -> dict[str, Any]:
+        """Decoded sub and type of a token, served from token_cache while the token is valid.
+
+        Raises InvalidTokenError like jwt.decode; failed decodes are never cached."""
+        digest = hashlib.sha256(token.encode("utf-8")).digest()
+        claims = self.token_cache.get(digest)
+        if claims is None:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            claims = {"sub": payload.get("sub"), "type": payload.get("type")}
+            self.token_cache.set(digest, claims, expires_at=payload.get("exp"))
+        return claims
 
     def create_password_hash(self, password: str) -> str:
-        return password_hash.hash(password)
+        return hashing_engine.run(_hash_password, password)
     
     def verify_password(self, plain_password, hashed_password):
-        return password_hash.verify(plain_password, hashed_password)
+        return hashing_engine.run(_verify_password, plain_password, hashed_password)
 
     # services/security.py
 
@@ -60,8 +153,8 @@ class SecurityService:
                     headers={"WWW-Authenticate": "Bearer"},
                 )
         try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            user_id = payload.get("sub")
+            claims = self._decode_claims(token)
+            user_id = claims["sub"]
             if user_id is None:
                 raise creditenitals_exception
             return user_id
@@ -85,9 +178,9 @@ class SecurityService:
     def verify_reset_token(self, token: str) -> int:
         """Verify password reset token and return user_id"""
         try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            user_id: str = payload.get("sub")
-            token_type: str = payload.get("type")
+            claims = self._decode_claims(token)
+            user_id: str = claims["sub"]
+            token_type: str = claims["type"]
 
             if user_id is None or token_type != "password_reset":
                 raise HTTPException(
@@ -0,0 +1,205 @@
+from db.db import supabase
+from services.media_pipeline import media_pipeline
+from services.phash_index import BKTree
+from services.cache import TTLCache
+from fastapi import HTTPException
+from postgrest.exceptions import APIError
+from typing import Any
+import io
+import os
+import threading
+
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:  # no hashes are computed and /images/similar answers 503
+    PIL_AVAILABLE = False
+
+# Bits that may differ between two 64 bit dHashes for the images to count as near-duplicates
+SIMILAR_DEFAULT_RADIUS = int(os.environ.get("SIMILAR_DEFAULT_RADIUS", 10))
+SIMILAR_MAX_RADIUS = 20
+SIMILAR_INDEX_CACHE_USERS = int(os.environ.get("SIMILAR_INDEX_CACHE_USERS", 256))
+SIMILAR_INDEX_TTL = float(os.environ.get("SIMILAR_INDEX_TTL", 600))
+SIMILAR_BACKFILL_BATCH = 50  # older images without a hash scheduled per index load
+SIMILAR_LOAD_PAGE_SIZE = 1000  # images rows per request while a tree is loaded
+
+_HASH_BITS = 64
+
+
+def dhash(data : bytes) -> int:
+    """64 bit difference hash: each bit says whether a pixel of a 9x8 grayscale thumbnail is
+    brighter than its right neighbour. Survives resizing, recompression and small edits.
+
+    Module level so that it can run in a worker process."""
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("L", (64, 64))
+        small = ImageOps.exif_transpose(image).convert("L").resize((9, 8), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
+
+def _to_signed(value : int) -> int:
+    """Postgres bigint is signed, the top bit of the hash becomes the sign."""
+    return value - (1 << _HASH_BITS) if value >= 1 << (_HASH_BITS - 1) else value
+
+def _to_unsigned(value : int) -> int:
+    return value & ((1 << _HASH_BITS) - 1)
+
+
+class SimilarityService:
+    def __init__(self):
+        self.enabled = PIL_AVAILABLE
+        self.column_available = True  # images.phash exists, turned off on the first miss
+        self._trees = TTLCache(maxsize=SIMILAR_INDEX_CACHE_USERS, default_ttl=SIMILAR_INDEX_TTL)
+        self._versions : dict[str, int] = {}
+        self._scheduled = TTLCache(maxsize=10000, default_ttl=SIMILAR_INDEX_TTL)
+        # Per user, the images found without a hash that have not been hashed since (kept with the tree)
+        self._unhashed = TTLCache(maxsize=SIMILAR_INDEX_CACHE_USERS, default_ttl=SIMILAR_INDEX_TTL)
+        self._lock = threading.Lock()
+
+    def _bump(self, key : str) -> None:
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+    def _missing_column(self, e : APIError) -> bool:
+        # 42703 / PGRST204: unknown column, i.e. sql/image_phash.sql was not applied
+        if e.code not in ("42703", "PGRST204"):
+            return False
+        print("Warning: images.phash not found, similar image search is off")
+        self.column_available = False
+        return True
+
+    def build(self, user_id : int, file_name : str, data : bytes) -> int | None:
+        """Upload hook: hashes the image in a worker process, stores it and adds it to a cached tree."""
+        if not self.enabled or not self.column_available:
+            return None
+        phash = media_pipeline.cpu(dhash, data)
+        try:
+            supabase.table("images").update({"phash": _to_signed(phash)})\
+                .eq("user_id", user_id)\
+                .eq("file_name", file_name)\
+                .execute()
+        except APIError as e:
+            if self._missing_column(e):
+                return None
+            raise
+        key = str(user_id)
+        self._bump(key)
+        self._discard_unhashed(key, file_name)
+        tree = self._trees.get(key)
+        if tree is not None:
+            tree.add(file_name, phash)
+        return phash
+
+    def forget(self, user_id : int, file_name : str) -> None:
+        key = str(user_id)
+        self._bump(key)
+        self._discard_unhashed(key, file_name)
+        tree = self._trees.get(key)
+        if tree is not None:
+            tree.remove(file_name)
+
+    def _discard_unhashed(self, key : str, file_name : str) -> None:
+        with self._lock:
+            unhashed = self._unhashed.get(key)
+            if unhashed is not None:
+                unhashed.discard(file_name)
+
+    def pending(self, user_id : int) -> list[str]:
+        """The user's images that were found without a hash and are still waiting for one."""
+        with self._lock:
+            return sorted(self._unhashed.get(str(user_id)) or ())
+
+    def _backfill(self, user_id : int, file_name : str) -> int | None:
+        try:
+            data = supabase.storage.from_("images_0").download(f"{user_id}/{file_name}")
+            return self.build(user_id, file_name, data)
+        finally:
+            # Files that can't be hashed (not an image, gone from storage) are not waited for either
+            self._discard_unhashed(str(user_id), file_name)
+
+    def _schedule(self, user_id : int, file_names : list[str]) -> None:
+        for file_name in file_names[:SIMILAR_BACKFILL_BATCH]:
+            task = (user_id, file_name)
+            if self._scheduled.get(task) is not None:
+                continue
+            self._scheduled.set(task, True)
+            if media_pipeline.background(self._backfill, user_id, file_name) is None:
+                self._scheduled.delete(task)
+                return
+
+    def get_tree(self, user_id : int) -> tuple[BKTree, list[str]]:
+        """The user's cached tree, and the images that have no hash yet (see pending)."""
+        key = str(user_id)
+        tree = self._trees.get(key)
+        if tree is not None:
+            return tree, self.pending(user_id)
+        with self._lock:
+            version = self._versions.get(key, 0)
+        tree, unhashed = self._load(user_id)
+        with self._lock:
+            # A hash written during the load may be missing from the rows, serve it once but don't keep it
+            if self._versions.get(key, 0) == version:
+                self._trees.set(key, tree)
+                self._unhashed.set(key, set(unhashed))
+        return tree, unhashed
+
+    def _load(self, user_id : int) -> tuple[BKTree, list[str]]:
+        """Reads the user's hashes SIMILAR_LOAD_PAGE_SIZE rows at a time, keyed on file_name."""
+        tree, unhashed, last = BKTree(), [], None
+        while True:
+            query = supabase.table("images").select("file_name", "phash").eq("user_id", user_id)
+            if last is not None:
+                query = query.gt("file_name", last)
+            try:
+                db_response = query.order("file_name").limit(SIMILAR_LOAD_PAGE_SIZE).execute()
+            except APIError as e:
+                if self._missing_column(e):
+                    raise HTTPException(status_code=503, detail="Similar image search is not set up")
+                raise
+            rows = db_response.data or []
+            for row in rows:
+                if row["phash"] is None:
+                    unhashed.append(row["file_name"])
+                else:
+                    tree.add(row["file_name"], _to_unsigned(row["phash"]))
+            if len(rows) < SIMILAR_LOAD_PAGE_SIZE:
+                return tree, unhashed
+            last = rows[-1]["file_name"]
+
+    def similar(self, user_id : int, file_name : str, radius : int | None = None,
+                limit : int = 50) -> dict[str, Any]:
+        """Near-duplicates of file_name among the user's images, closest first.
+
+        pending is set while file_name (or some of the user's older images) are still being hashed."""
+        if not self.enabled or not self.column_available:
+            raise HTTPException(status_code=503, detail="Similar image search is not available")
+        radius = SIMILAR_DEFAULT_RADIUS if radius is None else max(0, min(radius, SIMILAR_MAX_RADIUS))
+        tree, unhashed = self.get_tree(user_id)
+        self._schedule(user_id, unhashed)
+        phash = tree.get(file_name)
+        if phash is None:
+            if file_name not in unhashed and not self._exists(user_id, file_name):
+                raise HTTPException(status_code=404, detail="Image not found")
+            self._schedule(user_id, [file_name])
+            return {"file_name": file_name, "pending": True, "similar": []}
+        matches = tree.search(phash, radius, limit + 1)
+        similar = [{"file_name": name, "distance": distance}
+                   for name, distance in matches if name != file_name][:limit]
+        return {"file_name": file_name, "pending": bool(unhashed), "similar": similar}
+
+    def _exists(self, user_id : int, file_name : str) -> bool:
+        db_response = supabase.table("images").select("file_name")\
+            .eq("user_id", user_id)\
+            .eq("file_name", file_name)\
+            .limit(1)\
+            .execute()
+        return bool(db_response.data)
+
+
+similarity_service = SimilarityService()
+if similarity_service.enabled:
+    media_pipeline.add_upload_hook(similarity_service.build)
@@ -0,0 +1,105 @@
+from models.node import NODE_COLUMNS
+from db.db import supabase
+from services.offload import node_pool, link_pool, image_pool
+from fastapi import HTTPException
+from typing import Any, Iterable, Literal
+import asyncio
+import datetime
+import os
+
+Entity = Literal["node", "link", "image"]
+
+# Rows committed just before a sync may carry a slightly older timestamp (clock skew between the app
+# and the database, transactions still in flight), the watermark handed out trails "now" by this much
+SYNC_WATERMARK_LAG = float(os.environ.get("SYNC_WATERMARK_LAG", 5))
+# Tombstones older than this may have been pruned, older watermarks get a full resync instead
+SYNC_TOMBSTONE_RETENTION_DAYS = int(os.environ.get("SYNC_TOMBSTONE_RETENTION_DAYS", 30))
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def _parse_since(since : str) -> datetime.datetime:
+    """ISO 8601 timestamp or epoch milliseconds (the "version" of a previous sync) as an aware datetime."""
+    try:
+        if since.isdigit():
+            return datetime.datetime.fromtimestamp(int(since) / 1000, tz=datetime.timezone.utc)
+        parsed = datetime.datetime.fromisoformat(since.replace("Z", "+00:00"))
+    except (ValueError, OverflowError):
+        raise HTTPException(status_code=400, detail="since must be an ISO timestamp or a version")
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+
+class SyncService:
+    def __init__(self):
+        pass
+
+    def record_deletes(self, user_id : int, entity : Entity, entity_ids : Iterable[Any]) -> None:
+        """Writes one tombstone per deleted row so /sync/changes can tell clients to drop it."""
+        deleted_at = _now().isoformat()
+        rows = [{"user_id": user_id, "entity": entity, "entity_id": str(entity_id), "deleted_at": deleted_at}
+                for entity_id in entity_ids]
+        if not rows:
+            return
+        try:
+            supabase.table("tombstones").insert(rows).execute()
+        except Exception as e:
+            # The delete itself went through, a missing tombstone only costs clients a stale row
+            print(f"Warning: Could not record {entity} tombstones for user {user_id}: {e}")
+
+    def changed_nodes(self, user_id : int, since : str) -> list[dict]:
+        db_response = supabase.table("nodes").select(",".join(NODE_COLUMNS))\
+            .eq("user_id", user_id)\
+            .or_(f'updated_at.gt."{since}",created_at.gt."{since}"')\
+            .execute()
+        return db_response.data if db_response.data else []
+
+    def changed_links(self, user_id : int, since : str) -> list[dict]:
+        db_response = supabase.table("nodelinks").select("*")\
+            .eq("user_id", user_id)\
+            .gt("created_at", since)\
+            .execute()
+        return db_response.data if db_response.data else []
+
+    def changed_images(self, user_id : int, since : str) -> list[dict]:
+        db_response = supabase.table("images").select("image_id", "file_name", "created_at")\
+            .eq("user_id", user_id)\
+            .gt("created_at", since)\
+            .execute()
+        return db_response.data if db_response.data else []
+
+    def deleted_since(self, user_id : int, since : str) -> dict[str, list[str]]:
+        db_response = supabase.table("tombstones").select("entity", "entity_id")\
+            .eq("user_id", user_id)\
+            .gt("deleted_at", since)\
+            .execute()
+        deleted = {"nodes": [], "links": [], "images": []}
+        for row in db_response.data or []:
+            deleted[f'{row["entity"]}s'].append(row["entity_id"])
+        return deleted
+
+    async def changes(self, user_id : int, since : str | None) -> dict[str, Any]:
+        """Rows created or updated and ids deleted after since, plus the watermark for the next call.
+
+        Without since (or when it predates tombstone retention) full_resync is set and the client
+        should list everything once, then continue from the returned watermark."""
+        watermark = _now() - datetime.timedelta(seconds=SYNC_WATERMARK_LAG)
+        result : dict[str, Any] = {"watermark": watermark.isoformat(),
+                                   "version": str(int(watermark.timestamp() * 1000))}
+        since_at = _parse_since(since) if since else None
+        retention = _now() - datetime.timedelta(days=SYNC_TOMBSTONE_RETENTION_DAYS)
+        if since_at is None or since_at < retention:
+            return {**result, "full_resync": True}
+
+        since_iso = since_at.isoformat()
+        nodes, links, images, deleted = await asyncio.gather(
+            node_pool.run(self.changed_nodes, user_id, since_iso),
+            link_pool.run(self.changed_links, user_id, since_iso),
+            image_pool.run(self.changed_images, user_id, since_iso),
+            node_pool.run(self.deleted_since, user_id, since_iso),
+        )
+        return {**result, "full_resync": False, "nodes": nodes, "links": links,
+                "images": images, "deleted": deleted}
+
+
+sync_service = SyncService()
@@ -0,0 +1,9 @@
+-- SHA-256 of each image's bytes, so an image the user already has is reused instead of stored again.
+-- Run once in the Supabase SQL editor. Rows from before this migration are hashed as they are
+-- re-uploaded; until the column exists uploads are simply not deduplicated.
+
+alter table images add column if not exists content_sha256 text;
+
+-- One index lookup per upload: "does this user already have these bytes?"
+create index if not exists images_user_sha256_idx on images (user_id, content_sha256)
+    where content_sha256 is not null;
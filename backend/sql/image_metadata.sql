@@ -0,0 +1,45 @@
+-- EXIF metadata of uploads (width, height, orientation, taken_at, camera) and the capture time on its own
+-- column for sorting. Run once in the Supabase SQL editor.
+
+alter table images add column if not exists metadata jsonb;
+alter table images add column if not exists taken_at timestamptz;
+
+-- Saves a batch of parsed headers in one call and dates the nodes showing those images,
+-- custom_date values the user entered are never overwritten
+create or replace function apply_image_metadata(p_rows jsonb)
+returns void
+language sql volatile as $$
+    with batch as (
+        select * from jsonb_to_recordset(p_rows)
+            as r(user_id bigint, file_name text, metadata jsonb, taken_at timestamptz)
+    ), saved as (
+        update images i
+        set metadata = b.metadata, taken_at = b.taken_at
+        from batch b
+        where i.user_id = b.user_id and i.file_name = b.file_name
+    )
+    update nodes n
+    set custom_date = b.taken_at, updated_at = now()
+    from batch b
+    where n.user_id = b.user_id and n.image_id = b.file_name
+      and n.custom_date is null and b.taken_at is not null;
+$$;
+
+-- Nodes created after their image was ingested take its capture time as custom_date
+create or replace function nodes_default_custom_date()
+returns trigger
+language plpgsql as $$
+begin
+    if new.custom_date is null and new.image_id is not null then
+        select taken_at into new.custom_date
+        from images
+        where user_id = new.user_id and file_name = new.image_id and taken_at is not null
+        limit 1;
+    end if;
+    return new;
+end;
+$$;
+
+drop trigger if exists nodes_default_custom_date on nodes;
+create trigger nodes_default_custom_date before insert on nodes
+    for each row execute function nodes_default_custom_date();
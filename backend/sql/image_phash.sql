@@ -0,0 +1,5 @@
+-- 64 bit perceptual hash (dHash) of each image for GET /images/similar, stored as a signed bigint.
+-- Run once in the Supabase SQL editor. Hashes are filled in the background after each upload,
+-- older images are hashed the first time their owner searches for similar images.
+
+alter table images add column if not exists phash bigint;
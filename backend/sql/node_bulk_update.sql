@@ -0,0 +1,21 @@
+-- Batched partial node updates for POST /nodes/bulk_update, PATCH /nodes/positions, the position socket
+-- and /graph/layout. Run once in the Supabase SQL editor.
+-- Each element of p_changes carries node_id and only the columns to change. jsonb_populate_record
+-- starts from the current row, so columns missing from an element keep whatever is stored at the
+-- time of the update (a concurrent edit to another column is not overwritten).
+
+create or replace function apply_node_changes(p_user_id bigint, p_changes jsonb)
+returns setof nodes
+language sql volatile as $$
+    update nodes n
+    set (title, description, image_id, tags, position_x, position_y, custom_date) =
+            (select r.title, r.description, r.image_id, r.tags, r.position_x, r.position_y, r.custom_date
+             from jsonb_populate_record(n, c.change) as r),
+        updated_at = now()
+    from (
+        select (jsonb_populate_record(null::nodes, item)).node_id as node_id, item as change
+        from jsonb_array_elements(p_changes) as item
+    ) as c
+    where n.user_id = p_user_id and n.node_id = c.node_id
+    returning n.*;
+$$;
@@ -0,0 +1,36 @@
+-- Full-text search over nodes for GET /nodes/search (NODE_SEARCH_BACKEND=postgres or auto).
+-- Run once in the Supabase SQL editor.
+
+-- array_to_string is only STABLE, generated columns need an IMMUTABLE expression
+create or replace function nodes_tags_text(tags text[]) returns text
+language sql immutable as $$ select coalesce(array_to_string(tags, ' '), '') $$;
+
+alter table nodes add column if not exists search_vector tsvector
+    generated always as (
+        setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('simple', nodes_tags_text(tags)), 'B') ||
+        setweight(to_tsvector('simple', coalesce(description, '')), 'C')
+    ) stored;
+
+create index if not exists nodes_search_vector_idx on nodes using gin (search_vector);
+create index if not exists nodes_user_id_idx on nodes (user_id);
+
+-- Every word has to match, each one also as a prefix; tag_prefix filters on the start of any tag
+create or replace function search_nodes(p_user_id bigint, p_query text, p_tag_prefix text, p_limit int)
+returns table (node jsonb, rank real)
+language sql stable as $$
+    with query as (
+        select to_tsquery('simple', string_agg(quote_literal(word) || ':*', ' & ')) as tsq
+        from regexp_split_to_table(lower(p_query), '\W+') as word
+        where word <> ''
+    )
+    select to_jsonb(n) - 'search_vector' - 'timeline_at' as node,
+           coalesce(ts_rank(n.search_vector, query.tsq), 0) as rank
+    from nodes n, query
+    where n.user_id = p_user_id
+      and (query.tsq is null or n.search_vector @@ query.tsq)
+      and (p_tag_prefix = '' or exists (
+            select 1 from unnest(n.tags) as tag where starts_with(lower(tag), lower(p_tag_prefix))))
+    order by rank desc, n.node_id
+    limit p_limit
+$$;
@@ -0,0 +1,22 @@
+-- Date of a node on the timeline for GET /nodes/timeline: its custom_date, else when it was created.
+-- Run once in the Supabase SQL editor. custom_date and created_at are expected to be timestamptz,
+-- a plain timestamp would make the expression non-immutable.
+
+alter table nodes add column if not exists timeline_at timestamptz
+    generated always as (coalesce(custom_date, created_at)) stored;
+
+create index if not exists nodes_user_timeline_idx on nodes (user_id, timeline_at, node_id);
+
+-- Node counts per day, month or year (UTC) for the bucketed timeline
+create or replace function node_timeline_buckets(p_user_id bigint, p_bucket text,
+                                                 p_start timestamptz, p_end timestamptz)
+returns table (bucket timestamptz, count bigint)
+language sql stable as $$
+    select date_trunc(p_bucket, timeline_at, 'UTC') as bucket, count(*) as count
+    from nodes
+    where user_id = p_user_id
+      and (p_start is null or timeline_at >= p_start)
+      and (p_end is null or timeline_at < p_end)
+    group by 1
+    order by 1
+$$;
@@ -0,0 +1,13 @@
+-- Deleted node, link and image ids for GET /sync/changes, written by the delete endpoints.
+-- Run once in the Supabase SQL editor. Rows older than SYNC_TOMBSTONE_RETENTION_DAYS may be pruned.
+
+create table if not exists tombstones (
+    id bigint generated always as identity primary key,
+    user_id bigint not null,
+    entity text not null check (entity in ('node', 'link', 'image')),
+    entity_id text not null,
+    deleted_at timestamptz not null default now()
+);
+
+-- deleted_since reads one user's rows after a watermark
+create index if not exists tombstones_user_deleted_idx on tombstones (user_id, deleted_at);
@@ -17,9 +17,13 @@ os.environ.setdefault("SUPABASE_KEY", "test-supabase-key")
 from main import app  # noqa: E402
 from services.security import security_service  # noqa: E402
 import db.db as db_module  # noqa: E402
+import services.image_metadata as image_metadata  # noqa: E402
 import services.image_services as image_services  # noqa: E402
 import services.link_services as link_services  # noqa: E402
+import services.media_pipeline as media_pipeline  # noqa: E402
 import services.node_services as node_services  # noqa: E402
+import services.similarity as similarity  # noqa: E402
+import services.sync_services as sync_services  # noqa: E402
 import services.user_services as user_services  # noqa: E402
 
 
@@ -62,9 +66,13 @@ def mock_supabase(monkeypatch):
 
     for module in (
         db_module,
+        image_metadata,
         image_services,
         link_services,
+        media_pipeline,
         node_services,
+        similarity,
+        sync_services,
         user_services,
     ):
         monkeypatch.setattr(module, "supabase", supabase_mock)
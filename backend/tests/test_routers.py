@@ -1,6 +1,11 @@
+import asyncio
+import gzip
+import hashlib
 import sys
+import threading
 from pathlib import Path
 
+import httpx
 import pytest
 from fastapi import HTTPException
 from fastapi.testclient import TestClient
@@ -10,11 +15,17 @@ APP_PATH = ROOT / "backend" / "app"
 sys.path.insert(0, str(APP_PATH))
 
 from main import app  # noqa: E402
-from services.security import security_service  # noqa: E402
+from services.security import security_service, hashing_engine  # noqa: E402
 from services.user_services import user_service  # noqa: E402
 from services.image_services import image_service  # noqa: E402
 from services.node_services import node_service  # noqa: E402
 from services.link_services import link_service  # noqa: E402
+from routers import images as images_router  # noqa: E402
+from services import http_client  # noqa: E402
+from services.http_client import outbound_http  # noqa: E402
+from services import position_services  # noqa: E402
+from services.graph_services import graph_service  # noqa: E402
+from services.sync_services import sync_service  # noqa: E402
 
 
 @pytest.fixture
@@ -49,6 +60,23 @@ def test_create_user_valid_payload(client, monkeypatch):
     assert response.json()["email"] == "ada@example.com"
 
 
+def test_sign_up_and_login_rejected_before_queueing_when_hashing_is_saturated(client, monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(hashing_engine, "_slots", slots)
+    queued = []
+    monkeypatch.setattr(user_service, "create_user", lambda payload: queued.append(payload))
+    monkeypatch.setattr(user_service, "login_user", lambda payload: queued.append(payload))
+
+    payload = {"first_name": "Ada", "surname": "Lovelace", "email": "ada@example.com", "password": "secret"}
+    signup = client.post("/users/create_user", json=payload)
+    login = client.post("/users/get_access_token", data={"username": "ada@example.com", "password": "secret"})
+
+    assert signup.status_code == 503 and login.status_code == 503
+    assert signup.headers["retry-after"] == "1"
+    assert queued == []
+
+
 def test_create_user_missing_fields_returns_422(client):
     payload = {"first_name": "Ada", "surname": "Lovelace", "password": "secret"}
     response = client.post("/users/create_user", json=payload)
@@ -97,6 +125,24 @@ def test_get_upload_url_authorized_flow(client, monkeypatch):
     assert response.json() == "https://example.com/signed-url"
 
 
+def test_get_urls_by_names_returns_map(client, monkeypatch):
+    monkeypatch.setattr(
+        image_service,
+        "get_signed_urls",
+        lambda user_id, file_names, size=None: {
+            name: f"https://example.com/{user_id}/{name}" for name in file_names
+        },
+    )
+
+    response = client.post("/images/get_urls_by_names", json={"file_names": ["a.png", "b.png"]})
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "a.png": "https://example.com/42/a.png",
+        "b.png": "https://example.com/42/b.png",
+    }
+
+
 def test_create_node_valid_payload(client, monkeypatch):
     def fake_create_node(payload):
         return {"status": "ok", "image_id": payload.image_id}
@@ -118,6 +164,144 @@ def test_create_node_missing_fields_returns_422(client):
     assert response.status_code == 422
 
 
+def test_list_nodes_passes_pagination(client, monkeypatch):
+    captured = {}
+
+    def fake_list_nodes(user_id, limit, cursor, fields):
+        captured.update(user_id=user_id, limit=limit, cursor=cursor, fields=fields)
+        return {"nodes": [], "next_cursor": None}
+
+    monkeypatch.setattr(node_service, "list_nodes", fake_list_nodes)
+
+    response = client.get(
+        "/nodes/list_nodes",
+        params={"limit": 10, "cursor": "abc", "fields": ["title", "tags"]},
+    )
+
+    assert response.status_code == 200
+    assert captured["user_id"] == 42
+    assert captured["limit"] == 10
+    assert [field.value for field in captured["fields"]] == ["title", "tags"]
+
+
+def test_graph_snapshot_etag_roundtrip(client, monkeypatch):
+    monkeypatch.setattr(
+        node_service,
+        "list_all_nodes",
+        lambda user_id, fields: [{"node_id": "n1", "image_id": "a.png"}],
+    )
+    monkeypatch.setattr(
+        link_service,
+        "list_links",
+        lambda user_id: [{"link_id": 1, "source_node_id": "n1", "target_node_id": "n2"}],
+    )
+    monkeypatch.setattr(image_service, "list_file_names", lambda user_id: ["a.png"])
+    monkeypatch.setattr(
+        image_service,
+        "get_signed_urls",
+        lambda user_id, file_names, size=None: {name: f"https://example.com/{name}" for name in file_names},
+    )
+
+    response = client.get("/graph/snapshot")
+
+    assert response.status_code == 200
+    assert response.json()["image_urls"] == {"a.png": "https://example.com/a.png"}
+    assert len(response.json()["links"]) == 1
+
+    cached = client.get("/graph/snapshot", headers={"If-None-Match": response.headers["etag"]})
+
+    assert cached.status_code == 304
+
+
+def test_positions_socket_coalesces_moves(client, monkeypatch):
+    written = []
+
+    def fake_update_positions(user_id, positions):
+        written.append([(p.node_id, p.position_x, p.position_y) for p in positions])
+        return [{"index": i, "ok": True} for i in range(len(positions))]
+
+    monkeypatch.setattr(node_service, "update_positions", fake_update_positions)
+    monkeypatch.setattr(security_service, "get_current_user", lambda token: 42)
+    monkeypatch.setattr(position_services, "POSITION_FLUSH_INTERVAL", 0.01)
+
+    with client.websocket_connect("/nodes/positions/ws?token=abc") as websocket:
+        websocket.send_json([
+            {"node_id": "n1", "position_x": 1, "position_y": 1},
+            {"node_id": "n2", "position_x": 5, "position_y": 5},
+            {"node_id": "n1", "position_x": 3, "position_y": 3},
+        ])
+        message = websocket.receive_json()
+
+    assert len(message["saved"]) == 2
+    assert written[0] == [("n1", 3.0, 3.0), ("n2", 5.0, 5.0)]
+
+
+def test_positions_socket_survives_bad_frames_and_keeps_failed_moves(client, monkeypatch):
+    written = []
+
+    def fake_update_positions(user_id, positions):
+        written.append([p.node_id for p in positions])
+        # The first write fails for its chunk, the retry goes through
+        ok = len(written) > 1
+        return [{"index": i, "ok": ok, **({} if ok else {"error": "connection reset"})} for i in range(len(positions))]
+
+    monkeypatch.setattr(node_service, "update_positions", fake_update_positions)
+    monkeypatch.setattr(security_service, "get_current_user", lambda token: 42)
+    monkeypatch.setattr(position_services, "POSITION_FLUSH_INTERVAL", 0.01)
+
+    with client.websocket_connect("/nodes/positions/ws?token=abc") as websocket:
+        websocket.send_text("not json")
+        assert websocket.receive_json() == {"error": "Messages must be JSON text"}
+        websocket.send_json({"node_id": "n1", "position_x": 1, "position_y": 1})
+        first = websocket.receive_json()
+        second = websocket.receive_json()
+
+    assert first["saved"][0]["ok"] is False and second["saved"][0]["ok"] is True
+    assert written[:2] == [["n1"], ["n1"]]
+
+
+def test_update_node_passes_only_sent_fields(client, monkeypatch):
+    captured = {}
+
+    def fake_update_node(payload, return_representation):
+        captured.update(fields=payload.model_fields_set, returning=return_representation)
+        return {"status": "ok"}
+
+    monkeypatch.setattr(node_service, "update_node", fake_update_node)
+
+    response = client.patch(
+        "/nodes/update_node", params={"return_node": True}, json={"node_id": "n1", "title": "Trip"}
+    )
+
+    assert response.status_code == 200
+    assert captured["fields"] == {"user_id", "node_id", "title"}
+    assert captured["returning"] is True
+
+
+def test_graph_index_cached_until_link_created(client, mock_supabase, monkeypatch):
+    loads = []
+
+    def fake_list_links(user_id):
+        loads.append(user_id)
+        return [
+            {"source_node_id": "a", "target_node_id": "b"},
+            {"source_node_id": "b", "target_node_id": "c"},
+        ]
+
+    monkeypatch.setattr(link_service, "list_links", fake_list_links)
+    graph_service.invalidate(42)
+
+    assert client.get("/graph/neighbors", params={"node_id": "b"}).json()["neighbors"] == ["a", "c"]
+    path = client.get("/graph/path", params={"source": "a", "target": "c"}).json()
+    assert path == {"path": ["a", "b", "c"], "length": 2}
+    assert len(loads) == 1
+
+    client.post("/nodelinks/create_link", params={"source_node_id": "c", "target_node_id": "d"})
+    client.get("/graph/khop", params={"node_id": "a", "k": 1})
+
+    assert len(loads) == 2
+
+
 def test_create_link_valid_payload(client, monkeypatch):
     def fake_create_link(payload):
         return {"status": "ok", "source": payload.source_node_id}
@@ -137,3 +321,178 @@ def test_create_link_missing_fields_returns_422(client):
     response = client.post("/nodelinks/create_link", params={"source_node_id": "node-1"})
 
     assert response.status_code == 422
+
+
+def _mock_image_host(monkeypatch, body, headers):
+    def handler(request):
+        return httpx.Response(200, headers=headers, content=body)
+
+    monkeypatch.setattr(
+        outbound_http,
+        "client",
+        httpx.AsyncClient(transport=httpx.MockTransport(handler), follow_redirects=True),
+    )
+
+
+def test_fetch_from_url_raw_streams_bytes(client, monkeypatch):
+    _mock_image_host(monkeypatch, b"png-bytes", {"content-type": "image/png"})
+
+    response = client.post(
+        "/images/fetch_from_url", json={"url": "https://img.example.com/a.png", "mode": "raw"}
+    )
+
+    assert response.status_code == 200
+    assert response.content == b"png-bytes"
+    assert response.headers["content-type"] == "image/png"
+
+
+def test_fetch_from_url_raw_drops_length_of_encoded_body(client, monkeypatch):
+    body = b"png-bytes" * 50
+    encoded = gzip.compress(body)
+    headers = {"content-type": "image/png", "content-encoding": "gzip", "content-length": str(len(encoded))}
+    _mock_image_host(monkeypatch, encoded, headers)
+
+    response = client.post(
+        "/images/fetch_from_url", json={"url": "https://img.example.com/a.png", "mode": "raw"}
+    )
+
+    assert response.status_code == 200
+    assert response.content == body
+    assert response.headers.get("content-length") != str(len(encoded))
+
+
+def test_fetch_from_url_rejects_large_content_length(client, monkeypatch):
+    headers = {
+        "content-type": "image/png",
+        "content-length": str(images_router.MAX_IMAGE_BYTES + 1),
+    }
+    _mock_image_host(monkeypatch, b"", headers)
+
+    response = client.post("/images/fetch_from_url", json={"url": "https://img.example.com/a.png"})
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == images_router.IMAGE_TOO_LARGE
+
+
+def test_fetch_from_url_store_uploads_bytes(client, monkeypatch):
+    _mock_image_host(monkeypatch, b"jpeg-bytes", {"content-type": "image/jpeg"})
+    uploaded = {}
+
+    def fake_upload(payload, data, content_type, content_sha256):
+        uploaded.update(file_name=payload.file_name, data=data, content_type=content_type,
+                        content_sha256=content_sha256)
+        return {"image_id": 1}
+
+    monkeypatch.setattr(image_service, "upload_image_bytes", fake_upload)
+
+    response = client.post(
+        "/images/fetch_from_url",
+        json={"url": "https://img.example.com/a.jpg", "mode": "store", "file_name": "a.jpg"},
+    )
+
+    assert response.status_code == 200
+    assert uploaded == {
+        "file_name": "a.jpg",
+        "data": b"jpeg-bytes",
+        "content_type": "image/jpeg",
+        "content_sha256": hashlib.sha256(b"jpeg-bytes").hexdigest(),
+    }
+
+
+def test_fetch_from_url_records_host_stats(client, monkeypatch):
+    _mock_image_host(monkeypatch, b"png-bytes", {"content-type": "image/png"})
+
+    client.post("/images/fetch_from_url", json={"url": "https://stats.example.com/a.png"})
+    response = client.get("/health/outbound")
+
+    assert response.json()["requests"] >= 1
+    assert "stats.example.com" not in response.text
+
+
+def test_health_counters_need_a_token():
+    with TestClient(app) as anonymous:
+        assert anonymous.get("/health").status_code == 200
+        for route in ("/health/pools", "/health/media", "/health/caches", "/health/outbound"):
+            assert anonymous.get(route).status_code in (401, 403)
+
+
+def test_outbound_host_slots_dropped_when_idle():
+    outbound = http_client.OutboundHTTP()
+
+    async def fetch_from(hosts):
+        for host in hosts:
+            async with outbound.host_slot(f"https://{host}/a.png"):
+                assert host in outbound._host_slots
+
+    asyncio.run(fetch_from(["a.example.com", "b.example.com", "c.example.com"]))
+
+    assert outbound._host_slots == {}
+    assert outbound.stats()["requests"] == 3
+
+
+def test_outbound_client_uses_caching_dns_backend():
+    # start() swaps a private httpcore attribute, this breaks loudly if an upgrade renames it
+    outbound = http_client.OutboundHTTP()
+
+    async def start_and_close():
+        client = await outbound.start()
+        pool = client._transport._pool
+        await outbound.close()
+        return pool
+
+    pool = asyncio.run(start_and_close())
+
+    assert pool._network_backend is outbound.dns_backend
+
+
+def test_sync_changes_returns_delta_since_version(client, monkeypatch):
+    captured = {}
+
+    def fake_changed_nodes(user_id, since):
+        captured["since"] = since
+        return [{"node_id": "n1"}]
+
+    monkeypatch.setattr(sync_service, "changed_nodes", fake_changed_nodes)
+    monkeypatch.setattr(sync_service, "changed_links", lambda user_id, since: [])
+    monkeypatch.setattr(sync_service, "changed_images", lambda user_id, since: [])
+    monkeypatch.setattr(
+        sync_service,
+        "deleted_since",
+        lambda user_id, since: {"nodes": [], "links": ["7"], "images": []},
+    )
+
+    first = client.get("/sync/changes").json()
+    assert first["full_resync"] is True
+
+    response = client.get("/sync/changes", params={"since": first["version"]})
+
+    body = response.json()
+    assert body["full_resync"] is False
+    assert body["nodes"] == [{"node_id": "n1"}]
+    assert body["deleted"]["links"] == ["7"]
+    assert captured["since"].startswith(first["watermark"][:19])
+    assert client.get("/sync/changes", params={"since": "yesterday"}).status_code == 400
+
+
+def test_timeline_returns_buckets_or_page(client, monkeypatch):
+    captured = {}
+
+    def fake_timeline(user_id, start, end, limit, cursor, descending, fields):
+        captured.update(start=start, descending=descending)
+        return {"nodes": [], "next_cursor": None}
+
+    monkeypatch.setattr(node_service, "timeline", fake_timeline)
+    monkeypatch.setattr(
+        node_service,
+        "timeline_buckets",
+        lambda user_id, bucket, start, end: [{"bucket": "2024", "count": 3}],
+    )
+
+    page = client.get("/nodes/timeline", params={"start": "2024-01-01T00:00:00Z", "order": "desc"})
+    buckets = client.get("/nodes/timeline", params={"bucket": "year"})
+
+    assert page.json() == {"nodes": [], "next_cursor": None}
+    assert captured["start"].year == 2024 and captured["descending"] is True
+    assert buckets.json() == {"bucket": "year", "buckets": [{"bucket": "2024", "count": 3}]}
+    assert client.get("/nodes/timeline", params={"bucket": "week"}).status_code == 422
+
@@ -1,20 +1,46 @@
+import asyncio
+import datetime
+import io
 import pathlib
+import struct
 import sys
+import threading
 
 import pytest
 from fastapi import HTTPException
+from postgrest.exceptions import APIError
 
 sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "app"))
 
 from models.image import ImageFilename
 from models.link import LinkDataFields as link_df
-from models.link import NodeLinkDelete
+from models.link import NodeLinkCreate, NodeLinkDelete
 from models.node import NodeDataFields as node_df
-from models.node import NodeUpdate
+from models.node import NodePosition, NodeUpdate
 from models.user import UserCreate, UserLogin
-from services import image_services, link_services, node_services, user_services
+from services import (
+    derivatives,
+    graph_services,
+    image_metadata,
+    image_services,
+    link_services,
+    node_services,
+    search_services,
+    security,
+    similarity,
+    sync_services,
+    user_services,
+)
 from services.image_services import ImageService
 from services.link_services import LinkService
+from services.exif import parse_header
+from services.image_metadata import ImageMetadataService
+from services.offload import BlockingPool
+from services.phash_index import BKTree
+from services.graph_index import AdjacencyIndex
+from services.search_index import InvertedIndex
+from services.search_services import SearchService
+from services.security import HashingEngine, SecurityService
 from services.node_services import NodeService
 from services.user_services import UserService
 
@@ -44,26 +70,74 @@ class TableChain:
     def eq(self, *args, **kwargs):
         return self
 
+    def order(self, *args, **kwargs):
+        return self
+
+    def limit(self, *args, **kwargs):
+        return self
+
+    def or_(self, *args, **kwargs):
+        return self
+
+    def in_(self, *args, **kwargs):
+        return self
+
+    def gt(self, *args, **kwargs):
+        return self
+
+    def gte(self, *args, **kwargs):
+        return self
+
+    def lt(self, *args, **kwargs):
+        return self
+
+    def upsert(self, *args, **kwargs):
+        return self
+
     def execute(self):
         if self.exc:
             raise self.exc
         return self.response
 
 
+class AsyncTableChain(TableChain):
+    async def execute(self):
+        if self.exc:
+            raise self.exc
+        return self.response
+
+
 class StorageBucket:
     def __init__(self, response):
         self.response = response
+        self.calls = []
 
     def create_signed_upload_url(self, path):
         return self.response
 
+    def create_signed_url(self, path, expires_in):
+        self.calls.append(path)
+        return self.response
+
+    def create_signed_urls(self, paths, expires_in):
+        self.calls.append(tuple(paths))
+        return [
+            {"path": path, "error": None, "signedURL": f"https://{path}", "signedUrl": f"https://{path}"}
+            for path in paths
+            if "missing.png" not in path
+        ]
+
+    def remove(self, paths):
+        return [{"name": paths}]
+
 
 class StorageStub:
     def __init__(self, response):
         self.response = response
+        self.bucket = StorageBucket(response)
 
     def from_(self, name):
-        return StorageBucket(self.response)
+        return self.bucket
 
 
 class SupabaseStub:
@@ -230,9 +304,42 @@ def test_delete_link_success(monkeypatch):
     supabase_stub = SupabaseStub(table_chain=TableChain(response=response))
 
     monkeypatch.setattr(link_services, "supabase", supabase_stub)
+    monkeypatch.setattr(sync_services, "supabase", supabase_stub)
+    recorded = []
+    monkeypatch.setattr(
+        sync_services.sync_service,
+        "record_deletes",
+        lambda user_id, entity, ids: recorded.append((user_id, entity, list(ids))),
+    )
+
+    service = LinkService()
+    service.cache.store(1, [{"link_id": 3, "source_node_id": "a", "target_node_id": "b"}], service.cache.version(1))
+    version = service.cache.version(1)
+    notified = []
+    service.subscribe(notified.append)
+
+    assert service.delete_link(payload) == {"message": "Link deleted successfully"}
+    assert recorded == [(1, "link", [3])]
+    assert service.cache.version(1) > version
+    assert 3 not in service.cache.get(1)[1].links
+    assert notified == [1]
+
+
+def test_delete_link_of_missing_link_leaves_cache_alone(monkeypatch):
+    supabase_stub = SupabaseStub(table_chain=TableChain(response=DummyResponse([])))
+    monkeypatch.setattr(link_services, "supabase", supabase_stub)
+    monkeypatch.setattr(sync_services, "supabase", supabase_stub)
 
     service = LinkService()
-    assert service.delete_link(payload) == response
+    service.cache.store(1, [{"link_id": 3, "source_node_id": "a", "target_node_id": "b"}], service.cache.version(1))
+    version = service.cache.version(1)
+    notified = []
+    service.subscribe(notified.append)
+
+    service.delete_link(NodeLinkDelete(user_id=1, link_id=99))
+
+    assert service.cache.version(1) == version
+    assert notified == []
 
 
 def test_delete_link_supabase_error(monkeypatch):
@@ -244,3 +351,850 @@ def test_delete_link_supabase_error(monkeypatch):
     service = LinkService()
     with pytest.raises(RuntimeError, match="delete fail"):
         service.delete_link(payload)
+
+
+def test_link_cache_updates_incrementally_and_diffs(monkeypatch):
+    rows = [{"link_id": 1, "source_node_id": "a", "target_node_id": "b", "created_at": "2024-01-01"}]
+    table_chain = TableChain(response=DummyResponse(rows))
+    monkeypatch.setattr(link_services, "supabase", SupabaseStub(table_chain=table_chain))
+    monkeypatch.setattr(sync_services, "supabase", SupabaseStub(table_chain=table_chain))
+
+    service = LinkService()
+    assert service.list_links(1) == rows
+    version = service.cache.version(1)
+
+    new_row = {"link_id": 2, "source_node_id": "b", "target_node_id": "c", "created_at": "2024-01-02"}
+    table_chain.response = DummyResponse([new_row])
+    service.create_link(NodeLinkCreate(user_id=1, source_node_id="b", target_node_id="c"))
+    service.delete_link(NodeLinkDelete(user_id=1, link_id=1))
+
+    # Served from the cache, the stub now only knows about the inserted row
+    assert service.list_links(1) == [new_row]
+    etag, body = asyncio.run(service.list_links_since(1, since_version=service.cache.token(version)))
+    assert body["full"] is False
+    assert body["upserted"] == [new_row]
+    assert body["deleted"] == ["1"]
+
+    unchanged_etag, unchanged = asyncio.run(service.list_links_since(1, if_none_match=etag))
+    assert unchanged is None and unchanged_etag == etag
+
+
+def test_delete_link_records_tombstone(monkeypatch):
+    recorded = []
+    table_chain = TableChain(response=DummyResponse([{"link_id": 3}]))
+    monkeypatch.setattr(link_services, "supabase", SupabaseStub(table_chain=table_chain))
+    monkeypatch.setattr(
+        sync_services.sync_service,
+        "record_deletes",
+        lambda user_id, entity, ids: recorded.append((user_id, entity, list(ids))),
+    )
+
+    LinkService().delete_link(NodeLinkDelete(user_id=1, link_id=3))
+
+    assert recorded == [(1, "link", [3])]
+
+
+def test_link_cache_evicts_least_recent_user():
+    cache = link_services.LinkCache(max_links=3, ttl=60)
+    cache.store(1, [{"link_id": 1}, {"link_id": 2}], 0)
+    cache.store(2, [{"link_id": 3}], 0)
+    cache.get(1)
+    cache.store(3, [{"link_id": 4}], 0)
+
+    assert cache.get(2) is None
+    assert cache.get(1) is not None
+    assert cache.stats()["links"] == 3
+
+
+def test_link_cache_reload_after_expiry_changes_version_only_when_links_differ(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(link_services.time, "monotonic", lambda: now[0])
+    cache = link_services.LinkCache(max_links=10, ttl=60)
+    cache.store(1, [{"link_id": 1}], 0)
+    version = cache.version(1)
+
+    now[0] += 61
+    assert cache.get(1) is None
+    cache.store(1, [{"link_id": 1}], version)
+    assert cache.version(1) == version
+
+    now[0] += 61
+    assert cache.get(1) is None
+    # Another process added a link while the set was cached here
+    cache.store(1, [{"link_id": 1}, {"link_id": 2}], version)
+    assert cache.version(1) == version + 1
+    assert cache.get(1)[1].floor == version + 1
+
+
+def test_list_nodes_returns_cursor_when_more_rows(monkeypatch):
+    rows = [
+        {"node_id": f"node-{i}", "created_at": f"2024-01-0{i}T00:00:00"}
+        for i in (3, 2, 1)
+    ]
+    supabase_stub = SupabaseStub(table_chain=TableChain(response=DummyResponse(rows)))
+
+    monkeypatch.setattr(node_services, "supabase", supabase_stub)
+
+    service = NodeService()
+    page = service.list_nodes(user_id=1, limit=2)
+
+    assert [node["node_id"] for node in page["nodes"]] == ["node-3", "node-2"]
+    assert node_services._decode_cursor(page["next_cursor"]) == ("2024-01-02T00:00:00", "node-2")
+
+
+def test_node_reads_never_select_generated_columns(monkeypatch):
+    chain = TableChain(response=DummyResponse([{"node_id": "n1", "search_vector": "'cat':1A", "timeline_at": "2024"}]))
+    selected = []
+    chain.select = lambda columns: selected.append(columns) or chain
+    supabase_stub = SupabaseStub(table_chain=chain)
+    monkeypatch.setattr(node_services, "supabase", supabase_stub)
+    monkeypatch.setattr(sync_services, "supabase", supabase_stub)
+
+    service = NodeService()
+    service.get_node_info(node_services.NodeInfoDelete(user_id=1, node_id="n1"))
+    service.list_nodes(user_id=1)
+    sync_services.sync_service.changed_nodes(user_id=1, since="2024-01-01T00:00:00+00:00")
+    created = service.create_node(node_services.NodeCreate(user_id=1, image_id="a.png", description="d"))
+
+    assert len(selected) == 3
+    for columns in selected:
+        assert "*" not in columns and "search_vector" not in columns and "timeline_at" not in columns
+        assert {"node_id", "title", "created_at", "updated_at"} <= set(columns.split(","))
+    assert created.data == [{"node_id": "n1"}]
+
+
+def test_list_nodes_invalid_cursor(monkeypatch):
+    supabase_stub = SupabaseStub(table_chain=TableChain(response=DummyResponse([])))
+
+    monkeypatch.setattr(node_services, "supabase", supabase_stub)
+
+    service = NodeService()
+    with pytest.raises(HTTPException) as exc_info:
+        service.list_nodes(user_id=1, cursor="not-a-cursor")
+
+    assert exc_info.value.status_code == 400
+
+
+def test_list_nodes_async_uses_async_client(monkeypatch):
+    rows = [{"node_id": "node-1", "created_at": "2024-01-01T00:00:00"}]
+    async_stub = SupabaseStub(table_chain=AsyncTableChain(response=DummyResponse(rows)))
+
+    monkeypatch.setattr(node_services, "supabase", None)
+    monkeypatch.setattr(node_services, "get_async_supabase", lambda: async_stub)
+
+    service = NodeService()
+    page = asyncio.run(service.list_nodes_async(user_id=1, limit=5))
+
+    assert page == {"nodes": rows, "next_cursor": None}
+
+
+def test_blocking_pool_records_stats():
+    pool = BlockingPool(name="test", max_workers=2)
+
+    async def run_twice():
+        return [await pool.run(lambda x: x * 2, 3), await pool.run(sum, [1, 2])]
+
+    assert asyncio.run(run_twice()) == [6, 3]
+    stats = pool.stats()
+    assert stats["completed"] == 2
+    assert stats["queue_depth"] == 0
+    pool.shutdown()
+
+
+def test_blocking_pool_frees_slot_of_cancelled_call():
+    pool = BlockingPool(name="test", max_workers=1, max_queue=2)
+    release = threading.Event()
+
+    async def cancel_queued():
+        busy = asyncio.ensure_future(pool.run(release.wait))
+        queued = asyncio.ensure_future(pool.run(lambda: None))
+        await asyncio.sleep(0.05)
+        queued.cancel()
+        await asyncio.sleep(0.05)
+        depth = pool.stats()["queue_depth"]
+        release.set()
+        await busy
+        return depth
+
+    assert asyncio.run(cancel_queued()) == 0
+    pool.shutdown()
+
+
+def test_blocking_pool_rejects_when_queue_full():
+    pool = BlockingPool(name="test", max_workers=1, max_queue=1)
+    pool._queued = 1
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(pool.run(lambda: None))
+
+    assert exc_info.value.status_code == 503
+    assert pool.stats()["rejected"] == 1
+
+
+def test_hashing_engine_inline_when_no_workers():
+    engine = HashingEngine(workers=0, max_pending=1)
+
+    assert engine.run(str.upper, "argon") == "ARGON"
+
+
+def test_hashing_engine_rejects_when_saturated():
+    engine = HashingEngine(workers=1, max_pending=1)
+    engine._slots.acquire()
+
+    with pytest.raises(HTTPException) as exc_info:
+        with engine.admit():
+            engine.run(str.upper, "argon")
+
+    assert exc_info.value.status_code == 503
+    engine._slots.release()
+    with engine.admit():
+        assert engine._slots.acquire(blocking=False) is False
+    engine.shutdown()
+
+
+def test_get_current_user_caches_decoded_token(monkeypatch):
+    monkeypatch.setattr(security, "SECRET_KEY", "test-secret-key-for-unit-tests-0123456789")
+    monkeypatch.setattr(security, "ALGORITHM", "HS256")
+    service = SecurityService()
+    token = service.create_access_token({"sub": "7"})["access_token"]
+
+    assert service.get_current_user(token) == "7"
+    assert service.get_current_user(token) == "7"
+    assert service.token_cache.stats()["hits"] == 1
+
+
+def test_verify_reset_token_keeps_type_check_on_cached_token(monkeypatch):
+    monkeypatch.setattr(security, "SECRET_KEY", "test-secret-key-for-unit-tests-0123456789")
+    monkeypatch.setattr(security, "ALGORITHM", "HS256")
+    service = SecurityService()
+    access_token = service.create_access_token({"sub": "7"})["access_token"]
+    reset_token = service.create_reset_token_jwt(7)
+    service.get_current_user(access_token)
+
+    with pytest.raises(HTTPException) as exc_info:
+        service.verify_reset_token(access_token)
+
+    assert exc_info.value.status_code == 400
+    assert service.verify_reset_token(reset_token) == 7
+    assert service.verify_reset_token(reset_token) == 7
+
+
+def test_get_signed_url_served_from_cache_until_deleted(monkeypatch):
+    payload = ImageFilename(user_id=1, file_name="photo.png")
+    storage = StorageStub({"signedUrl": "https://signed"})
+    supabase_stub = SupabaseStub(
+        table_chain=TableChain(response=DummyResponse([])), storage=storage
+    )
+
+    monkeypatch.setattr(image_services, "supabase", supabase_stub)
+
+    service = ImageService()
+    assert service.get_signed_url(payload) == {"signedUrl": "https://signed"}
+    assert service.get_signed_url(payload) == {"signedUrl": "https://signed"}
+    assert storage.bucket.calls == ["1/photo.png"]
+
+    service.delete_image(payload)
+    service.get_signed_url(payload)
+    assert storage.bucket.calls == ["1/photo.png", "1/photo.png"]
+
+
+def test_delete_image_refused_while_other_nodes_use_it(monkeypatch):
+    payload = ImageFilename(user_id=1, file_name="shared.png")
+    chain = TableChain(response=DummyResponse([{"node_id": "n1"}, {"node_id": "n2"}]))
+    storage = StorageStub({"signedUrl": "https://signed"})
+    removed = []
+    storage.bucket.remove = lambda paths: removed.append(paths)
+    monkeypatch.setattr(image_services, "supabase", SupabaseStub(table_chain=chain, storage=storage))
+
+    with pytest.raises(HTTPException) as exc_info:
+        ImageService().delete_image(payload, node_id="n1")
+
+    assert exc_info.value.status_code == 409
+    assert removed == []
+
+    chain.response = DummyResponse([{"node_id": "n1"}])
+    monkeypatch.setattr(sync_services.sync_service, "record_deletes", lambda *args: None)
+    ImageService().delete_image(payload, node_id="n1")
+    assert removed[0] == "1/shared.png"
+
+
+def test_get_signed_urls_batches_and_falls_back(monkeypatch):
+    storage = StorageStub({"signedURL": "https://single", "signedUrl": "https://single"})
+    supabase_stub = SupabaseStub(storage=storage)
+
+    monkeypatch.setattr(image_services, "supabase", supabase_stub)
+
+    service = ImageService()
+    urls = service.get_signed_urls(1, ["a.png", "missing.png", "a.png"])
+
+    assert urls == {"a.png": "https://1/a.png", "missing.png": "https://single"}
+    assert storage.bucket.calls == [("1/a.png", "1/missing.png"), "1/missing.png"]
+    assert service.get_signed_urls(1, ["a.png"]) == {"a.png": "https://1/a.png"}
+    assert len(storage.bucket.calls) == 2
+
+
+def test_get_signed_urls_with_size_falls_back_to_originals(monkeypatch):
+    storage = StorageStub({"signedURL": "https://single", "signedUrl": "https://single"})
+    monkeypatch.setattr(image_services, "supabase", SupabaseStub(storage=storage))
+    monkeypatch.setattr(derivatives.derivative_service, "enabled", True)
+    monkeypatch.setattr(derivatives.derivative_service, "format", "webp")
+    scheduled = []
+    monkeypatch.setattr(
+        derivatives.derivative_service, "ensure", lambda user_id, file_name: scheduled.append(file_name)
+    )
+
+    urls = ImageService().get_signed_urls(1, ["a.png", "missing.png"], size="thumb")
+
+    assert urls == {"a.png": "https://1/derivatives/thumb/a.png.webp", "missing.png": "https://single"}
+    assert scheduled == ["missing.png"]
+
+
+def test_missing_derivatives_are_remembered_and_change_the_snapshot_etag(monkeypatch):
+    storage = StorageStub({"signedURL": "https://single", "signedUrl": "https://single"})
+    monkeypatch.setattr(image_services, "supabase", SupabaseStub(storage=storage))
+    service = derivatives.DerivativeService()
+    service.enabled, service.format = True, "webp"
+    monkeypatch.setattr(image_services, "derivative_service", service)
+    monkeypatch.setattr(derivatives.media_pipeline, "background", lambda *args: None)
+
+    ImageService().get_signed_urls(1, ["a.png", "missing.png"], size="thumb")
+    etag = graph_services._snapshot_etag([], [], ["a.png", "missing.png"], "thumb", ["missing.png"])
+    storage.bucket.calls.clear()
+    urls = ImageService().get_signed_urls(1, ["a.png", "missing.png"], size="thumb")
+
+    assert service.is_missing("1", "missing.png") and not service.is_missing(1, "a.png")
+    assert urls == {"a.png": "https://1/derivatives/thumb/a.png.webp", "missing.png": "https://single"}
+    assert all("thumb/missing.png" not in str(call) for call in storage.bucket.calls)
+    assert etag != graph_services._snapshot_etag([], [], ["a.png", "missing.png"], "thumb")
+    monkeypatch.setattr(derivatives.media_pipeline, "cpu", lambda *args: {})
+    service.build(1, "missing.png", b"bytes")
+    assert not service.is_missing("1", "missing.png")
+
+
+def test_upload_image_bytes_reuses_image_with_same_hash(monkeypatch):
+    existing = {"image_id": 7, "file_name": "first.png", "file_path": "1/first.png"}
+    # StorageBucket has no upload, storing the duplicate again would fail the test
+    monkeypatch.setattr(
+        image_services,
+        "supabase",
+        SupabaseStub(table_chain=TableChain(response=DummyResponse([existing])), storage=StorageStub(None)),
+    )
+    payload = ImageFilename(user_id=1, file_name="second.png")
+
+    row = ImageService().upload_image_bytes(payload, b"same-bytes", "image/png")
+
+    assert row == {**existing, "deduplicated": True}
+
+
+def test_find_by_hash_disabled_without_column(monkeypatch):
+    missing = APIError({"code": "42703", "message": "column images.content_sha256 does not exist"})
+    monkeypatch.setattr(image_services, "supabase", SupabaseStub(table_chain=TableChain(exc=missing)))
+
+    service = ImageService()
+
+    assert service.find_by_hash(1, "ab" * 32) is None
+    assert service.hashes_available is False
+
+
+def test_bk_tree_finds_hashes_within_radius():
+    tree = BKTree([("a", 0b0000), ("b", 0b0001), ("c", 0b0111), ("d", 0xFFFF)])
+    tree.add("e", 0b0000)
+    tree.remove("b")
+
+    assert tree.search(0b0001, 1) == [("a", 1), ("e", 1)]
+    assert tree.search(0b0000, 3) == [("a", 0), ("e", 0), ("c", 3)]
+    assert tree.search(0b0000, 3, limit=1) == [("a", 0)]
+    assert "b" not in tree and len(tree) == 4
+
+
+def test_similar_images_excludes_query_and_maps_signed_hashes(monkeypatch):
+    rows = [
+        {"file_name": "a.png", "phash": -1},
+        {"file_name": "b.png", "phash": similarity._to_signed(0xFFFFFFFFFFFFFFFE)},
+        {"file_name": "c.png", "phash": 0},
+    ]
+    monkeypatch.setattr(similarity, "supabase", SupabaseStub(table_chain=TableChain(response=DummyResponse(rows))))
+    service = similarity.SimilarityService()
+    service.enabled = True
+
+    result = service.similar(1, "a.png", radius=4)
+
+    assert result == {"file_name": "a.png", "pending": False, "similar": [{"file_name": "b.png", "distance": 1}]}
+
+
+def test_similarity_tree_loads_in_pages_and_tracks_pending_hashes(monkeypatch):
+    rows = [{"file_name": "a.png", "phash": 1}, {"file_name": "b.png", "phash": None}, {"file_name": "c.png", "phash": 3}]
+    chain = TableChain()
+    after = []
+    chain.gt = lambda column, value: after.append(value) or chain
+    chain.execute = lambda: DummyResponse([row for row in rows if not after or row["file_name"] > after[-1]][:2])
+    monkeypatch.setattr(similarity, "supabase", SupabaseStub(table_chain=chain))
+    monkeypatch.setattr(similarity, "SIMILAR_LOAD_PAGE_SIZE", 2)
+    monkeypatch.setattr(similarity.media_pipeline, "background", lambda *args: None)
+    monkeypatch.setattr(similarity.media_pipeline, "cpu", lambda fn, data: 0)
+    service = similarity.SimilarityService()
+    service.enabled = True
+
+    tree, unhashed = service.get_tree(1)
+
+    assert after == ["b.png"] and len(tree) == 2 and unhashed == ["b.png"]
+    assert service.similar(1, "a.png")["pending"] is True
+    service.build(1, "b.png", b"bytes")
+    assert service.similar(1, "a.png") == {
+        "file_name": "a.png", "pending": False,
+        "similar": [{"file_name": "b.png", "distance": 1}, {"file_name": "c.png", "distance": 1}],
+    }
+
+
+def _jpeg_with_exif(orientation, taken_at, width, height):
+    # Big-endian TIFF: IFD0 with Orientation and the EXIF pointer, then an EXIF IFD with DateTimeOriginal
+    date = taken_at.encode() + b"\0"
+    exif_at = 8 + 2 + 2 * 12 + 4
+    ifd0 = struct.pack(">H", 2) + struct.pack(">HHIHH", 0x0112, 3, 1, orientation, 0)
+    ifd0 += struct.pack(">HHII", 0x8769, 4, 1, exif_at) + struct.pack(">I", 0)
+    exif_ifd = struct.pack(">H", 1) + struct.pack(">HHII", 0x9003, 2, len(date), exif_at + 18)
+    tiff = b"MM\0\x2a" + struct.pack(">I", 8) + ifd0 + exif_ifd + struct.pack(">I", 0) + date
+    app1 = b"Exif\0\0" + tiff
+    sof = b"\x08" + struct.pack(">HH", height, width) + b"\x03"
+    return (b"\xff\xd8" + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1
+            + b"\xff\xc0" + struct.pack(">H", len(sof) + 2) + sof + b"\xff\xda")
+
+
+def test_parse_header_reads_exif_and_frame_size():
+    data = _jpeg_with_exif(6, "2023:07:14 18:30:05", 4032, 3024)
+
+    assert parse_header(data) == {
+        "width": 4032,
+        "height": 3024,
+        "orientation": 6,
+        "taken_at": "2023-07-14T18:30:05",
+    }
+    assert parse_header(data[:40])["orientation"] == 6
+    assert parse_header(b"GIF89a") == {}
+
+
+def test_image_metadata_saved_in_batches(monkeypatch):
+    calls = []
+    supabase_stub = SupabaseStub(table_chain=TableChain(response=DummyResponse([])))
+    supabase_stub.rpc = lambda name, params: calls.append((name, params)) or TableChain(DummyResponse(None))
+    monkeypatch.setattr(image_metadata, "supabase", supabase_stub)
+    monkeypatch.setattr(image_metadata.media_pipeline, "cpu_workers", 0)
+    service = ImageMetadataService(batch_size=2, flush_interval=60)
+    header = _jpeg_with_exif(1, "2020:01:02 03:04:05", 10, 20)
+
+    service.ingest(1, "a.jpg", header)
+    assert calls == []
+    service.ingest(1, "b.jpg", header)
+
+    assert [name for name, _ in calls] == ["apply_image_metadata"]
+    assert [row["file_name"] for row in calls[0][1]["p_rows"]] == ["a.jpg", "b.jpg"]
+    assert calls[0][1]["p_rows"][0]["taken_at"] == "2020-01-02T03:04:05"
+    assert service._timer is None and service.written == 2
+
+
+def test_image_metadata_reads_the_shared_upload_download(monkeypatch):
+    parsed = []
+    monkeypatch.setattr(image_metadata.media_pipeline, "cpu", lambda fn, data: parsed.append(len(data)) or {})
+    service = ImageMetadataService()
+
+    service.ingest(1, "big.jpg", b"\xff\xd8" + b"\0" * (2 * image_metadata.EXIF_HEADER_BYTES))
+
+    assert parsed == [image_metadata.EXIF_HEADER_BYTES]
+    assert image_metadata.image_metadata_service.ingest in image_metadata.media_pipeline._hooks
+
+
+def test_snapshot_etag_rolls_over_before_cached_urls_expire(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(graph_services.time, "time", lambda: now[0])
+    first = graph_services._snapshot_etag([], [], ["a.png"])
+
+    # A url served now may have only SIGNED_URL_MIN_REMAINING seconds left, the etag must change before that
+    now[0] += image_services.SIGNED_URL_MIN_REMAINING
+
+    assert graph_services._snapshot_etag([], [], ["a.png"]) != first
+
+
+def test_graph_layout_needs_numpy(monkeypatch):
+    monkeypatch.setattr(graph_services, "NUMPY_AVAILABLE", False)
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(graph_services.GraphService().layout(1))
+
+    assert exc.value.status_code == 503
+
+
+def test_graph_layout_keeps_pinned_and_saves_moved_nodes(monkeypatch):
+    pytest.importorskip("numpy")
+    nodes = [
+        {"node_id": "a", "position_x": 0.0, "position_y": 0.0},
+        {"node_id": "b", "position_x": 0.0, "position_y": 0.0},
+        {"node_id": "c", "position_x": None, "position_y": None},
+    ]
+    links = [{"source_node_id": "a", "target_node_id": "b"}, {"source_node_id": "b", "target_node_id": "c"}]
+    saved = []
+
+    async def fake_nodes(user_id, fields):
+        return nodes
+
+    async def fake_links(user_id):
+        return links
+
+    monkeypatch.setattr(graph_services.node_service, "list_all_nodes_async", fake_nodes)
+    monkeypatch.setattr(graph_services.link_service, "list_links_async", fake_links)
+    monkeypatch.setattr(
+        graph_services.node_service, "update_positions", lambda user_id, positions: saved.extend(positions)
+    )
+
+    result = asyncio.run(graph_services.GraphService().layout(1, pinned=["a"], iterations=30))
+
+    positions = {row["node_id"]: row for row in result["positions"]}
+    assert (positions["a"]["position_x"], positions["a"]["position_y"]) == (0.0, 0.0)
+    assert positions["b"]["position_x"] != 0.0 or positions["b"]["position_y"] != 0.0
+    assert sorted(position.node_id for position in saved) == ["b", "c"]
+
+
+def test_graph_layout_keeps_positions_dragged_during_the_run(monkeypatch):
+    pytest.importorskip("numpy")
+    reads = [
+        [{"node_id": "a", "position_x": 0.0, "position_y": 0.0}, {"node_id": "b", "position_x": 1.0, "position_y": 0.0}],
+        [{"node_id": "a", "position_x": 0.0, "position_y": 0.0}, {"node_id": "b", "position_x": 500.0, "position_y": 9.0}],
+    ]
+    saved = []
+
+    async def fake_nodes(user_id, fields):
+        return reads.pop(0)
+
+    async def fake_links(user_id):
+        return []
+
+    monkeypatch.setattr(graph_services.node_service, "list_all_nodes_async", fake_nodes)
+    monkeypatch.setattr(graph_services.link_service, "list_links_async", fake_links)
+    monkeypatch.setattr(
+        graph_services.node_service, "update_positions", lambda user_id, positions: saved.extend(positions)
+    )
+    monkeypatch.setattr(graph_services, "LAYOUT_WORK_BUDGET", 40)
+
+    # The router passes the token's sub, a string
+    result = asyncio.run(graph_services.GraphService().layout("1", iterations=100))
+
+    assert result["iterations"] == 10
+    assert [position.node_id for position in saved] == ["a"]
+    assert result["moved"] == 1 and result["skipped"] == 1
+
+
+def test_graph_layout_runs_once_per_user(monkeypatch):
+    monkeypatch.setattr(graph_services, "NUMPY_AVAILABLE", True)
+    service = graph_services.GraphService()
+    service._layouts_running.add("1")
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(service.layout(1))
+
+    assert exc.value.status_code == 409
+
+
+def test_render_derivatives_shrinks_to_each_size():
+    Image = pytest.importorskip("PIL.Image")
+    source = io.BytesIO()
+    Image.new("RGB", (1200, 800), "red").save(source, format="PNG")
+
+    rendered = derivatives.render_derivatives(source.getvalue(), {"thumb": 200, "small": 480}, "jpeg", 80)
+
+    with Image.open(io.BytesIO(rendered["thumb"])) as thumb:
+        assert thumb.size == (200, 133)
+    with Image.open(io.BytesIO(rendered["small"])) as small:
+        assert small.size == (480, 320)
+
+
+def test_bulk_create_nodes_reports_per_item(monkeypatch):
+    created = [{"node_id": "n1"}, {"node_id": "n2"}]
+    supabase_stub = SupabaseStub(table_chain=TableChain(response=DummyResponse(created)))
+
+    monkeypatch.setattr(node_services, "supabase", supabase_stub)
+
+    service = NodeService()
+    results = service.bulk_create_nodes(
+        user_id=1,
+        items=[
+            {"image_id": "a.png", "description": "first"},
+            {"image_id": "b.png"},
+            {"image_id": "c.png", "description": "third", "user_id": 999},
+        ],
+    )
+
+    assert [result["ok"] for result in results] == [True, False, True]
+    assert results[0]["node"] == {"node_id": "n1"}
+    assert results[2]["node"] == {"node_id": "n2"}
+
+
+def test_bulk_update_nodes_skips_foreign_nodes(monkeypatch):
+    rows = [{"node_id": "n1", "title": "new"}]
+    supabase_stub = SupabaseStub()
+    supabase_stub.rpc = lambda name, params: TableChain(response=DummyResponse(rows))
+
+    monkeypatch.setattr(node_services, "supabase", supabase_stub)
+
+    service = NodeService()
+    results = service.bulk_update_nodes(
+        user_id=1,
+        items=[
+            {"node_id": "n1", "image_id": "a.png", "description": "d", "title": "new"},
+            {"node_id": "n2", "image_id": "b.png", "description": "d"},
+        ],
+    )
+
+    assert results[0] == {"index": 0, "ok": True, "node": rows[0]}
+    assert results[1] == {"index": 1, "ok": False, "error": "Node not found"}
+
+
+def test_bulk_update_nodes_rejects_items_without_changes(monkeypatch):
+    calls = []
+    supabase_stub = SupabaseStub(table_chain=TableChain(response=DummyResponse([])))
+    supabase_stub.rpc = lambda name, params: calls.append(params) or TableChain(
+        response=DummyResponse([{"node_id": "n1", "title": "New"}])
+    )
+    monkeypatch.setattr(node_services, "supabase", supabase_stub)
+
+    results = NodeService().bulk_update_nodes(user_id=1, items=[{"node_id": "n1", "title": "New"}, {"node_id": "n2"}])
+
+    assert results[1] == {"index": 1, "ok": False, "error": "No fields to update"}
+    assert results[0]["ok"] is True
+    assert [change["node_id"] for change in calls[0]["p_changes"]] == ["n1"]
+
+
+def test_update_positions_writes_only_coordinates(monkeypatch):
+    rows = [{"node_id": "n1", "user_id": 1, "image_id": "a.png", "description": "d", "search_vector": "'d':1"}]
+    calls = []
+    supabase_stub = SupabaseStub()
+    supabase_stub.rpc = lambda name, params: calls.append((name, params)) or TableChain(DummyResponse(rows))
+
+    monkeypatch.setattr(node_services, "supabase", supabase_stub)
+
+    service = NodeService()
+    results = service.update_positions(
+        user_id=1,
+        positions=[
+            NodePosition(node_id="n1", position_x=4, position_y=2),
+            NodePosition(node_id="n9", position_x=0, position_y=0),
+            NodePosition(node_id="n1", position_x=5, position_y=3),
+        ],
+    )
+
+    assert [result["ok"] for result in results] == [True, False, True]
+    assert "search_vector" not in results[0]["node"]
+    assert calls == [
+        (
+            "apply_node_changes",
+            {
+                "p_user_id": 1,
+                "p_changes": [
+                    {"position_x": 5, "position_y": 3, "node_id": "n1"},
+                    {"position_x": 0, "position_y": 0, "node_id": "n9"},
+                ],
+            },
+        )
+    ]
+
+
+def test_update_positions_without_rpc_updates_each_node(monkeypatch):
+    chain = TableChain(response=DummyResponse([{"node_id": "n1"}]))
+    updates = []
+    chain.update = lambda change, **kwargs: updates.append(change) or chain
+    supabase_stub = SupabaseStub(table_chain=chain)
+
+    def missing_rpc(name, params):
+        raise APIError({"code": "PGRST202", "message": "function not found"})
+
+    supabase_stub.rpc = missing_rpc
+    monkeypatch.setattr(node_services, "supabase", supabase_stub)
+
+    service = NodeService()
+    results = service.update_positions(user_id=1, positions=[NodePosition(node_id="n1", position_x=1, position_y=2)])
+
+    assert results[0]["ok"] is True
+    assert service.changes_rpc_available is False
+    assert set(updates[0]) == {"position_x", "position_y", "updated_at"}
+
+
+def test_update_node_sends_only_set_fields(monkeypatch):
+    chain = TableChain(response=DummyResponse([]))
+    sent = {}
+
+    def fake_update(changes, returning=None):
+        sent.update(changes=changes, returning=returning)
+        return chain
+
+    chain.update = fake_update
+    monkeypatch.setattr(node_services, "supabase", SupabaseStub(table_chain=chain))
+
+    service = NodeService()
+    service.update_node(NodeUpdate(user_id=1, node_id="node-1", tags=["trip"]))
+
+    assert set(sent["changes"]) == {"tags", "updated_at"}
+    assert sent["changes"]["tags"] == ["trip"]
+    assert sent["returning"].value == "minimal"
+
+
+def test_update_node_without_changes_is_rejected(monkeypatch):
+    monkeypatch.setattr(node_services, "supabase", SupabaseStub(table_chain=TableChain()))
+
+    service = NodeService()
+    with pytest.raises(HTTPException) as exc_info:
+        service.update_node(NodeUpdate(user_id=1, node_id="node-1"))
+
+    assert exc_info.value.status_code == 400
+
+
+def test_adjacency_index_khop_and_path():
+    index = AdjacencyIndex(
+        [
+            {"source_node_id": "a", "target_node_id": "b"},
+            {"source_node_id": "b", "target_node_id": "c"},
+            {"source_node_id": "c", "target_node_id": "d"},
+            {"source_node_id": "e", "target_node_id": "a"},
+        ]
+    )
+
+    assert index.k_hop("a", 2) == {"b": 1, "e": 1, "c": 2}
+    assert index.k_hop("a", 2, direction="out") == {"b": 1, "c": 2}
+    assert index.shortest_path("e", "d") == ["e", "a", "b", "c", "d"]
+    assert index.shortest_path("d", "e", direction="out") is None
+    assert index.shortest_path("e", "d", max_depth=2) is None
+
+
+def test_delete_nodes_removes_incident_links_in_one_filter(monkeypatch):
+    link_chain = TableChain(response=DummyResponse([{"link_id": 5}, {"link_id": 6}]))
+    filters = []
+    link_chain.or_ = lambda expression: filters.append(expression) or link_chain
+    node_chain = TableChain(response=DummyResponse([{"node_id": "n1"}, {"node_id": "n2"}]))
+    recorded = []
+
+    monkeypatch.setattr(link_services, "supabase", SupabaseStub(table_chain=link_chain))
+    monkeypatch.setattr(node_services, "supabase", SupabaseStub(table_chain=node_chain))
+    monkeypatch.setattr(
+        sync_services.sync_service,
+        "record_deletes",
+        lambda user_id, entity, ids: recorded.append((entity, list(ids))),
+    )
+
+    result = NodeService().delete_nodes(user_id=1, node_ids=["n1", "n2", "n1"])
+
+    assert result == {"deleted_nodes": ["n1", "n2"], "deleted_links": [5, 6]}
+    assert filters == ['source_node_id.in.("n1","n2"),target_node_id.in.("n1","n2")']
+    assert recorded == [("link", [5, 6]), ("node", ["n1", "n2"])]
+
+
+def test_delete_links_of_nodes_keeps_filter_urls_short(monkeypatch):
+    chain = TableChain(response=DummyResponse([{"link_id": 1}]))
+    filters = []
+    chain.or_ = lambda expression: filters.append(expression) or chain
+    monkeypatch.setattr(link_services, "supabase", SupabaseStub(table_chain=chain))
+    monkeypatch.setattr(sync_services.sync_service, "record_deletes", lambda *args: None)
+
+    node_ids = [f"{i:08d}-0000-0000-0000-000000000000" for i in range(120)]
+    deleted = LinkService().delete_links_of_nodes(user_id=1, node_ids=node_ids)
+
+    assert len(filters) == 3
+    assert all(len(expression) < 5000 for expression in filters)
+    assert len(deleted) == 3
+
+
+def test_bulk_create_links_dedupes_pairs(monkeypatch):
+    existing = [{"link_id": 1, "source_node_id": "a", "target_node_id": "b", "created_at": "2024-01-01"}]
+    chain = TableChain(response=DummyResponse(existing))
+    inserted = []
+
+    def fake_insert(rows):
+        inserted.append(rows)
+        chain.response = DummyResponse([{**row, "link_id": 10 + i} for i, row in enumerate(rows)])
+        return chain
+
+    chain.insert = fake_insert
+    monkeypatch.setattr(link_services, "supabase", SupabaseStub(table_chain=chain))
+
+    service = LinkService()
+    results = service.bulk_create_links(
+        user_id=1,
+        items=[
+            {"source_node_id": "b", "target_node_id": "a"},
+            {"source_node_id": "b", "target_node_id": "c"},
+            {"source_node_id": "c", "target_node_id": "b"},
+            {"source_node_id": "c"},
+            {"source_node_id": "d", "target_node_id": " d"},
+        ],
+    )
+
+    assert len(inserted) == 1
+    assert [(row["source_node_id"], row["target_node_id"]) for row in inserted[0]] == [("b", "c")]
+    assert results[0]["link"]["link_id"] == 1 and results[0]["created"] is False
+    assert results[1]["created"] is True
+    assert results[2]["link"]["link_id"] == results[1]["link"]["link_id"] and results[2]["created"] is False
+    assert results[3]["ok"] is False
+    assert results[4] == {"index": 4, "ok": False, "error": "A node cannot be linked to itself"}
+
+
+def test_inverted_index_ranks_title_hits_and_tag_prefixes():
+    index = InvertedIndex(
+        [
+            {"node_id": "n1", "title": "Beach trip", "description": "sunny day", "tags": ["Travel"]},
+            {"node_id": "n2", "title": "Birthday", "description": "cake after the beach", "tags": ["family"]},
+            {"node_id": "n3", "title": "Trail run", "description": "", "tags": ["sport", "travel"]},
+        ]
+    )
+
+    assert [node_id for node_id, _ in index.search("beach")] == ["n1", "n2"]
+    assert [node_id for node_id, _ in index.search("tr")] == ["n1", "n3"]
+    assert [node_id for node_id, _ in index.search(tag_prefix="#tra")] == ["n1", "n3"]
+    assert [node_id for node_id, _ in index.search("beach cake")] == ["n2"]
+
+    index.upsert({"node_id": "n1", "title": "Mountain"})
+    index.remove("n2")
+
+    assert index.search("beach") == []
+    assert [node_id for node_id, _ in index.search("mount")] == ["n1"]
+    assert "beach" not in index.postings
+
+
+def test_search_service_local_index_follows_node_writes(monkeypatch):
+    rows = [{"node_id": "n1", "title": "Beach trip", "description": "d", "tags": []}]
+    table_chain = TableChain(response=DummyResponse(rows))
+    monkeypatch.setattr(search_services, "supabase", SupabaseStub(table_chain=table_chain))
+    monkeypatch.setattr(search_services, "NODE_SEARCH_BACKEND", "local")
+    monkeypatch.setattr(node_services.node_service, "list_all_nodes", lambda user_id, fields: rows)
+
+    service = SearchService()
+    service.postgres_available = False
+    assert [row["node_id"] for row in service.search(1, "beach")] == ["n1"]
+
+    service.apply(1, written=[{"node_id": "n1", "title": "Mountain"}], deleted=[])
+    assert service.search(1, "beach") == []
+
+    with pytest.raises(HTTPException) as exc:
+        service.search(1, " ")
+    assert exc.value.status_code == 400
+
+
+def test_timeline_buckets_counts_pages_without_rpc(monkeypatch):
+    # No migration: neither the function nor timeline_at exist, dates come from custom_date else created_at
+    rows = [
+        {"node_id": "n1", "custom_date": None, "created_at": "2024-01-03T10:00:00+00:00"},
+        {"node_id": "n2", "custom_date": "2024-01-20T10:00:00Z", "created_at": "2024-05-01T10:00:00+00:00"},
+        {"node_id": "n3", "custom_date": "2024-03-01T01:00:00+02:00", "created_at": "2024-05-01T10:00:00+00:00"},
+        {"node_id": "n4", "custom_date": None, "created_at": "2023-12-31T10:00:00+00:00"},
+    ]
+    chain = TableChain(response=DummyResponse(rows))
+    selected = []
+    chain.select = lambda columns: selected.append(columns) or chain
+    supabase_stub = SupabaseStub(table_chain=chain)
+
+    def missing_rpc(name, params):
+        raise APIError({"code": "PGRST202", "message": "function not found"})
+
+    supabase_stub.rpc = missing_rpc
+    monkeypatch.setattr(node_services, "supabase", supabase_stub)
+
+    buckets = NodeService().timeline_buckets(user_id=1, bucket="month", start=datetime.datetime(2024, 1, 1))
+
+    assert buckets == [{"bucket": "2024-01", "count": 2}, {"bucket": "2024-02", "count": 1}]
+    assert all("timeline_at" not in columns for columns in selected)
+